@@ -1,17 +1,48 @@
+import base64
+from collections import Counter
 from enum import Enum
+from functools import partial, wraps
+import json
 import os
 import re
+import threading
+import time
 from datetime import datetime, timedelta, timezone
-from flask import Flask, jsonify, request, abort
+import click
+from flask.cli import AppGroup
+from flask import Flask, Response, jsonify, make_response, request, has_request_context, abort, send_file, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
-from flask_jwt_extended import JWTManager, create_access_token, create_refresh_token, get_jwt, jwt_required
-from sqlalchemy.orm import joinedload
-from werkzeug.security import generate_password_hash, check_password_hash
+from flask_jwt_extended import JWTManager, create_access_token, create_refresh_token, get_jwt, jwt_required, verify_jwt_in_request
+from sqlalchemy import and_, delete, event, exists, func, insert, inspect, literal, or_, select, text, update
+from sqlalchemy.exc import OperationalError
+from background import PeriodicTask
+from db_profile import (REPLICA_BIND, RoutingSession, apply_sqlite_pragmas, backend_name, current_shard, is_sqlite, pool_options,
+                        reading_replica, shard_bind, sqlite_pragmas, use_read_replica, use_shard)
+from availability import AvailabilityIndex
+from change_feed import ChangeNotifier
+from entity_cache import EntityCache
+from counters import CounterTable
+from bulk_io import ImportReport, RowSchema, UnreadableInput, batched, csv_lines, parse_bool, parse_email, parse_enum, parse_int, parse_text, read_rows
+from instrumentation import RequestMetrics
+from log_buffer import LogBuffer
+from log_retention import LogArchive
+import migrations
+from overdue import OverdueTracker
+from password_hashing import PasswordHashBusy, PasswordHasher
+from rate_limit import TokenBucketLimiter
+from reports import REPORTS, ReportPool, ReportsBusy
+from response_cache import ResponseCache
+from search_index import FullTextIndex
+from serializers import FastJSONProvider, ModelSerializer, NestedSerializer
+from sharding import DEFAULT_SHARD, ID_RANGE, ShardRouter, merge_sorted, parse_shards
+from token_blocklist import BlocklistCache
+from transactions import Rollback, TransactionRetry, is_lock_error
 
 
 # Initialize the Flask application
 app = Flask(__name__)
+app.json = FastJSONProvider(app)  # orjson when installed, the stdlib encoder otherwise
 app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///library.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 """
@@ -27,19 +58,207 @@ app.config['JWT_BLACKLIST_TOKEN_CHECKS'] = ['access']
 app.config['JWT_ACCESS_TOKEN_EXPIRES'] = timedelta(hours=1)
 app.config['JWT_REFRESH_TOKEN_EXPIRES'] = timedelta(days=30)
 
-# Initialize SQLAlchemy
-db = SQLAlchemy(app)
+# Revoked token cache: workers share revocations through an append-only channel file
+app.config['JWT_BLOCKLIST_CHANNEL'] = os.environ.get('JWT_BLOCKLIST_CHANNEL', os.path.join(app.instance_path, 'token_blocklist.channel'))
+app.config['JWT_BLOCKLIST_NEGATIVE_TTL'] = int(os.environ.get('JWT_BLOCKLIST_NEGATIVE_TTL', 60))
+app.config['TOKEN_PURGE_INTERVAL'] = int(os.environ.get('TOKEN_PURGE_INTERVAL', 3600))
+
+# Password hashing runs on a bounded pool; stored hashes made with other parameters are upgraded at login
+app.config['PASSWORD_HASH_METHOD'] = os.environ.get('PASSWORD_HASH_METHOD', 'scrypt')  # e.g. 'pbkdf2:sha256:600000'
+app.config['PASSWORD_HASH_WORKERS'] = int(os.environ.get('PASSWORD_HASH_WORKERS', 2))  # Concurrent hashes per process
+app.config['PASSWORD_HASH_QUEUE'] = int(os.environ.get('PASSWORD_HASH_QUEUE', 32))
+app.config['PASSWORD_HASH_QUEUE_TIMEOUT'] = float(os.environ.get('PASSWORD_HASH_QUEUE_TIMEOUT', 2.0))
+
+# Login attempts allowed per username and per client address before 429, checked before any hashing
+app.config['LOGIN_RATE_LIMIT_ENABLED'] = os.environ.get('LOGIN_RATE_LIMIT_ENABLED', '1') == '1'
+app.config['LOGIN_RATE_USERNAME_BURST'] = int(os.environ.get('LOGIN_RATE_USERNAME_BURST', 5))
+app.config['LOGIN_RATE_USERNAME_PER_MINUTE'] = float(os.environ.get('LOGIN_RATE_USERNAME_PER_MINUTE', 5))
+app.config['LOGIN_RATE_IP_BURST'] = int(os.environ.get('LOGIN_RATE_IP_BURST', 20))
+app.config['LOGIN_RATE_IP_PER_MINUTE'] = float(os.environ.get('LOGIN_RATE_IP_PER_MINUTE', 60))
+
+# Buffered logging: log_message queues records and a background thread bulk-inserts them
+app.config['LOG_BUFFER_ENABLED'] = os.environ.get('LOG_BUFFER_ENABLED', '1') == '1'
+app.config['LOG_BUFFER_SIZE'] = int(os.environ.get('LOG_BUFFER_SIZE', 10000))
+app.config['LOG_FLUSH_BATCH_SIZE'] = int(os.environ.get('LOG_FLUSH_BATCH_SIZE', 500))
+app.config['LOG_FLUSH_INTERVAL'] = float(os.environ.get('LOG_FLUSH_INTERVAL', 1.0))
+app.config['LOG_QUEUE_POLICY'] = os.environ.get('LOG_QUEUE_POLICY', 'drop')  # 'drop' or 'block' when the queue is full
+app.config['LOG_FLUSH_ATTEMPTS'] = int(os.environ.get('LOG_FLUSH_ATTEMPTS', 3))  # Tries per batch before its records are lost
+
+# Log retention: hourly per-level rollups, then records older than LOG_RETENTION_DAYS move to gzipped NDJSON archives
+app.config['LOG_RETENTION_DAYS'] = float(os.environ.get('LOG_RETENTION_DAYS', 30))
+app.config['LOG_RETENTION_INTERVAL'] = int(os.environ.get('LOG_RETENTION_INTERVAL', 3600))  # 0 disables the background job
+app.config['LOG_RETENTION_CHUNK_SIZE'] = int(os.environ.get('LOG_RETENTION_CHUNK_SIZE', 1000))  # Rows deleted per transaction
+app.config['LOG_ROLLUP_DELAY'] = int(os.environ.get('LOG_ROLLUP_DELAY', 60))  # Seconds an hour is left open for late flushes
+app.config['LOG_ARCHIVE_DIR'] = os.environ.get('LOG_ARCHIVE_DIR', os.path.join(app.instance_path, 'log_archive'))
+app.config['LOG_ARCHIVE_MAX_RESULTS'] = int(os.environ.get('LOG_ARCHIVE_MAX_RESULTS', 1000))
+
+# List endpoints: keyset pagination and streaming
+app.config['DEFAULT_PAGE_SIZE'] = int(os.environ.get('DEFAULT_PAGE_SIZE', 100))
+app.config['MAX_PAGE_SIZE'] = int(os.environ.get('MAX_PAGE_SIZE', 1000))
+app.config['STREAM_BATCH_SIZE'] = int(os.environ.get('STREAM_BATCH_SIZE', 500))
+app.config['IMPORT_BATCH_SIZE'] = int(os.environ.get('IMPORT_BATCH_SIZE', 1000))
+
+# Search endpoints: number of results returned when the request gives no limit, and the cap on it
+app.config['SEARCH_DEFAULT_LIMIT'] = int(os.environ.get('SEARCH_DEFAULT_LIMIT', 50))
+app.config['SEARCH_MAX_LIMIT'] = int(os.environ.get('SEARCH_MAX_LIMIT', 500))
+
+# Response cache for the list endpoints; the shared tier lets every worker see invalidations
+app.config['RESPONSE_CACHE_ENABLED'] = os.environ.get('RESPONSE_CACHE_ENABLED', '1') == '1'
+app.config['RESPONSE_CACHE_SIZE'] = int(os.environ.get('RESPONSE_CACHE_SIZE', 256))
+app.config['RESPONSE_CACHE_TTL'] = int(os.environ.get('RESPONSE_CACHE_TTL', 300))
+app.config['RESPONSE_CACHE_SHARED_PATH'] = os.environ.get('RESPONSE_CACHE_SHARED_PATH', os.path.join(app.instance_path, 'response_cache.db'))
+
+# Change feed: writes append to change_log; /changes long-polls and /changes/stream pushes Server-Sent Events
+app.config['CHANGES_DEFAULT_LIMIT'] = int(os.environ.get('CHANGES_DEFAULT_LIMIT', 100))
+app.config['CHANGES_MAX_LIMIT'] = int(os.environ.get('CHANGES_MAX_LIMIT', 1000))
+app.config['CHANGES_MAX_WAIT'] = float(os.environ.get('CHANGES_MAX_WAIT', 25))  # Longest long-poll, in seconds
+app.config['CHANGES_POLL_INTERVAL'] = float(os.environ.get('CHANGES_POLL_INTERVAL', 1.0))  # Re-check for other workers' changes
+app.config['CHANGES_MAX_WAITERS'] = int(os.environ.get('CHANGES_MAX_WAITERS', 32))  # Long-polls and streams per process
+app.config['CHANGES_HEARTBEAT'] = float(os.environ.get('CHANGES_HEARTBEAT', 15))
+app.config['CHANGES_STREAM_MAX_SECONDS'] = float(os.environ.get('CHANGES_STREAM_MAX_SECONDS', 300))  # Clients reconnect after this
+app.config['CHANGE_LOG_RETENTION_DAYS'] = float(os.environ.get('CHANGE_LOG_RETENTION_DAYS', 7))  # Also how long a silent consumer is kept
+app.config['CHANGE_COMPACTION_INTERVAL'] = int(os.environ.get('CHANGE_COMPACTION_INTERVAL', 300))  # 0 disables the background job
+
+# Availability index: ids of borrowable books per category and loan type, held in memory and caught up from the change log
+app.config['AVAILABILITY_INDEX_ENABLED'] = os.environ.get('AVAILABILITY_INDEX_ENABLED', '1') == '1'
+app.config['AVAILABILITY_MAX_STALENESS'] = float(os.environ.get('AVAILABILITY_MAX_STALENESS', 1.0))  # Seconds before other workers' writes show
+app.config['AVAILABILITY_REBUILD_INTERVAL'] = int(os.environ.get('AVAILABILITY_REBUILD_INTERVAL', 3600))
+
+# Entity cache: books and customers by id, name and email, shared by a process's requests and caught up from the change log
+app.config['ENTITY_CACHE_ENABLED'] = os.environ.get('ENTITY_CACHE_ENABLED', '1') == '1'
+app.config['ENTITY_CACHE_SIZE'] = int(os.environ.get('ENTITY_CACHE_SIZE', 10000))
+app.config['ENTITY_CACHE_MAX_STALENESS'] = float(os.environ.get('ENTITY_CACHE_MAX_STALENESS', 1.0))  # Seconds before other workers' writes show
+
+# Overdue loans: late listings come from an in-memory tracker refreshed by a background scan
+app.config['OVERDUE_TRACKER_ENABLED'] = os.environ.get('OVERDUE_TRACKER_ENABLED', '1') == '1'
+app.config['OVERDUE_SCAN_INTERVAL'] = int(os.environ.get('OVERDUE_SCAN_INTERVAL', 60))
+app.config['OVERDUE_REBUILD_INTERVAL'] = int(os.environ.get('OVERDUE_REBUILD_INTERVAL', 3600))
+app.config['OVERDUE_MAX_IN_IDS'] = int(os.environ.get('OVERDUE_MAX_IN_IDS', 10000))  # Above this, use the due-date index instead
+
+# Instrumentation: requests slower than this keep their SQL for GET /metrics/slow (0 disables)
+app.config['SLOW_REQUEST_THRESHOLD_MS'] = float(os.environ.get('SLOW_REQUEST_THRESHOLD_MS', 500))
+app.config['SERVER_TIMING_ENABLED'] = os.environ.get('SERVER_TIMING_ENABLED', '0') == '1'
+
+# Write transactions (checkout) are retried with jittered exponential backoff while SQLite reports the database as locked
+app.config['TRANSACTION_RETRY_ATTEMPTS'] = int(os.environ.get('TRANSACTION_RETRY_ATTEMPTS', 5))
+app.config['TRANSACTION_RETRY_BACKOFF'] = float(os.environ.get('TRANSACTION_RETRY_BACKOFF', 0.01))
+app.config['TRANSACTION_RETRY_MAX_BACKOFF'] = float(os.environ.get('TRANSACTION_RETRY_MAX_BACKOFF', 0.5))
+app.config['MAX_BATCH_ITEMS'] = int(os.environ.get('MAX_BATCH_ITEMS', 100))  # Items per /loans/batch or /returns/batch request
+app.config['MAX_ACTIVE_LOANS_PER_CUSTOMER'] = int(os.environ.get('MAX_ACTIVE_LOANS_PER_CUSTOMER', 0))  # Checked at checkout; 0 means no limit
+
+# ASGI mode (asgi.py): threads per process running the views while the event loop holds the connections
+app.config['ASGI_THREADS'] = int(os.environ.get('ASGI_THREADS', 64))
+
+# Database engine profile: SQLite pragmas, pool limits for server databases, and an optional read replica
+app.config['DATABASE_REPLICA_URL'] = os.environ.get('DATABASE_REPLICA_URL', '')  # List, search and export reads go here when set
+app.config['SQLITE_JOURNAL_MODE'] = os.environ.get('SQLITE_JOURNAL_MODE', 'WAL')
+app.config['SQLITE_SYNCHRONOUS'] = os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL')
+app.config['SQLITE_BUSY_TIMEOUT_MS'] = int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', 5000))
+app.config['SQLITE_MMAP_SIZE'] = int(os.environ.get('SQLITE_MMAP_SIZE', 256 * 1024 * 1024))
+app.config['SQLITE_CACHE_SIZE_KIB'] = int(os.environ.get('SQLITE_CACHE_SIZE_KIB', 16384))  # Per connection
+app.config['DB_POOL_SIZE'] = int(os.environ.get('DB_POOL_SIZE', 5))  # Per worker process
+app.config['DB_MAX_OVERFLOW'] = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+app.config['DB_POOL_TIMEOUT'] = int(os.environ.get('DB_POOL_TIMEOUT', 30))
+app.config['DB_POOL_RECYCLE'] = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+app.config['DB_POOL_PRE_PING'] = os.environ.get('DB_POOL_PRE_PING', '1') == '1'
+
+# Sharding: each branch's customers, books and loans live on one shard; the primary database is the 'default' shard
+app.config['SHARDS'] = parse_shards(os.environ.get('SHARDS', ''))  # Extra shards, e.g. 'north=sqlite:///north.db south=postgresql://...'
+app.config['SHARD_DIRECTORY_TTL'] = float(os.environ.get('SHARD_DIRECTORY_TTL', 5))  # Seconds a process trusts its copy of the branch map
+app.config['SHARD_MOVE_BATCH_SIZE'] = int(os.environ.get('SHARD_MOVE_BATCH_SIZE', 1000))  # Rows copied per transaction by `flask shards move`
+
+# Reports: POST /reports queues a job that a pool of separate processes runs, writing a CSV file to REPORT_DIR
+app.config['REPORT_WORKERS'] = int(os.environ.get('REPORT_WORKERS', 2))  # Processes per web worker, started with the first report
+app.config['REPORT_MAX_QUEUE'] = int(os.environ.get('REPORT_MAX_QUEUE', 8))  # Jobs waiting for a process before POST /reports answers 503
+app.config['REPORT_CHUNK_SIZE'] = int(os.environ.get('REPORT_CHUNK_SIZE', 10000))  # Rows fetched and totalled at a time
+app.config['REPORT_DIR'] = os.environ.get('REPORT_DIR', os.path.join(app.instance_path, 'reports'))
+app.config['REPORT_STALE_AFTER'] = int(os.environ.get('REPORT_STALE_AFTER', 600))  # Seconds without progress before a running job counts as failed
+
+def engine_options(url):
+    """Engine options for a database URL: SQLite keeps SQLAlchemy's pool, server databases get a bounded one."""
+    if is_sqlite(url):
+        return {}
+    return pool_options(
+        pool_size=app.config['DB_POOL_SIZE'],
+        max_overflow=app.config['DB_MAX_OVERFLOW'],
+        pool_timeout=app.config['DB_POOL_TIMEOUT'],
+        pool_recycle=app.config['DB_POOL_RECYCLE'],
+        pool_pre_ping=app.config['DB_POOL_PRE_PING']
+    )
+
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config['SQLALCHEMY_DATABASE_URI'])
+app.config['SQLALCHEMY_BINDS'] = {}
+if app.config['DATABASE_REPLICA_URL']:
+    app.config['SQLALCHEMY_BINDS'][REPLICA_BIND] = {'url': app.config['DATABASE_REPLICA_URL'], **engine_options(app.config['DATABASE_REPLICA_URL'])}
+for shard_name, shard_url in app.config['SHARDS'].items():
+    app.config['SQLALCHEMY_BINDS'][shard_bind(shard_name)] = {'url': shard_url, **engine_options(shard_url)}
+
+SQLITE_PRAGMAS = sqlite_pragmas(
+    journal_mode=app.config['SQLITE_JOURNAL_MODE'],
+    synchronous=app.config['SQLITE_SYNCHRONOUS'],
+    busy_timeout_ms=app.config['SQLITE_BUSY_TIMEOUT_MS'],
+    mmap_size=app.config['SQLITE_MMAP_SIZE'],
+    cache_size_kib=app.config['SQLITE_CACHE_SIZE_KIB']
+)
+
+# Initialize SQLAlchemy; the routing session sends sharded tables to the request's shard and reads of @read_replica views to the replica
+db = SQLAlchemy(app, session_options={'class_': RoutingSession})
+for shard_name in app.config['SHARDS']:
+    db.metadatas[shard_bind(shard_name)] = db.metadata  # Every shard has the full schema, so create_all() and drop_all() cover them
+with app.app_context():
+    for engine in db.engines.values():
+        apply_sqlite_pragmas(engine, SQLITE_PRAGMAS)
 CORS(app)
 
+# Per-request query counts and timings, exported on /metrics
+metrics = RequestMetrics(
+    slow_threshold_ms=app.config['SLOW_REQUEST_THRESHOLD_MS'],
+    server_timing=app.config['SERVER_TIMING_ENABLED']
+)
+metrics.init_app(app)
+
 # Initialize JWT Manager
 jwt = JWTManager(app)
 
+def is_jti_in_database(jti):
+    """Look up a token ID in the TokenBlacklist table."""
+    return TokenBlacklist.query.filter_by(jti=jti).first() is not None
+
+blocklist_cache = BlocklistCache(
+    is_jti_in_database,
+    app.config['JWT_BLOCKLIST_CHANNEL'],
+    negative_ttl=app.config['JWT_BLOCKLIST_NEGATIVE_TTL']
+)
+
+def purge_expired_tokens():
+    """Delete blacklisted tokens that have expired anyway and drop them from the cache."""
+    with app.app_context():
+        cutoff = datetime.utcnow() - app.config['JWT_ACCESS_TOKEN_EXPIRES']
+        deleted = TokenBlacklist.query.filter(TokenBlacklist.created_at < cutoff).delete(synchronize_session=False)
+        db.session.commit()
+        blocklist_cache.prune()
+        return deleted
+
+token_purge_task = PeriodicTask('token-purge', app.config['TOKEN_PURGE_INTERVAL'], purge_expired_tokens)
+
+def load_blocklist_cache():
+    """Fill the cache with the unexpired blacklisted tokens and start the purge job."""
+    expires = app.config['JWT_ACCESS_TOKEN_EXPIRES']
+    cutoff = datetime.utcnow() - expires
+    tokens = TokenBlacklist.query.filter(TokenBlacklist.created_at >= cutoff).all()
+    # A token revoked at created_at was issued before then, so it expires no later than created_at + expires
+    blocklist_cache.load(
+        (token.jti, (token.created_at + expires).replace(tzinfo=timezone.utc).timestamp()) for token in tokens
+    )
+    token_purge_task.start()
+
 # Token Blacklist Check
 @jwt.token_in_blocklist_loader
 def check_if_token_in_blacklist(jwt_header, jwt_payload):
+    if not blocklist_cache.loaded:
+        load_blocklist_cache()
     jti = jwt_payload['jti']  # Get the token ID
-    token = TokenBlacklist.query.filter_by(jti=jti).first()
-    return token is not None  # Return True if the token is blacklisted
+    return blocklist_cache.is_revoked(jti, jwt_payload['exp'])  # Return True if the token is blacklisted
 
 # Define Enums for City and Loan Type
 class City(Enum):
@@ -74,6 +293,20 @@ class BookCategory(Enum):
     HISTORICAL_FICTION = "historical fiction"
     YOUNG_ADULT = "young adult"
 
+def dialect_options(option, **values):
+    """Dialect-specific keyword arguments for the configured database only, e.g. {'sqlite_where': ...}.
+
+    Naming another dialect's option would import that dialect at startup (about 50 ms for PostgreSQL).
+    """
+    backend = backend_name(app.config['SQLALCHEMY_DATABASE_URI'])
+    return {f'{backend}_{option}': values[backend]} if backend in values else {}
+
+def shard_id_default(table):
+    """Primary key options for a sharded table: with SHARDS set, each shard hands out ids from its own range."""
+    if not app.config['SHARDS']:
+        return {}
+    return {'default': lambda context: next_shard_id(context, table)}
+
 # Define models for User, Books, Customers, Loans, and Log
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -82,11 +315,11 @@ class User(db.Model):
 
     def set_password(self, password):
         """Hashes the password and stores it in the database."""
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = password_hasher.hash(password)
 
     def check_password(self, password):
         """Checks if the provided password matches the hashed password."""
-        return check_password_hash(self.password_hash, password)
+        return password_hasher.verify(self.password_hash, password)[0]
 
     def __repr__(self):
         return f'<User {self.username}>'
@@ -96,12 +329,16 @@ class TokenBlacklist(db.Model):
     jti = db.Column(db.String(36), unique=True, nullable=False)  # JWT ID
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        db.Index('ix_token_blacklist_created_at', 'created_at'),  # Purge of expired tokens
+    )
+
     def __repr__(self):
         return f'<TokenBlacklist {self.jti}>'
 
 class Books(db.Model):
     """Model representing a book in the library."""
-    id = db.Column(db.Integer, primary_key=True)
+    id = db.Column(db.Integer, primary_key=True, **shard_id_default('books'))
     name = db.Column(db.String(80), unique=True, nullable=False)
     author = db.Column(db.String(80), nullable=False)
     year_published = db.Column(db.Integer, nullable=False)
@@ -109,10 +346,16 @@ class Books(db.Model):
     category = db.Column(db.Enum(BookCategory), nullable=False)  # Added category field
     is_active = db.Column(db.Boolean, default=True)
     is_loaned = db.Column(db.Boolean, default=False)
+    branch = db.Column(db.Enum(City))  # Branch holding the book, which decides its shard; None for the default shard
 
     # Define a relationship to Loans
     loans = db.relationship('Loans', back_populates='book')
 
+    __table_args__ = (
+        db.Index('ix_books_is_active_id', 'is_active', 'id'),  # Status listings in id order
+        db.Index('ix_books_is_active_is_loaned', 'is_active', 'is_loaned'),  # Available books
+    )
+
     def to_dict(self):
         """Convert the Book object to a dictionary for JSON serialization."""
         return {
@@ -123,12 +366,13 @@ class Books(db.Model):
             'loan_time_type': self.loan_time_type.name,
             'category': self.category.name,  # Include category in dict
             'is_active': self.is_active,
-            'is_loaned': self.is_loaned
+            'is_loaned': self.is_loaned,
+            'branch': self.branch.name if self.branch else None
         }
 
 class Customers(db.Model):
     """Model representing a customer of the library."""
-    id = db.Column(db.Integer, primary_key=True)
+    id = db.Column(db.Integer, primary_key=True, **shard_id_default('customers'))
     full_name = db.Column(db.String(80), nullable=False)
     email = db.Column(db.String(80), unique=True, nullable=False)
     city = db.Column(db.Enum(City), nullable=False)
@@ -138,6 +382,10 @@ class Customers(db.Model):
     # Define a relationship to Loans
     loans = db.relationship('Loans', back_populates='customer')
 
+    __table_args__ = (
+        db.Index('ix_customers_is_active_id', 'is_active', 'id'),  # Status listings in id order
+    )
+
     def to_dict(self):
         """Convert the Customer object to a dictionary for JSON serialization."""
         return {
@@ -151,7 +399,7 @@ class Customers(db.Model):
 
 class Loans(db.Model):
     """Model representing a loan of a book."""
-    id = db.Column(db.Integer, primary_key=True)
+    id = db.Column(db.Integer, primary_key=True, **shard_id_default('loans'))
     customer_id = db.Column(db.Integer, db.ForeignKey('customers.id'), nullable=False)
     book_id = db.Column(db.Integer, db.ForeignKey('books.id'), nullable=False)
     loan_time_type = db.Column(db.Enum(LoanType), nullable=False)
@@ -163,6 +411,15 @@ class Loans(db.Model):
     book = db.relationship('Books', back_populates='loans')
     customer = db.relationship('Customers', back_populates='loans')
 
+    __table_args__ = (
+        db.Index('ix_loans_is_active_id', 'is_active', 'id'),  # Status listings in id order
+        db.Index('ix_loans_is_active_return_date', 'is_active', 'return_date'),  # Late loans
+        db.Index('ix_loans_open_return_date', 'return_date',
+                 **dialect_options('where', sqlite=text('is_active = 1'), postgresql=text('is_active'))),  # Due dates of open loans only
+        db.Index('ix_loans_customer_id_is_active', 'customer_id', 'is_active'),  # Loans of a customer
+        db.Index('ix_loans_book_id_is_active', 'book_id', 'is_active'),  # Loans of a book
+    )
+
     def to_dict(self):
         """Convert the Loan object to a dictionary for JSON serialization."""
         return {
@@ -182,30 +439,300 @@ class Log(db.Model):
     level = db.Column(db.String(10), nullable=False)
     message = db.Column(db.String(256), nullable=False)
 
+    __table_args__ = (
+        db.Index('ix_log_timestamp', 'timestamp'),  # Time-range scans
+    )
+
     def __repr__(self):
         """Return a string representation of the Log entry."""
         return f'<Log {self.id}: {self.level} - {self.message}>'
 
+class LogRollup(db.Model):
+    """Number of log records per level and hour, kept after the records are archived."""
+    __tablename__ = 'log_rollup'
+    hour = db.Column(db.DateTime, primary_key=True)
+    level = db.Column(db.String(10), primary_key=True)
+    count = db.Column(db.Integer, nullable=False)
+
+    def to_dict(self):
+        return {'hour': self.hour.isoformat(), 'level': self.level, 'count': self.count}
+
+class StatCounter(db.Model):
+    """Running totals behind the /stats endpoints, e.g. ('active_loans_by_city', 'HAIFA')."""
+    __tablename__ = 'stat_counters'
+    name = db.Column(db.String(40), primary_key=True)
+    key = db.Column(db.String(40), primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
+
+class ChangeLog(db.Model):
+    """One created, updated or deleted book, customer or loan; seqs commit in order (see reserve_change_seqs)."""
+    __tablename__ = 'change_log'
+    seq = db.Column(db.Integer, primary_key=True)
+    timestamp = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    entity = db.Column(db.String(20), nullable=False)  # 'books', 'customers' or 'loans'
+    entity_id = db.Column(db.Integer, nullable=False)
+    action = db.Column(db.String(10), nullable=False)  # 'created', 'updated' or 'deleted'
+    data = db.Column(db.JSON)  # The row after the change; None for deletions
+
+    __table_args__ = (
+        db.Index('ix_change_log_timestamp', 'timestamp'),  # Compaction by age
+        {'sqlite_autoincrement': True}  # Never hand out a seq again once compaction deleted it
+    )
+
+class ChangeConsumer(db.Model):
+    """How far a named /changes consumer has read; compaction keeps what the slowest one still needs."""
+    __tablename__ = 'change_consumers'
+    name = db.Column(db.String(80), primary_key=True)
+    seq = db.Column(db.Integer, nullable=False)
+    seen_at = db.Column(db.DateTime, nullable=False)
+
+class ShardDirectory(db.Model):
+    """The shard holding each branch's customers, books and loans; branches not listed are on the default shard."""
+    __tablename__ = 'shard_directory'
+    branch = db.Column(db.Enum(City), primary_key=True)
+    shard = db.Column(db.String(40), nullable=False)
+    moving = db.Column(db.Boolean, nullable=False, default=False)  # The shard is read-only while the branch is copied off it
+
+class ShardIdSequence(db.Model):
+    """Last id a shard handed out for a sharded table, within the shard's own id range."""
+    __tablename__ = 'shard_id_sequences'
+    name = db.Column(db.String(40), primary_key=True)
+    last_id = db.Column(db.BigInteger, nullable=False)
+
+class ReportJob(db.Model):
+    """A report queued with POST /reports; a pool process fills in the progress and writes the CSV file."""
+    __tablename__ = 'report_jobs'
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(20), nullable=False)  # A name in reports.REPORTS
+    status = db.Column(db.String(10), nullable=False, default='queued')  # 'queued', 'running', 'done', 'failed' or 'cancelled'
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)  # The report describes the data as of then
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    rows_total = db.Column(db.Integer)  # Counted when the job starts
+    rows_done = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime)  # Last write by the pool process; a running job that stops writing has died
+    cancel_requested = db.Column(db.Boolean, nullable=False, default=False)  # The job stops after its current chunk
+    error = db.Column(db.String(256))
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'status': self.status,
+            'created_at': self.created_at.isoformat(),
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+            'rows_done': self.rows_done,
+            'rows_total': self.rows_total,
+            'progress': round(self.rows_done / self.rows_total, 3) if self.rows_total else float(self.status == 'done'),
+            'error': self.error
+        }
+
+# Users, tokens, logs, report jobs and the shard directory stay on the primary; every other table follows the request's shard
+RoutingSession.global_tables = frozenset(model.__tablename__ for model in (User, TokenBlacklist, Log, LogRollup, ReportJob, ShardDirectory))
+
+SEQUENCED_MODELS = [Books, Customers, Loans]
+
+def next_shard_id(context, table):
+    """Column default giving the next id from the shard's sequence for `table`.
+
+    The sequence row is advanced once per INSERT statement for all its rows, on the inserting
+    connection, so the ids are reserved in the same transaction as the rows that use them.
+    """
+    reserved = context.__dict__.setdefault('shard_ids', {})
+    if table not in reserved:
+        count = len(context.compiled_parameters)
+        last_id = context.connection.execute(
+            update(ShardIdSequence).where(ShardIdSequence.name == table)
+            .values(last_id=ShardIdSequence.last_id + count).returning(ShardIdSequence.last_id)
+        ).scalar()
+        if last_id is None:
+            raise RuntimeError(f"No id sequence for {table} on this shard; run 'flask db upgrade'.")
+        reserved[table] = iter(range(last_id - count + 1, last_id + 1))
+    return next(reserved[table])
+
+def connection_shard(connection):
+    """Name of the shard a connection belongs to."""
+    return next(name for name in shard_router.names if db.engines[shard_bind(name)] is connection.engine)
+
+def sync_id_sequences(connection):
+    """Move this shard's id sequences past the ids already in its range, e.g. rows added before SHARDS was set."""
+    tables = set(inspect(connection).get_table_names())
+    if ShardIdSequence.__tablename__ not in tables:
+        return
+    base = shard_router.id_base(connection_shard(connection))
+    last_ids = dict(connection.execute(select(ShardIdSequence.name, ShardIdSequence.last_id)).all())
+    for model_class in SEQUENCED_MODELS:
+        name = model_class.__tablename__
+        highest = connection.scalar(select(func.max(model_class.id)).where(
+            model_class.id >= base, model_class.id < base + ID_RANGE)) if name in tables else None
+        last_id = max(base, highest or 0, last_ids.get(name, 0))
+        set_sequence(connection, last_ids, name, last_id)
+    # The change log's seqs count from 0 on every shard (see reserve_change_seqs)
+    name = ChangeLog.__tablename__
+    highest = connection.scalar(select(func.max(ChangeLog.seq))) if name in tables else None
+    set_sequence(connection, last_ids, name, max(highest or 0, last_ids.get(name, 0)))
+
+def set_sequence(connection, last_ids, name, last_id):
+    if name not in last_ids:
+        connection.execute(insert(ShardIdSequence).values(name=name, last_id=last_id))
+    elif last_id != last_ids[name]:
+        connection.execute(update(ShardIdSequence).where(ShardIdSequence.name == name).values(last_id=last_id))
+
+event.listen(ShardIdSequence.__table__, 'after_create', lambda target, connection, **kw: sync_id_sequences(connection))
+
+def load_shard_directory():
+    """{branch: (shard, moving)} from the directory table on the primary."""
+    with db.engine.connect() as connection:
+        return {branch.name: (shard, moving) for branch, shard, moving in
+                connection.execute(select(ShardDirectory.branch, ShardDirectory.shard, ShardDirectory.moving))}
+
+shard_router = ShardRouter([DEFAULT_SHARD, *app.config['SHARDS']], load_shard_directory, ttl=app.config['SHARD_DIRECTORY_TTL'])
+metrics.add_gauge('library_shards', "Shards, branches mapped to them and directory reloads.", shard_router.stats)
+
+def shard_stats(stats_by_shard):
+    """Merge per-shard gauge values, prefixing those of every shard but the default one with its name."""
+    return {(name if shard == DEFAULT_SHARD else f'{shard}.{name}'): value
+            for shard, stats in stats_by_shard.items() for name, value in stats.items()}
+
+# Full-text search indexes (SQLite FTS5), created and dropped together with their tables
+SEARCH_INDEXES = {
+    Books: FullTextIndex('books', ['name', 'author']),
+    Customers: FullTextIndex('customers', ['full_name', 'email'])
+}
+
+for indexed_model, search_index in SEARCH_INDEXES.items():
+    event.listen(indexed_model.__table__, 'after_create', lambda target, connection, index=search_index, **kw: index.install(connection))
+    event.listen(indexed_model.__table__, 'before_drop', lambda target, connection, index=search_index, **kw: index.drop(connection))
+
+def install_search_indexes(connection):
+    """Create any missing full-text indexes for tables that already exist."""
+    for search_index in SEARCH_INDEXES.values():
+        search_index.install(connection)
+
+# Statistics counters, changed in the same transactions as the books and loans they count
+stat_counters = CounterTable(StatCounter.__table__)
+
+def count_books(deltas, is_active, is_loaned, count=1):
+    deltas['books', 'total'] += count
+    deltas['books', 'active'] += count if is_active else 0
+    deltas['books', 'loaned'] += count if is_loaned else 0
+
+def count_loans(deltas, city, category, active, total):
+    deltas['loans', 'active'] += active
+    deltas['loans', 'total'] += total
+    for group, value in (('city', city), ('category', category)):
+        if value is not None:
+            deltas[f'active_loans_by_{group}', value.name] += active
+            deltas[f'loans_by_{group}', value.name] += total
+
+def book_counter_deltas(books, sign=1):
+    """Counter changes for adding (sign=1) or removing (sign=-1) books given as (is_active, is_loaned) pairs."""
+    deltas = Counter()
+    for is_active, is_loaned in books:
+        count_books(deltas, is_active, is_loaned, sign)
+    return deltas
+
+def loan_counter_deltas(connection, loans, active=0, total=0, loaned=0):
+    """Counter changes for loans given as (book_id, customer_id) pairs, adding `active`, `total` and `loaned` per loan."""
+    deltas = Counter()
+    if not loans:
+        return deltas
+    categories = dict(connection.execute(select(Books.id, Books.category).where(Books.id.in_({book_id for book_id, _ in loans}))).all())
+    cities = dict(connection.execute(select(Customers.id, Customers.city).where(Customers.id.in_({customer_id for _, customer_id in loans}))).all())
+    for book_id, customer_id in loans:
+        count_loans(deltas, cities.get(customer_id), categories.get(book_id), active, total)
+        deltas['books', 'loaned'] += loaned
+    return deltas
+
+def count_stats(connection):
+    """Recount every statistic from the books and loans tables."""
+    values = Counter()
+    for is_active, is_loaned, count in connection.execute(
+            select(Books.is_active, Books.is_loaned, func.count()).group_by(Books.is_active, Books.is_loaned)):
+        count_books(values, is_active, is_loaned, count)
+    for is_active, city, category, count in connection.execute(
+            select(Loans.is_active, Customers.city, Books.category, func.count())
+            .select_from(Loans)
+            .outerjoin(Customers, Loans.customer_id == Customers.id)
+            .outerjoin(Books, Loans.book_id == Books.id)
+            .group_by(Loans.is_active, Customers.city, Books.category)):
+        count_loans(values, city, category, count if is_active else 0, count)
+    return values
+
+def rebuild_stats():
+    """Replace each shard's counters with values recounted in one transaction.
+
+    Returns {(name, key): (old, new)} for those that drifted, summed over the shards.
+    """
+    drift = {}
+    for shard in shard_router.names:
+        shard_drift = transaction_retry.run(shard_engine(shard), lambda connection: stat_counters.replace(connection, count_stats(connection)))
+        for counter, (old, new) in shard_drift.items():
+            total_old, total_new = drift.get(counter, (0, 0))
+            drift[counter] = (total_old + old, total_new + new)
+    return drift
+
+def install_stat_counters(connection):
+    migrations.create_tables(db.metadata, StatCounter.__table__)(connection)
+    stat_counters.replace(connection, count_stats(connection))
+
 def toggle_status(model_class, identifier_field, identifier_value):
     """Toggle the active status of a specific record."""
-    record = model_class.query.filter(getattr(model_class, identifier_field) == identifier_value).first()
-    if record is None:
+    row = route_to_entity(model_class, identifier_field, identifier_value)
+
+    def toggle(connection):
+        # Flipped in the statement, so concurrent toggles each count the change they made
+        is_active = connection.scalar(
+            update(model_class).where(model_class.id == row['id']).values(is_active=~model_class.is_active).returning(model_class.is_active)
+        ) if row else None
+        if is_active is None:
+            raise Rollback('not_found')
+        if model_class is Books:
+            stat_counters.add(connection, {('books', 'active'): 1 if is_active else -1})
+        record_changes(connection, model_class.__tablename__, 'updated', [row['id']])
+        return is_active
+
+    is_active = run_transaction(toggle, f"status of {model_class.__name__} {identifier_value} not changed")
+    if is_active == 'not_found':
         log_message('WARNING', f"{model_class.__name__} not found: {identifier_value}")
         abort(404, description=f"{model_class.__name__} not found.")
+    invalidate_responses(model_class.__tablename__)
 
-    record.is_active = not record.is_active  # Toggle active status
-    db.session.commit()
-
-    log_message('INFO', f"Toggled status for {model_class.__name__}: {identifier_value} (Active: {record.is_active})")
-    return jsonify({'message': f"{model_class.__name__} '{identifier_value}' status updated to {'active' if record.is_active else 'inactive'}."}), 200
+    log_message('INFO', f"Toggled status for {model_class.__name__}: {identifier_value} (Active: {is_active})")
+    return jsonify({'message': f"{model_class.__name__} '{identifier_value}' status updated to {'active' if is_active else 'inactive'}."}), 200
 
 def search_records(model_class, identifier_field, identifier_value):
-    """Search for records in the database using case-insensitive matching."""
+    """Search for records by word prefixes, ranked, using the full-text index when there is one."""
     if not identifier_value:
         log_message('WARNING', "Identifier value is empty.")
         abort(400, description="Identifier value cannot be empty.")
 
-    records = model_class.query.filter(getattr(model_class, identifier_field).ilike(f'%{identifier_value}%')).all()
+    body = request.json or {}
+    limit = body['limit'] if 'limit' in body else app.config['SEARCH_DEFAULT_LIMIT']
+    if not isinstance(limit, int) or isinstance(limit, bool) or limit < 1:
+        abort(400, description="limit must be a positive integer.")
+    limit = min(limit, app.config['SEARCH_MAX_LIMIT'])
+
+    search_index = SEARCH_INDEXES.get(model_class)
+
+    def search_shard():
+        """(sort key, record) for this shard's best matches, best first."""
+        connection = db.session.connection()
+        if search_index is not None and search_index.is_installed(connection):
+            ranked = search_index.search(connection, identifier_field, identifier_value, limit, ranked=True)
+            by_id = {record.id: record for record in model_class.query.filter(model_class.id.in_([record_id for record_id, _ in ranked]))} if ranked else {}
+            return [((rank, record_id), by_id[record_id]) for record_id, rank in ranked if record_id in by_id]  # Keep the ranking order
+        # No full-text support on this backend: fall back to case-insensitive substring matching
+        records = (model_class.query
+                   .filter(getattr(model_class, identifier_field).ilike(f'%{identifier_value}%'))
+                   .order_by(model_class.id)
+                   .limit(limit)
+                   .all())
+        return [((0, record.id), record) for record in records]
+
+    # The shards' best matches merge into one ranking; bm25 ranks compare across shards, each weighing words by its own rows
+    records = [record for _, record in merge_sorted(scatter(search_shard), key=lambda match: match[0], limit=limit)]
 
     if not records:
         log_message('WARNING', f"{model_class.__name__} not found: {identifier_value}")
@@ -234,38 +761,729 @@ def validate_fields(data, required_fields, enum_fields=None):
         log_message('ERROR', f"Invalid email format: {data['email']}")
         abort(400, description="Invalid email format.")
 
-def get_status(model_class, status, eager_load=None):
-    """Retrieve records based on specified status: active, inactive, late, or all."""
+def status_filter(model_class, status):
+    """Filter criteria for a status: active, inactive, late (open loans past their return date), or all."""
+    if status == 'late':
+        return [model_class.is_active.is_(True), model_class.return_date < datetime.now(timezone.utc)]
+    if status == 'all':
+        return []
+    return [model_class.is_active == (status == 'active')]
+
+def status_query(model_class, status):
+    """Build the query for records with the specified status: active, inactive, late, or all."""
     if status not in ['active', 'inactive', 'all', 'late']:
         log_message('WARNING', f"Invalid status parameter provided for {model_class.__name__.lower()}s.")
         abort(400, description="Invalid status parameter. Use 'active', 'inactive', 'all', or 'late'.")
 
-    query = model_class.query
+    criteria = late_loan_criteria() if status == 'late' and model_class is Loans else status_filter(model_class, status)
+    query = model_class.query.filter(*criteria)
 
-    if eager_load:
-        query = query.options(*eager_load)
+    log_message('INFO', f"Retrieved all {'' if status == 'all' else status + ' '}{model_class.__name__.lower()}s.")
+    return query
 
-    if status == 'late':
-        current_time = datetime.now(timezone.utc)
-        records = query.filter(model_class.return_date < current_time).all()
-        log_message('INFO', f"Retrieved all late {model_class.__name__.lower()}s.")
-    elif status == 'all':
-        records = query.all()
-        log_message('INFO', f"Retrieved all {model_class.__name__.lower()}s.")
+def load_open_loans(shard, after_id):
+    """(id, return_date) of the open loans on a shard with an id above after_id."""
+    with shard_engine(shard).connect() as connection:
+        return connection.execute(
+            select(Loans.id, Loans.return_date)
+            .where(Loans.is_active.is_(True), Loans.id > after_id)
+            .order_by(Loans.id)
+        ).all()
+
+def log_overdue_loans(newly_late):
+    """Record loans that just became overdue, in one log entry per batch."""
+    loan_ids = [loan_id for loan_id, _ in newly_late]
+    shown = ', '.join(str(loan_id) for loan_id in loan_ids[:20])
+    log_message('WARNING', f"{len(loan_ids)} loan(s) became overdue: {shown}{' ...' if len(loan_ids) > 20 else ''}")
+
+def make_overdue_tracker(shard):
+    tracker = OverdueTracker(partial(load_open_loans, shard), rebuild_interval=app.config['OVERDUE_REBUILD_INTERVAL'])
+    tracker.subscribe(log_overdue_loans)
+    return tracker
+
+overdue_trackers = {shard: make_overdue_tracker(shard) for shard in shard_router.names}  # One per shard, as loan ids are per shard
+
+def scan_overdue_loans():
+    with app.app_context():
+        for tracker in overdue_trackers.values():
+            tracker.refresh()
+
+overdue_scan_task = PeriodicTask('overdue-scan', app.config['OVERDUE_SCAN_INTERVAL'], scan_overdue_loans)
+
+def late_loan_ids():
+    """Ids of late loans from the tracker, after picking up loans created since the last look."""
+    overdue_scan_task.start()
+    tracker = overdue_trackers[current_shard()]
+    tracker.refresh()
+    return tracker.late_ids()
+
+def late_loan_criteria():
+    """Filter criteria for late loans: the tracker's ids when there are few enough, the due-date index otherwise."""
+    if app.config['OVERDUE_TRACKER_ENABLED']:
+        late_ids = late_loan_ids()
+        if len(late_ids) <= app.config['OVERDUE_MAX_IN_IDS']:
+            # Loans returned by another worker may still be tracked, hence the is_active check
+            return [Loans.id.in_(late_ids), Loans.is_active.is_(True)]
+    return status_filter(Loans, 'late')
+
+response_cache = ResponseCache(
+    max_entries=app.config['RESPONSE_CACHE_SIZE'],
+    ttl=app.config['RESPONSE_CACHE_TTL'],
+    shared_path=app.config['RESPONSE_CACHE_SHARED_PATH'] or None
+)
+
+def cached_response(*namespaces):
+    """Cache a list view's response, keyed on path and query string, until one of the namespaces changes."""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            # Streams are not buffered, and late loans depend on the clock
+            if not app.config['RESPONSE_CACHE_ENABLED'] or 'stream' in request.args or request.args.get('status') == 'late':
+                return view(*args, **kwargs)
+
+            key = request.path + '?' + '&'.join(f'{name}={value}' for name, value in sorted(request.args.items(multi=True)))
+            etag = response_cache.etag(key, response_cache.generations(namespaces))
+
+            if request.if_none_match.contains(etag):
+                response_cache.not_modified += 1
+                response = Response(status=304, headers={'Cache-Control': 'no-cache'})
+                response.set_etag(etag)
+                return response
+
+            entry = response_cache.get(key, etag)
+            if entry is not None:
+                response = Response(entry.body, status=entry.status, mimetype=entry.mimetype)
+            else:
+                # Build cached responses from the primary: a lagging replica would pin stale data to a fresh ETag
+                use_read_replica(False)
+                entity_cache.mark_stale()  # Likewise rows cached before another worker's write
+                response = make_response(view(*args, **kwargs))
+                if response.status_code == 200 and not response.is_streamed:
+                    response_cache.put(key, etag, response.get_data(), response.status_code, response.mimetype)
+
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = 'no-cache'  # Clients revalidate with If-None-Match
+            return response
+        return wrapper
+    return decorator
+
+def read_replica(view):
+    """Serve the view's reads from the read replica, when one is configured."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        use_read_replica(True)
+        return view(*args, **kwargs)
+    return wrapper
+
+@app.before_request
+def reset_read_replica():
+    use_read_replica(False)  # The flag outlives the view so streamed responses keep reading the replica
+
+# Shard routing: views route to the shard of the branch or record they touch, or gather from every shard
+def shard_engine(shard=None):
+    """Engine of a shard, by default the one this request is routed to."""
+    return db.engines[shard_bind(shard or current_shard())]
+
+def request_branch():
+    """The branch named by ?branch=, which limits a request to that branch's shard."""
+    branch = request.args.get('branch')
+    if branch and branch not in City.__members__:
+        log_message('WARNING', f"Invalid branch parameter: {branch}")
+        abort(400, description=f"Invalid branch. Must be one of: {', '.join(City.__members__)}.")
+    return branch or None
+
+def shard_busy_response():
+    response = jsonify({'error': "A branch is being moved to another database, please try again."})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(int(app.config['SHARD_DIRECTORY_TTL']) + 1)
+    return response
+
+def route_to_shard(shard):
+    """Send this request's statements on sharded tables to `shard`; writes get 503 while a branch moves off it."""
+    writing = not has_request_context() or request.method not in ('GET', 'HEAD')
+    if writing and shard_router.is_read_only(shard):
+        log_message('WARNING', f"Write refused while a branch moves off shard {shard}")
+        abort(shard_busy_response())
+    use_shard(shard)
+    return shard
+
+def route_to_branch(branch):
+    return route_to_shard(shard_router.shard_for(branch))
+
+def route_to_record(model_class, *criteria, record_id=None):
+    """Route to the shard holding the row matching criteria, trying the home shard of record_id first.
+
+    A row stays on the shard whose range its id came from unless its branch was moved, so the
+    first look usually finds it. Without a match the request goes to the default shard, where
+    the view answers 404. Nothing is looked up when unsharded or when ?branch= chose the shard.
+    """
+    if not shard_router.sharded or request_branch():
+        return current_shard()
+    home = shard_router.home_shard(record_id) if isinstance(record_id, int) else None
+    for shard in sorted(shard_router.names, key=lambda name: name != home):
+        use_shard(shard)
+        if db.session.scalar(select(exists().where(*criteria))):
+            return route_to_shard(shard)
+    return route_to_shard(DEFAULT_SHARD)
+
+def request_shards():
+    """Shards a cross-branch read gathers from: the ?branch= shard, or all of them."""
+    if has_request_context() and request_branch():
+        return [current_shard()]
+    return shard_router.names
+
+def on_shard(shard, func):
+    """func() with the request routed to a shard; the routing stays for what follows."""
+    use_shard(shard)
+    return func()
+
+def scatter(func, shards=None):
+    """[func()] run once on each shard, by default those of request_shards(), routed to it in turn."""
+    return [on_shard(shard, func) for shard in shards or request_shards()]
+
+def rows_by_shard(statement, shards=None):
+    """(shard, row) for every row the statement finds on the shards."""
+    shards = shards or request_shards()
+    return [(shard, row) for shard, rows in zip(shards, scatter(lambda: db.session.execute(statement).all(), shards)) for row in rows]
+
+@app.before_request
+def route_request_to_branch():
+    branch = request_branch()
+    if branch:
+        route_to_branch(branch)
+
+@app.teardown_request
+def reset_shard(error=None):
+    use_shard(None)  # Runs once a streamed response is done; g outlives the request when the app context is shared, as in tests
+
+def invalidate_responses(*namespaces):
+    """Drop cached list responses built from these tables, and wake requests waiting on the change feed."""
+    response_cache.invalidate(*namespaces)
+    change_notifier.notify()
+    if 'books' in namespaces:
+        for index in availability_indexes.values():
+            index.mark_stale()  # Show this process's writes on its next lookup
+    if 'books' in namespaces or 'customers' in namespaces:
+        entity_cache.mark_stale()  # Drops again rows re-read before the commit; see record_changes()
+
+def encode_cursor(last_id):
+    """Encode the last returned id as an opaque pagination token."""
+    return base64.urlsafe_b64encode(json.dumps({'id': last_id}).encode()).decode().rstrip('=')
+
+def decode_cursor(token):
+    """Decode a pagination token produced by encode_cursor."""
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        return int(json.loads(base64.urlsafe_b64decode(padded))['id'])
+    except (ValueError, KeyError, TypeError):
+        log_message('WARNING', f"Invalid pagination cursor: {token}")
+        abort(400, description="Invalid pagination cursor.")
+
+# Listings select plain column tuples instead of ORM entities and turn them into dicts with these
+BOOK_ROW = ModelSerializer(Books)
+CUSTOMER_ROW = ModelSerializer(Customers)
+LOAN_ROW = ModelSerializer(Loans)
+LOAN_DETAILS_ROW = NestedSerializer(LOAN_ROW, book=BOOK_ROW, customer=CUSTOMER_ROW)
+LOAN_DETAILS_JOINS = [(Books, Loans.book_id == Books.id), (Customers, Loans.customer_id == Customers.id)]
+
+def row_query(model_class, status, serializer, joins=()):
+    """status_query() selecting only the serializer's columns, outer joining the related tables it embeds."""
+    query = status_query(model_class, status).with_entities(*serializer.columns)
+    for target, condition in joins:
+        query = query.outerjoin(target, condition)
+    return query
+
+def shard_queries(build):
+    """[(shard, build())] with the query built while routed to each shard the request covers."""
+    shards = request_shards()
+    return list(zip(shards, scatter(build, shards)))
+
+def merged_rows(model_class, queries):
+    """Rows of per-shard queries merged in id order, each query running on its shard once the merge first reads it."""
+    def rows(shard, query):
+        use_shard(shard)
+        yield from query.order_by(model_class.id).yield_per(app.config['STREAM_BATCH_SIZE'])
+    return merge_sorted([rows(shard, query) for shard, query in queries], key=lambda row: row[0])
+
+def stream_records(model_class, queries, serialize, fmt):
+    """Stream records as a JSON array, NDJSON or CSV without loading the whole result set.
+
+    queries are (shard, query) pairs, whose rows are merged in id order as they stream.
+    """
+    rows = merged_rows(model_class, queries)
+
+    if fmt == 'csv':
+        fieldnames = [column.name for column in model_class.__table__.columns]
+        return Response(stream_with_context(csv_lines((serialize(record) for record in rows), fieldnames)), mimetype='text/csv')
+
+    def generate_ndjson():
+        for record in rows:
+            yield app.json.dumps(serialize(record)) + '\n'
+
+    def generate_json():
+        yield '['
+        first = True
+        for record in rows:
+            yield ('' if first else ',') + app.json.dumps(serialize(record))
+            first = False
+        yield ']'
+
+    if fmt == 'ndjson':
+        return Response(stream_with_context(generate_ndjson()), mimetype='application/x-ndjson')
+    return Response(stream_with_context(generate_json()), mimetype='application/json')
+
+def list_records(model_class, serialize, joins=()):
+    """Respond with the records matching ?status=, paginated with ?limit=/&after= or streamed with ?stream=.
+
+    serialize is a row serializer: its columns are selected, and it turns each row into a dict.
+    """
+    status = request.args.get('status', default='active', type=str)
+    # Built on each shard, as late loans come from that shard's tracker
+    queries = shard_queries(lambda: row_query(model_class, status, serialize, joins))
+
+    stream = request.args.get('stream')
+    if stream:
+        if stream not in ['json', 'ndjson']:
+            log_message('WARNING', f"Invalid stream format: {stream}")
+            abort(400, description="Invalid stream parameter. Use 'json' or 'ndjson'.")
+        return stream_records(model_class, queries, serialize, stream)
+
+    limit = request.args.get('limit')
+    after = request.args.get('after')
+    if limit is None and after is None:
+        return jsonify([serialize(record) for record in merged_rows(model_class, queries)]), 200
+
+    if limit is None:
+        limit = app.config['DEFAULT_PAGE_SIZE']
+    else:
+        try:
+            limit = int(limit)
+        except ValueError:
+            limit = 0  # Rejected below, rather than falling back to the whole table
+    if limit < 1:
+        abort(400, description="limit must be a positive integer.")
+    limit = min(limit, app.config['MAX_PAGE_SIZE'])
+
+    if after:
+        after_id = decode_cursor(after)
+        queries = [(shard, query.filter(model_class.id > after_id)) for shard, query in queries]
+
+    # Fetch one extra row to know whether another page exists; each shard's first rows are enough for the merge
+    pages = [on_shard(shard, query.order_by(model_class.id).limit(limit + 1).all) for shard, query in queries]
+    records = list(merge_sorted(pages, key=lambda row: row[0], limit=limit + 1))
+    next_cursor = encode_cursor(records[limit - 1][0]) if len(records) > limit else None
+
+    return jsonify({'items': [serialize(record) for record in records[:limit]], 'next_cursor': next_cursor}), 200
+
+# Change feed
+CHANGE_ROWS = {'books': (Books, BOOK_ROW), 'customers': (Customers, CUSTOMER_ROW), 'loans': (Loans, LOAN_ROW)}
+
+change_notifier = ChangeNotifier(
+    poll_interval=app.config['CHANGES_POLL_INTERVAL'],
+    max_waiters=app.config['CHANGES_MAX_WAITERS']
+)
+
+def record_changes(connection, entity, action, ids):
+    """Append changes to the change log in the caller's transaction, with each row's state as of now.
+
+    ORM callers flush first so the rows are visible on the connection. Waiters are woken by
+    invalidate_responses() once the transaction has committed.
+    """
+    ids = list(dict.fromkeys(ids))
+    if not ids:
+        return
+    if entity in ENTITY_FIELDS:
+        entity_cache.invalidate(entity, ids)
+    model_class, serializer = CHANGE_ROWS[entity]
+    if action == 'deleted':
+        data = {}
     else:
-        is_active = status == 'active'
-        records = query.filter_by(is_active=is_active).all()
-        log_message('INFO', f"Retrieved all {'active' if is_active else 'inactive'} {model_class.__name__.lower()}s.")
+        rows = connection.execute(select(*serializer.columns).where(model_class.id.in_(ids))).all()
+        data = {row[0]: serializer(row) for row in rows}
+    timestamp = datetime.utcnow()
+    entries = [{'timestamp': timestamp, 'entity': entity, 'entity_id': entity_id, 'action': action, 'data': data.get(entity_id)}
+               for entity_id in ids]
+    seqs = reserve_change_seqs(connection, len(entries))
+    if seqs is not None:
+        for entry, seq in zip(entries, seqs):
+            entry['seq'] = seq
+    connection.execute(insert(ChangeLog), entries)
+    start_change_compaction()
+
+def reserve_change_seqs(connection, count):
+    """Seqs for `count` change-log entries on a server database, or None on SQLite.
+
+    Readers follow the feed by seq, so an entry must never become visible after a higher one. SQLite
+    has a single writer, and its autoincrement seqs commit in order. Elsewhere the seqs come from the
+    shard's 'change_log' sequence row, whose lock is held until the transaction ends, so writers
+    logging changes commit one after the other.
+    """
+    if connection.dialect.name == 'sqlite':
+        return None
+    last_seq = connection.execute(
+        update(ShardIdSequence).where(ShardIdSequence.name == ChangeLog.__tablename__)
+        .values(last_id=ShardIdSequence.last_id + count).returning(ShardIdSequence.last_id)
+    ).scalar()
+    if last_seq is None:
+        raise RuntimeError("No change-log sequence on this shard; run 'flask db upgrade'.")
+    return range(last_seq - count + 1, last_seq + 1)
+
+def record_session_changes(action, *records):
+    """record_changes() for model instances changed through db.session, flushed first so new ones have ids."""
+    db.session.flush()
+    for record in records:
+        record_changes(db.session.connection(), record.__tablename__, action, [record.id])
+
+def change_log_bounds():
+    """(oldest, latest) seq still in the shard's change log, or (None, None) when it is empty."""
+    with shard_engine().connect() as connection:
+        return tuple(connection.execute(select(func.min(ChangeLog.seq), func.max(ChangeLog.seq))).one())
+
+def fetch_changes(since, limit, entities=None):
+    """Up to `limit` changes after seq `since` on the request's shard, oldest first."""
+    # A connection per look, so waiting requests never hold a read snapshot open between looks
+    with shard_engine().connect() as connection:
+        query = select(ChangeLog).where(ChangeLog.seq > since)
+        if entities:
+            query = query.where(ChangeLog.entity.in_(entities))
+        rows = connection.execute(query.order_by(ChangeLog.seq).limit(limit)).all()
+    return [{'seq': row.seq, 'timestamp': row.timestamp.isoformat(), 'entity': row.entity,
+             'id': row.entity_id, 'action': row.action, 'data': row.data} for row in rows]
+
+def compact_changes(now=None):
+    """Delete entries every registered consumer has read, and entries past CHANGE_LOG_RETENTION_DAYS, on every shard.
+
+    Returns the count.
+    """
+    now = now or datetime.utcnow()
+    cutoff = now - timedelta(days=app.config['CHANGE_LOG_RETENTION_DAYS'])
+
+    def compact(connection):
+        connection.execute(delete(ChangeConsumer).where(ChangeConsumer.seen_at < cutoff))
+        latest = connection.scalar(select(func.max(ChangeLog.seq)))
+        if latest is None:
+            return 0
+        consumed = connection.scalar(select(func.min(ChangeConsumer.seq)))
+        expired = ChangeLog.timestamp < cutoff
+        # The newest entry always stays, so the oldest seq left shows how far back the log reaches
+        return connection.execute(delete(ChangeLog).where(
+            or_(expired, ChangeLog.seq <= consumed) if consumed is not None else expired,
+            ChangeLog.seq < latest
+        )).rowcount
 
-    return records
+    with app.app_context():
+        return sum(transaction_retry.run(shard_engine(shard), compact) for shard in shard_router.names)
+
+change_compaction_task = PeriodicTask('change-compaction', app.config['CHANGE_COMPACTION_INTERVAL'], compact_changes)
+
+def start_change_compaction():
+    if app.config['CHANGE_COMPACTION_INTERVAL'] > 0:
+        change_compaction_task.start()
+
+def register_consumer(name, seq):
+    """Record that consumer `name` has everything up to seq."""
+    def save(connection):
+        updated = connection.execute(
+            update(ChangeConsumer).where(ChangeConsumer.name == name).values(seq=seq, seen_at=datetime.utcnow())
+        ).rowcount
+        if not updated:
+            connection.execute(insert(ChangeConsumer).values(name=name, seq=seq, seen_at=datetime.utcnow()))
+    run_transaction(save, f"cursor of change consumer '{name}' not saved")
+
+metrics.add_gauge('library_change_feed', "Change feed waiters, wake-ups and refused waits.", change_notifier.stats)
+
+# Availability index, one per shard
+def load_available_books(shard):
+    """(latest change seq, [(id, category, loan type)]) for every book on a shard that can be borrowed, in id order."""
+    with shard_engine(shard).connect() as connection:
+        seq = connection.scalar(select(func.max(ChangeLog.seq))) or 0  # Read first: later changes are replayed over the rows
+        rows = connection.execute(
+            select(Books.id, Books.category, Books.loan_time_type)
+            .where(Books.is_active.is_(True), Books.is_loaned.is_(False))
+            .order_by(Books.id)
+        ).all()
+    return seq, [(book_id, category.name, loan_type.name) for book_id, category, loan_type in rows]
+
+def load_book_changes(shard, after_seq):
+    """(oldest, latest, [(seq, id, state)]) for the book changes a shard logged after after_seq; see AvailabilityIndex."""
+    with shard_engine(shard).connect() as connection:
+        oldest, latest = connection.execute(select(func.min(ChangeLog.seq), func.max(ChangeLog.seq))).one()
+        rows = connection.execute(
+            select(ChangeLog.seq, ChangeLog.entity_id, ChangeLog.data)
+            .where(ChangeLog.seq > after_seq, ChangeLog.seq <= (latest or 0), ChangeLog.entity == 'books')
+            .order_by(ChangeLog.seq)
+        ).all()
+    return oldest, latest, [
+        (seq, book_id, (data['category'], data['loan_time_type']) if data and data['is_active'] and not data['is_loaned'] else None)
+        for seq, book_id, data in rows
+    ]
+
+availability_indexes = {shard: AvailabilityIndex(
+    BookCategory.__members__, LoanType.__members__, partial(load_available_books, shard), partial(load_book_changes, shard),
+    max_staleness=app.config['AVAILABILITY_MAX_STALENESS'],
+    rebuild_interval=app.config['AVAILABILITY_REBUILD_INTERVAL']
+) for shard in shard_router.names}
+
+def warm_availability_index():
+    """Build the indexes in the background, so a new worker's first lookup does not wait for them."""
+    def build():
+        with app.app_context():
+            for index in availability_indexes.values():
+                index.refresh()
+    if app.config['AVAILABILITY_INDEX_ENABLED']:
+        threading.Thread(target=build, name='availability-warmup', daemon=True).start()
+
+metrics.add_gauge('library_availability_index', "Books held by the availability index, rebuilds and changes applied.",
+                  lambda: shard_stats({shard: index.stats() for shard, index in availability_indexes.items()}))
+
+# Entity cache: rows of books and customers for lookups by id, name or email; never consulted to decide a checkout
+ENTITY_FIELDS = {'books': ('name',), 'customers': ('email',)}  # Unique fields records are also looked up by
+
+def load_entity_changes(shard, after_seq):
+    """(oldest, latest, [(kind, id)]) for the book and customer changes a shard logged after after_seq; see EntityCache."""
+    with shard_engine(shard).connect() as connection:
+        oldest, latest = connection.execute(select(func.min(ChangeLog.seq), func.max(ChangeLog.seq))).one()
+        if after_seq is None:
+            return oldest, latest, []
+        rows = connection.execute(
+            select(ChangeLog.entity, ChangeLog.entity_id)
+            .where(ChangeLog.seq > after_seq, ChangeLog.seq <= (latest or 0), ChangeLog.entity.in_(ENTITY_FIELDS))
+        ).all()
+    return oldest, latest, [tuple(row) for row in rows]
+
+entity_cache = EntityCache(
+    load_entity_changes, shard_router.names,
+    max_entries=app.config['ENTITY_CACHE_SIZE'],
+    max_staleness=app.config['ENTITY_CACHE_MAX_STALENESS']
+)
+
+def find_entities(model_class, field, values, shards=None):
+    """{value: (shard, row)} for the books or customers whose `field` (id, name or email) has one of the values.
+
+    Read through the entity cache; the values it misses are looked up with one query per shard,
+    trying the shards in order (by default those of request_shards()) until all are found.
+    Rows read from the replica are not cached.
+    """
+    kind, serializer = model_class.__tablename__, CHANGE_ROWS[model_class.__tablename__][1]
+    shards = shards or request_shards()
+    found = {}
+    enabled = app.config['ENTITY_CACHE_ENABLED']
+    if enabled:
+        entity_cache.refresh()
+        version = entity_cache.version(kind)
+        for value in values:
+            entity = entity_cache.get(kind, value) if field == 'id' else entity_cache.get_by(kind, field, value)
+            if entity is not None and entity[0] in shards:
+                found[value] = entity
+
+    missing = [value for value in dict.fromkeys(values) if value not in found]
+    for shard in shards:
+        if not missing:
+            break
+        rows = on_shard(shard, lambda: db.session.execute(
+            select(*serializer.columns).where(getattr(model_class, field).in_(missing))).all())
+        for row in rows:
+            data = serializer(row)
+            found[data[field]] = (shard, data)
+            if enabled and not reading_replica():
+                entity_cache.put(kind, shard, data, version, ENTITY_FIELDS[kind])
+        missing = [value for value in missing if value not in found]
+    return found
+
+def route_to_entity(model_class, field, value):
+    """Route to the shard of the book or customer whose `field` equals value, and return its row.
+
+    Without a match the request goes to the shard of its ?branch=, else the default one, and
+    None is returned. Unsharded, the lookup only saves a query when the row is cached.
+    """
+    home = shard_router.home_shard(value) if field == 'id' and isinstance(value, int) else None
+    shards = sorted(request_shards(), key=lambda name: name != home)
+    entity = find_entities(model_class, field, [value], shards).get(value)
+    if entity is None:
+        route_to_branch(request_branch())
+        return None
+    route_to_shard(entity[0])
+    return entity[1]
+
+metrics.add_gauge('library_entity_cache', "Books and customers held by the entity cache, hits and invalidations.", entity_cache.stats)
+
+def write_log_batch(records):
+    """Bulk insert a batch of queued log records in a single transaction."""
+    with app.app_context():
+        with db.engine.begin() as connection:
+            connection.execute(Log.__table__.insert(), records)
+    start_log_retention()
+
+log_buffer = LogBuffer(
+    write_log_batch,
+    max_size=app.config['LOG_BUFFER_SIZE'],
+    batch_size=app.config['LOG_FLUSH_BATCH_SIZE'],
+    flush_interval=app.config['LOG_FLUSH_INTERVAL'],
+    policy=app.config['LOG_QUEUE_POLICY'],
+    flush_attempts=app.config['LOG_FLUSH_ATTEMPTS']
+)
+
+metrics.add_gauge('library_log_buffer', "Log buffer queue depth and flush counters.",
+                  lambda: {name: value for name, value in log_buffer.stats().items() if name != 'policy'})
+metrics.add_gauge('library_overdue_tracker', "Open and late loans held by the overdue tracker.",
+                  lambda: shard_stats({shard: tracker.stats() for shard, tracker in overdue_trackers.items()}))
+metrics.add_gauge('library_response_cache', "Response cache size and hit counters.", response_cache.stats)
+metrics.add_gauge('library_token_blocklist', "Token blocklist cache size and hit counters.", blocklist_cache.stats)
+
+transaction_retry = TransactionRetry(
+    attempts=app.config['TRANSACTION_RETRY_ATTEMPTS'],
+    backoff=app.config['TRANSACTION_RETRY_BACKOFF'],
+    max_backoff=app.config['TRANSACTION_RETRY_MAX_BACKOFF']
+)
+metrics.add_gauge('library_transactions', "Write transactions, lock retries and transactions that stayed locked.", transaction_retry.stats)
 
 def log_message(level, message):
-    """Log a message to the Log model."""
+    """Log a message to the Log model, through the write-behind buffer when enabled."""
+    metrics.count_log_message()
+    if app.config['LOG_BUFFER_ENABLED']:
+        log_buffer.put({'timestamp': datetime.utcnow(), 'level': level, 'message': message})
+        return
+
     new_log = Log(level=level, message=message)
     db.session.add(new_log)
     db.session.commit()
+    start_log_retention()
+
+@app.route('/log/stats', methods=['GET'])
+def get_log_stats():
+    """Return queue-depth and flush-latency counters for the log buffer."""
+    return jsonify(log_buffer.stats()), 200
+
+# Log retention
+log_archive = LogArchive(app.config['LOG_ARCHIVE_DIR'])
+
+def hour_bucket(column):
+    """SQL expression truncating a timestamp to its hour."""
+    if db.engine.dialect.name == 'sqlite':
+        return func.strftime('%Y-%m-%d %H:00:00', column)
+    return func.date_trunc('hour', column)
+
+def rollup_logs(now=None):
+    """Count the records of each level for every completed hour not rolled up yet. Returns the rollup rows added."""
+    now = now or datetime.utcnow()
+    until = (now - timedelta(seconds=app.config['LOG_ROLLUP_DELAY'])).replace(minute=0, second=0, microsecond=0)
+    last_hour = db.session.scalar(select(func.max(LogRollup.hour)))
+    since = last_hour + timedelta(hours=1) if last_hour else db.session.scalar(select(func.min(Log.timestamp)))
+    if since is None or since >= until:
+        return 0
+
+    hour = hour_bucket(Log.timestamp).label('hour')
+    counts = db.session.execute(
+        select(hour, Log.level, func.count())
+        .where(Log.timestamp >= since, Log.timestamp < until)
+        .group_by(hour, Log.level)
+    ).all()
+    rows = [{'hour': bucket if isinstance(bucket, datetime) else datetime.fromisoformat(bucket), 'level': level, 'count': count}
+            for bucket, level, count in counts]
+    if rows:
+        db.session.execute(insert(LogRollup), rows)
+    db.session.commit()
+    return len(rows)
+
+def rotate_logs(now=None):
+    """Archive and delete records older than LOG_RETENTION_DAYS, one bounded chunk per transaction. Returns the count."""
+    now = now or datetime.utcnow()
+    # Records of hours not rolled up yet stay, so the rollups never miss them
+    rolled_up = (now - timedelta(seconds=app.config['LOG_ROLLUP_DELAY'])).replace(minute=0, second=0, microsecond=0)
+    cutoff = min(now - timedelta(days=app.config['LOG_RETENTION_DAYS']), rolled_up)
+    chunk_size = app.config['LOG_RETENTION_CHUNK_SIZE']
+
+    archived = 0
+    while True:
+        rows = db.session.execute(
+            select(Log.id, Log.timestamp, Log.level, Log.message)
+            .where(Log.timestamp < cutoff)
+            .order_by(Log.timestamp)
+            .limit(chunk_size)
+        ).all()
+        db.session.commit()
+        if not rows:
+            break
+
+        log_archive.append([row._asdict() for row in rows])  # Synced to disk before the rows go
+        ids = [row.id for row in rows]
+        transaction_retry.run(db.engine, lambda connection: connection.execute(delete(Log).where(Log.id.in_(ids))))
+        archived += len(rows)
+        if len(rows) < chunk_size:
+            break
+    return archived
+
+def run_log_retention(now=None):
+    """Roll up, then archive old records. Returns (rollup rows, records archived), or None if another process is on it."""
+    with app.app_context():
+        with log_archive.exclusive() as acquired:
+            if not acquired:
+                return None
+            return rollup_logs(now), rotate_logs(now)
+
+log_retention_task = PeriodicTask('log-retention', app.config['LOG_RETENTION_INTERVAL'], run_log_retention)
+
+def start_log_retention():
+    if app.config['LOG_RETENTION_INTERVAL'] > 0:
+        log_retention_task.start()
+
+metrics.add_gauge('library_log_archive', "Log archive files and their size in bytes.", log_archive.stats)
+
+def time_range_args():
+    """The ?since= and ?until= query arguments as datetimes (ISO 8601), or None."""
+    bounds = []
+    for name in ('since', 'until'):
+        value = request.args.get(name)
+        try:
+            bounds.append(parse_datetime(value) if value else None)
+        except ValueError:
+            log_message('WARNING', f"Invalid {name} parameter: {value}")
+            abort(400, description=f"Invalid {name} parameter. Use an ISO 8601 date or time.")
+    return bounds
+
+@app.route('/log/rollup', methods=['GET'])
+@jwt_required()
+def get_log_rollup():
+    """Hourly record counts per level, optionally limited with ?since=, ?until= and ?level=."""
+    since, until = time_range_args()
+    query = LogRollup.query
+    if since:
+        query = query.filter(LogRollup.hour >= since)
+    if until:
+        query = query.filter(LogRollup.hour < until)
+    if request.args.get('level'):
+        query = query.filter(LogRollup.level == request.args['level'])
+    return jsonify([rollup.to_dict() for rollup in query.order_by(LogRollup.hour, LogRollup.level)]), 200
+
+@app.route('/log/archive', methods=['GET'])
+@jwt_required()
+def search_log_archive():
+    """Archived records between ?since= and ?until=, filtered by ?level= and a ?contains= substring."""
+    since, until = time_range_args()
+    limit = min(request.args.get('limit', default=app.config['LOG_ARCHIVE_MAX_RESULTS'], type=int),
+                app.config['LOG_ARCHIVE_MAX_RESULTS'])
+    records, truncated = log_archive.query(since, until, request.args.get('level'), request.args.get('contains'), limit)
+    return jsonify({'records': records, 'truncated': truncated}), 200
 
 # Routes for Auth
+password_hasher = PasswordHasher(
+    method=app.config['PASSWORD_HASH_METHOD'],
+    workers=app.config['PASSWORD_HASH_WORKERS'],
+    max_queue=app.config['PASSWORD_HASH_QUEUE'],
+    queue_timeout=app.config['PASSWORD_HASH_QUEUE_TIMEOUT']
+)
+username_limiter = TokenBucketLimiter(app.config['LOGIN_RATE_USERNAME_BURST'], app.config['LOGIN_RATE_USERNAME_PER_MINUTE'])
+address_limiter = TokenBucketLimiter(app.config['LOGIN_RATE_IP_BURST'], app.config['LOGIN_RATE_IP_PER_MINUTE'])
+
+metrics.add_gauge('library_password_hashing', "Password hashes queued, done and refused.", password_hasher.stats)
+metrics.add_gauge('library_login_limiter', "Login rate limiter keys and decisions per username.", username_limiter.stats)
+
+def hash_busy_response():
+    log_message('WARNING', "Password hashing pool is saturated")
+    response = jsonify({"msg": "Too many logins in progress, please try again."})
+    response.headers['Retry-After'] = '1'
+    return response, 503
+
 @app.route('/register', methods=['POST'])
 def register():
     data = request.json
@@ -279,7 +1497,10 @@ def register():
     if existing_user:
         return jsonify({"msg": "User already exists"}), 400
 
-    hashed_password = generate_password_hash(password)
+    try:
+        hashed_password = password_hasher.hash(password)
+    except PasswordHashBusy:
+        return hash_busy_response()
 
     new_user = User(username=username, password_hash=hashed_password)
     db.session.add(new_user)
@@ -300,9 +1521,32 @@ def login():
     username = data.get('username')
     password = data.get('password')
 
+    if app.config['LOGIN_RATE_LIMIT_ENABLED']:
+        # Both buckets are charged, so a flood spread over many usernames is still caught per address
+        retry_after = max(username_limiter.acquire(str(username)), address_limiter.acquire(request.remote_addr or ''))
+        if retry_after:
+            log_message('WARNING', f"Login rate limit hit for user '{username}' from {request.remote_addr}")
+            response = jsonify({"msg": "Too many login attempts, please try again later."})
+            response.headers['Retry-After'] = str(max(1, int(retry_after + 0.999)))
+            return response, 429
+
     user = User.query.filter_by(username=username).first()
 
-    if user and check_password_hash(user.password_hash, password):
+    try:
+        matches, needs_rehash = password_hasher.verify(user.password_hash, password) if user else (False, False)
+    except PasswordHashBusy:
+        return hash_busy_response()
+
+    if needs_rehash:
+        # The hash parameters changed since this password was stored: upgrade it while we have the plaintext
+        try:
+            user.password_hash = password_hasher.hash(password)
+            db.session.commit()
+            password_hasher.rehashed += 1
+        except PasswordHashBusy:
+            pass  # Try again at the next login
+
+    if matches:
         access_token = create_access_token(identity=user.id)
         refresh_token = create_refresh_token(identity=user.id) 
         return jsonify(access_token=access_token, refresh_token=refresh_token), 200
@@ -312,9 +1556,10 @@ def login():
 @app.route('/logout', methods=['POST'])
 @jwt_required()
 def logout():
-    jti = get_jwt()['jti']  
-    db.session.add(TokenBlacklist(jti=jti))
+    token = get_jwt()
+    db.session.add(TokenBlacklist(jti=token['jti']))
     db.session.commit()
+    blocklist_cache.revoke(token['jti'], token['exp'])  # Visible to this worker now, to the others on their next sync
     return jsonify({"msg": "User has been logged out."}), 200
 
 @app.route('/check_user/<username>', methods=['GET'])
@@ -343,9 +1588,11 @@ def create_book():
     log_message('INFO', f"Received data for book creation: {data}")
 
     required_fields = ['name', 'author', 'year_published', 'loan_time_type', 'category']  # Updated to include category
-    enum_fields = {'loan_time_type': LoanType}
+    enum_fields = {'loan_time_type': LoanType, 'branch': City}
 
     validate_fields(data, required_fields, enum_fields)
+    branch = data.get('branch') or request_branch()
+    route_to_branch(branch)
 
     new_book = Books(
         name=data['name'],
@@ -353,16 +1600,21 @@ def create_book():
         year_published=data['year_published'],
         loan_time_type=LoanType[data['loan_time_type']],
         category=data['category'],  # New category field
-        is_loaned=data.get('is_loaned', False)
+        is_loaned=data.get('is_loaned', False),
+        branch=City[branch] if branch else None
     )
 
     db.session.add(new_book)
+    stat_counters.add(db.session.connection(), book_counter_deltas([(True, new_book.is_loaned)]))
+    record_session_changes('created', new_book)
     db.session.commit()
+    invalidate_responses('books')
 
     log_message('INFO', f"Successfully created a new book: {new_book.name} (ID: {new_book.id})")
     return jsonify(new_book.to_dict()), 201
 
 @app.route('/book/search', methods=['POST'])
+@read_replica
 def search_book():
     """Search for a specific book using a case-insensitive name."""
     data = request.json
@@ -375,6 +1627,7 @@ def search_book():
     return search_records(Books, 'name', name)
 
 @app.route('/author/search', methods=['POST'])
+@read_replica
 def search_author():
     """Search for a specific book using a case-insensitive author."""
     data = request.json
@@ -387,11 +1640,51 @@ def search_author():
     return search_records(Books, 'author', author)
 
 @app.route('/books', methods=['GET'])
+@read_replica
+@cached_response('books')
 def get_books():
     """Retrieve books based on specified status: active, inactive, or all."""
-    status = request.args.get('status', default='active', type=str)
-    books = get_status(Books, status)
-    return jsonify([book.to_dict() for book in books]), 200
+    return list_records(Books, BOOK_ROW)
+
+@app.route('/books/available', methods=['GET'])
+def get_available_books():
+    """Books that can be borrowed now, optionally of one category and loan type, paged in id order with ?limit= and ?after=."""
+    validate_fields(request.args, [], {'category': BookCategory, 'loan_time_type': LoanType})
+    category = request.args.get('category')
+    loan_type = request.args.get('loan_time_type')
+    limit = request.args.get('limit', default=app.config['DEFAULT_PAGE_SIZE'], type=int)
+    if limit < 1:
+        abort(400, description="limit must be a positive integer.")
+    limit = min(limit, app.config['MAX_PAGE_SIZE'])
+    after = decode_cursor(request.args['after']) if request.args.get('after') else 0
+
+    criteria = [Books.is_active.is_(True), Books.is_loaned.is_(False)]
+
+    def shard_page():
+        if app.config['AVAILABILITY_INDEX_ENABLED']:
+            index = availability_indexes[current_shard()]
+            index.refresh()
+            return index.available(category, loan_type, after, limit + 1)
+        filters = list(criteria)
+        if category:
+            filters.append(Books.category == BookCategory[category])
+        if loan_type:
+            filters.append(Books.loan_time_type == LoanType[loan_type])
+        ids = db.session.scalars(select(Books.id).where(*filters, Books.id > after).order_by(Books.id).limit(limit + 1)).all()
+        return ids, db.session.scalar(select(func.count()).select_from(Books).where(*filters))
+
+    shard_pages = scatter(shard_page)
+    ids = list(merge_sorted([ids for ids, _ in shard_pages], limit=limit + 1))
+    total = sum(count for _, count in shard_pages)
+
+    page = ids[:limit]
+    def page_rows():
+        # Checked again against the table: another worker may have lent a book since the index last caught up
+        return db.session.execute(select(*BOOK_ROW.columns).where(Books.id.in_(page), *criteria).order_by(Books.id)).all()
+
+    rows = list(merge_sorted(scatter(page_rows), key=lambda row: row.id)) if page else []
+    next_cursor = encode_cursor(page[-1]) if len(ids) > limit else None
+    return jsonify({'items': [BOOK_ROW(row) for row in rows], 'next_cursor': next_cursor, 'count': total}), 200
 
 @app.route('/book/status', methods=['POST'])
 @jwt_required()
@@ -410,13 +1703,17 @@ def toggle_book_status():
 @jwt_required()
 def delete_book(name):
     """Delete a specific book by its name."""
-    book = Books.query.filter_by(name=name).first()
+    row = route_to_entity(Books, 'name', name)
+    book = db.session.get(Books, row['id']) if row else None
     if book is None:
         log_message('WARNING', f"Book not found for deletion: {name}")
         abort(404, description="Book not found.")
 
     db.session.delete(book)
+    stat_counters.add(db.session.connection(), book_counter_deltas([(book.is_active, book.is_loaned)], sign=-1))
+    record_session_changes('deleted', book)
     db.session.commit()
+    invalidate_responses('books')
     
     log_message('INFO', f"Deleted book: {name}")
     return jsonify({'message': f"Book '{name}' deleted successfully."}), 200
@@ -434,6 +1731,7 @@ def create_customer():
 
     # Validate required and enum fields
     validate_fields(data, required_fields, enum_fields)
+    route_to_branch(data['city'])  # Customers belong to the branch of their city
 
     new_customer = Customers(
         full_name=data['full_name'],
@@ -443,7 +1741,9 @@ def create_customer():
     )
 
     db.session.add(new_customer)
+    record_session_changes('created', new_customer)
     db.session.commit()
+    invalidate_responses('customers')
 
     log_message('INFO', f"Successfully created a new customer: {new_customer.full_name} (ID: {new_customer.id})")
     return jsonify(new_customer.to_dict()), 201
@@ -462,6 +1762,7 @@ def toggle_customer_status():
     return toggle_status(Customers, 'email', email)
 
 @app.route('/customer/search', methods=['POST'])
+@read_replica
 def search_customer():
     """Search for a specific customer using email or full name."""
     data = request.json
@@ -478,31 +1779,145 @@ def search_customer():
         return search_records(Customers, 'full_name', full_name)
 
 @app.route('/customers', methods=['GET'])
+@read_replica
+@cached_response('customers')
 def get_customers():
     """Retrieve customers based on specified status: active, inactive, or all."""
-    status = request.args.get('status', default='active', type=str)
-    customers = get_status(Customers, status)
-    return jsonify([customer.to_dict() for customer in customers]), 200
+    return list_records(Customers, CUSTOMER_ROW)
 
 @app.route('/customer/<email>', methods=['DELETE'])
 def delete_customer(email):
     """Delete a specific customer by their email."""
-    customer = Customers.query.filter_by(email=email).first()
+    row = route_to_entity(Customers, 'email', email)
+    customer = db.session.get(Customers, row['id']) if row else None
     if customer is None:
         log_message('WARNING', f"Customer not found for deletion: {email}")
         abort(404, description="Customer not found.")
     
-    if customer.loans:  # Check if there are any associated loans
+    # EXISTS stops at the first loan in the customer index instead of loading them all
+    if db.session.scalar(select(exists().where(Loans.customer_id == customer.id))):
         log_message('WARNING', f"Cannot delete customer with active loans: {email}")
         abort(400, description="Customer cannot be deleted while having active loans.")
 
     db.session.delete(customer)
+    record_session_changes('deleted', customer)
     db.session.commit()
+    invalidate_responses('customers')
     
     log_message('INFO', f"Deleted customer: {email}")
     return jsonify({'message': f"Customer '{email}' deleted successfully."}), 200
 
+@app.route('/customer/<int:customer_id>/loans', methods=['GET'])
+@read_replica
+@cached_response('loans', 'books', 'customers')
+def get_customer_loans(customer_id):
+    """A customer's loans, newest first, with ?status=active, returned, late or all, paged with ?limit= and ?after=."""
+    status = request.args.get('status', 'all')
+    criteria = {'active': [Loans.is_active.is_(True)], 'returned': [Loans.is_active.is_(False)], 'all': []}.get(status)
+    if status == 'late':
+        criteria = status_filter(Loans, 'late')  # One customer's open loans are few; no need for the tracker
+    if criteria is None:
+        log_message('WARNING', f"Invalid status parameter provided for loans of customer {customer_id}.")
+        abort(400, description="Invalid status parameter. Use 'active', 'returned', 'late', or 'all'.")
+    limit = request.args.get('limit', default=app.config['DEFAULT_PAGE_SIZE'], type=int)
+    if limit < 1:
+        abort(400, description="limit must be a positive integer.")
+    limit = min(limit, app.config['MAX_PAGE_SIZE'])
+
+    if route_to_entity(Customers, 'id', customer_id) is None:  # Loans live on their customer's shard
+        log_message('WARNING', f"Customer not found: {customer_id}")
+        abort(404, description="Customer not found.")
+
+    # Keyset pagination down the (customer_id, is_active) index, one extra row to know whether another page exists
+    query = select(*LOAN_ROW.columns).where(Loans.customer_id == customer_id, *criteria)
+    if request.args.get('after'):
+        query = query.where(Loans.id < decode_cursor(request.args['after']))
+    loans = db.session.execute(query.order_by(Loans.id.desc()).limit(limit + 1)).all()
+    next_cursor = encode_cursor(loans[limit - 1].id) if len(loans) > limit else None
+    loans = loans[:limit]
+
+    # The books of the whole page, those not in the entity cache in one query
+    books = {book_id: row for book_id, (_, row) in find_entities(Books, 'id', {loan.book_id for loan in loans}, [current_shard()]).items()}
+
+    items = [dict(LOAN_ROW(loan), book=books.get(loan.book_id)) for loan in loans]
+    return jsonify({'items': items, 'next_cursor': next_cursor}), 200
+
 # Routes for loans
+def active_loan_counts(connection, customer_ids):
+    """{customer_id: open loans} for the given customers, counted on the (customer_id, is_active) index."""
+    return dict(connection.execute(
+        select(Loans.customer_id, func.count())
+        .where(Loans.customer_id.in_(customer_ids), Loans.is_active.is_(True))
+        .group_by(Loans.customer_id)
+    ).all())
+
+def loans_over_limit(connection, customer_ids):
+    """For new loans to these customers, in order, whether each would pass MAX_ACTIVE_LOANS_PER_CUSTOMER.
+
+    Called inside the checkout transaction after its first write: on SQLite the write lock is then
+    held, so two checkouts for the same customer cannot both see room for one more loan.
+    """
+    limit = app.config['MAX_ACTIVE_LOANS_PER_CUSTOMER']
+    if limit <= 0:
+        return [False] * len(customer_ids)
+    counts = Counter(active_loan_counts(connection, set(customer_ids)))
+    over = []
+    for customer_id in customer_ids:
+        over.append(counts[customer_id] >= limit)
+        if not over[-1]:
+            counts[customer_id] += 1
+    return over
+
+def run_transaction(func, action):
+    """Run func(connection) in a write transaction on the request's shard, retried while locked; answer 503 if the lock outlasts the retries."""
+    try:
+        return transaction_retry.run(shard_engine(), func)
+    except OperationalError as error:
+        if not is_lock_error(error):
+            raise
+        log_message('ERROR', f"Database still locked after retries: {action}")
+        abort(503, description="The library is busy, please try again.")
+
+def checkout_book(customer_id, book_id, loan_time_type):
+    """Claim a book and insert its loan in one short transaction.
+
+    The conditional UPDATE is the availability check: of two concurrent checkouts of the same
+    book only one can flip is_loaned, so a book is never loaned twice. Returns the loan row,
+    'unavailable', 'loan_limit' or 'no_customer'.
+    """
+    def checkout(connection):
+        claimed = connection.execute(
+            update(Books)
+            .where(Books.id == book_id, Books.is_loaned.is_(False), Books.is_active.is_(True))
+            .values(is_loaned=True)
+        ).rowcount
+        if not claimed:
+            raise Rollback('unavailable')
+        if loans_over_limit(connection, [customer_id])[0]:
+            raise Rollback('loan_limit')  # Releases the book again
+
+        # Taken once the book is ours, so a loan never starts before the previous one was returned
+        loan_date = datetime.utcnow()
+        return_date = loan_date + timedelta(days=loan_days(loan_time_type))
+
+        # Insert only if the customer exists, without a separate round-trip to check
+        loan = connection.execute(
+            insert(Loans).from_select(
+                ['customer_id', 'book_id', 'loan_time_type', 'loan_date', 'return_date', 'is_active'],
+                select(Customers.id, literal(book_id), literal(loan_time_type, Loans.loan_time_type.type),
+                       literal(loan_date, Loans.loan_date.type), literal(return_date, Loans.return_date.type),
+                       literal(True)).where(Customers.id == customer_id)
+            ).returning(*LOAN_ROW.columns)
+        ).first()
+        if loan is None:
+            raise Rollback('no_customer')  # Releases the book again
+        stat_counters.add(connection, loan_counter_deltas(connection, [(book_id, customer_id)], active=1, total=1, loaned=1))
+        record_changes(connection, 'loans', 'created', [loan.id])
+        record_changes(connection, 'books', 'updated', [book_id])
+        return loan
+
+    return run_transaction(checkout, f"loan for book ID {book_id} not created")
+
 @app.route('/loan', methods=['POST'])
 @jwt_required()
 def create_loan():
@@ -514,110 +1929,1005 @@ def create_loan():
 
     # Validate required and enum fields
     validate_fields(data, required_fields, enum_fields)
+    # A loan is made on its customer's shard, so only books of branches on that shard can be lent
+    route_to_entity(Customers, 'id', data['customer_id'])  # A missing customer is reported by checkout_book()
 
-    # Check if the book is available for loan
-    book = Books.query.get(data['book_id'])
-    if book is None or book.is_loaned:
+    loan = checkout_book(data['customer_id'], data['book_id'], LoanType[data['loan_time_type']])
+    if loan == 'unavailable':
         log_message('ERROR', f"Book is either unavailable or already loaned: {data['book_id']}")
         abort(400, description="Book is unavailable or already loaned.")
-
-    customer = Customers.query.get(data['customer_id'])
-    if customer is None:
+    if loan == 'no_customer':
         log_message('ERROR', f"Customer not found: {data['customer_id']}")
         abort(404, description="Customer not found.")
+    if loan == 'loan_limit':
+        log_message('WARNING', f"Customer {data['customer_id']} is at the limit of active loans")
+        abort(400, description=f"Customer already has {app.config['MAX_ACTIVE_LOANS_PER_CUSTOMER']} active loans.")
 
-    # Use the enum directly to get the number of days
-    loan_time_type = LoanType[data['loan_time_type']]
-    days = int(loan_time_type.value.split()[0])  # Extract the number of days as integer
-
-    # Calculate return date
-    return_date = datetime.now(timezone.utc) + timedelta(days=days)
+    new_loan = LOAN_ROW(loan)
+    overdue_trackers[current_shard()].add(new_loan['id'], loan.return_date)
+    invalidate_responses('loans', 'books')
 
-    new_loan = Loans(
-        customer_id=data['customer_id'],
-        book_id=data['book_id'],
-        loan_time_type=loan_time_type,
-        return_date=return_date
-    )
-
-    book.is_loaned = True
-    db.session.add(new_loan)
-    db.session.commit()
-
-    log_message('INFO', f"Successfully created a new loan: {new_loan.id} for book ID: {data['book_id']}")
-    return jsonify(new_loan.to_dict()), 201
+    log_message('INFO', f"Successfully created a new loan: {new_loan['id']} for book ID: {data['book_id']}")
+    return jsonify(new_loan), 201
 
 @app.route('/loan/<int:loan_id>', methods=['DELETE'])
 @jwt_required()
 def delete_loan(loan_id):
     """Delete a specific loan by its ID."""
-    loan = Loans.query.get(loan_id)
-    if loan is None:
+    route_to_record(Loans, Loans.id == loan_id, record_id=loan_id)
+
+    def remove(connection):
+        # Of two concurrent deletes only one gets the row back, and only it changes the book and the counters
+        loan = connection.execute(
+            delete(Loans).where(Loans.id == loan_id).returning(Loans.book_id, Loans.customer_id, Loans.is_active)
+        ).first()
+        if loan is None:
+            raise Rollback('not_found')
+        deltas = loan_counter_deltas(connection, [(loan.book_id, loan.customer_id)], active=-1 if loan.is_active else 0, total=-1)
+        record_changes(connection, 'loans', 'deleted', [loan_id])
+        if loan.is_active:  # A returned loan's book may be out on a newer loan by now
+            deltas['books', 'loaned'] -= release_books(connection, [loan.book_id])
+        stat_counters.add(connection, deltas)
+        return loan
+
+    if run_transaction(remove, f"loan {loan_id} not deleted") == 'not_found':
         log_message('WARNING', f"Loan not found for deletion: {loan_id}")
         abort(404, description="Loan not found.")
-
-    # Mark the associated book as not loaned
-    book = Books.query.get(loan.book_id)
-    if book:
-        book.is_loaned = False
-
-    db.session.delete(loan)
-    db.session.commit()
+    overdue_trackers[current_shard()].remove(loan_id)
+    invalidate_responses('loans', 'books')
     
     log_message('INFO', f"Deleted loan: {loan_id}")
     return jsonify({'message': f"Loan '{loan_id}' deleted successfully."}), 200
 
+def release_books(connection, book_ids):
+    """Mark the books of closed loans as not loaned. Returns how many were loaned."""
+    released = connection.execute(
+        update(Books).where(Books.id.in_(book_ids), Books.is_loaned.is_(True)).values(is_loaned=False)
+    ).rowcount
+    record_changes(connection, 'books', 'updated', book_ids)
+    return released
+
+def close_loans(connection, loan_ids):
+    """Return the loans among loan_ids that are still open and release their books. Returns [(id, book_id)] of those closed.
+
+    The conditional UPDATE is the check that a loan is open: of two concurrent returns only one
+    closes it, and only that one releases the book and changes the counters.
+    """
+    returned = connection.execute(
+        update(Loans)
+        .where(Loans.id.in_(loan_ids), Loans.is_active.is_(True))
+        .values(is_active=False, return_date=datetime.utcnow())
+        .returning(Loans.id, Loans.book_id, Loans.customer_id)
+    ).all()
+    if returned:
+        deltas = loan_counter_deltas(connection, [(book_id, customer_id) for _, book_id, customer_id in returned], active=-1)
+        deltas['books', 'loaned'] -= release_books(connection, [book_id for _, book_id, _ in returned])
+        stat_counters.add(connection, deltas)
+        record_changes(connection, 'loans', 'updated', [loan_id for loan_id, _, _ in returned])
+    return [(loan_id, book_id) for loan_id, book_id, _ in returned]
+
 @app.route('/return/<int:loan_id>', methods=['POST'])
 @jwt_required()
 def return_loan(loan_id):
     """Return a loan by its ID."""
-    loan = Loans.query.get(loan_id)
-    if loan is None:
-        log_message('WARNING', f"Loan not found: {loan_id}")
-        return jsonify({'error': 'Loan not found'}), 404
-
-    if not loan.is_active:
+    route_to_record(Loans, Loans.id == loan_id, record_id=loan_id)
+    returned = run_transaction(lambda connection: close_loans(connection, [loan_id]), f"loan {loan_id} not returned")
+    if not returned:
+        if db.session.get(Loans, loan_id) is None:
+            log_message('WARNING', f"Loan not found: {loan_id}")
+            return jsonify({'error': 'Loan not found'}), 404
         log_message('WARNING', f"Loan already returned: {loan_id}")
         return jsonify({'error': 'Loan already returned'}), 400
 
-    loan.is_active = False
-    loan.return_date = datetime.now(timezone.utc)  # Set the return date
-
-    # Use relationship to access the book
-    book = loan.book  # Now using the relationship
-    if book:
-        book.is_loaned = False  # Update book status
-
-    db.session.commit()
-
-    log_message('INFO', f"Successfully returned book ID: {book.id} for loan ID: {loan_id}")
-    return jsonify({'message': f'Loan {loan_id} for book "{book.name}" returned successfully.'}), 200
+    overdue_trackers[current_shard()].remove(loan_id)
+    invalidate_responses('loans', 'books')
+
+    book_id = returned[0][1]
+    log_message('INFO', f"Successfully returned book ID: {book_id} for loan ID: {loan_id}")
+    book_name = db.session.scalar(select(Books.name).where(Books.id == book_id))
+    return jsonify({'message': f'Loan {loan_id} for book "{book_name}" returned successfully.'}), 200
+
+# Batch checkout and return for front-desk scanners
+CHECKOUT_ITEM = RowSchema(required={'customer_id': parse_int, 'book_id': parse_int, 'loan_time_type': parse_enum(LoanType)})
+
+def batch_items(field):
+    """The list sent under `field` in the JSON body; aborts when it is missing, empty or too long."""
+    data = request.get_json(silent=True)
+    items = data.get(field) if isinstance(data, dict) else None
+    if not isinstance(items, list) or not items:
+        log_message('WARNING', f"Batch request without a '{field}' list")
+        abort(400, description=f"Send a non-empty '{field}' list.")
+    if len(items) > app.config['MAX_BATCH_ITEMS']:
+        log_message('WARNING', f"Batch of {len(items)} items exceeds MAX_BATCH_ITEMS")
+        abort(400, description=f"At most {app.config['MAX_BATCH_ITEMS']} items per batch.")
+    return items
+
+def batch_response(results):
+    succeeded = sum(1 for result in results if result['status'] < 400)
+    return jsonify({'results': results, 'succeeded': succeeded, 'failed': len(results) - succeeded}), 200
+
+@app.route('/loans/batch', methods=['POST'])
+@jwt_required()
+def create_loans_batch():
+    """Check out several books at once. Each item gets its own result; the valid ones are applied in one transaction."""
+    items = batch_items('items')
+    results = [None] * len(items)
+    pending = {}  # index -> validated item
+    book_ids = set()
+
+    for index, item in enumerate(items):
+        clean, errors = CHECKOUT_ITEM.validate(item) if isinstance(item, dict) else ({}, ["item must be an object"])
+        if errors:
+            results[index] = {'index': index, 'status': 400, 'error': '; '.join(errors)}
+        elif clean['book_id'] in book_ids:
+            results[index] = {'index': index, 'status': 400, 'error': "Book appears more than once in the batch."}
+        else:
+            book_ids.add(clean['book_id'])
+            pending[index] = clean
+
+    # The customers of the batch from the entity cache, the rest in one query per shard; each loan is made on its customer's shard
+    customer_shards = {}
+    if pending:
+        customer_ids = {clean['customer_id'] for clean in pending.values()}
+        customer_shards = {customer_id: shard for customer_id, (shard, _) in find_entities(Customers, 'id', customer_ids).items()}
+        for index, clean in list(pending.items()):
+            if clean['customer_id'] not in customer_shards:
+                results[index] = {'index': index, 'status': 404, 'error': "Customer not found."}
+                del pending[index]
+
+    def checkout(connection, shard_items):
+        # The conditional update claims the books again, in case another request took one since the check
+        claimed = set(connection.scalars(
+            update(Books)
+            .where(Books.id.in_([clean['book_id'] for clean in shard_items.values()]),
+                   Books.is_loaned.is_(False), Books.is_active.is_(True))
+            .values(is_loaned=True)
+            .returning(Books.id)
+        ))
+        indexes = [index for index, clean in shard_items.items() if clean['book_id'] in claimed]
+        over = loans_over_limit(connection, [shard_items[index]['customer_id'] for index in indexes])
+        refused = [index for index, is_over in zip(indexes, over) if is_over]
+        if refused:
+            connection.execute(update(Books).where(Books.id.in_([shard_items[index]['book_id'] for index in refused]))
+                               .values(is_loaned=False))
+            indexes = [index for index, is_over in zip(indexes, over) if not is_over]
+        if not indexes:
+            return {}, refused
+
+        loan_date = datetime.utcnow()
+        rows = [dict(shard_items[index], loan_date=loan_date, is_active=True,
+                     return_date=loan_date + timedelta(days=loan_days(shard_items[index]['loan_time_type'])))
+                for index in indexes]
+        loans = connection.execute(insert(Loans).returning(*LOAN_ROW.columns, sort_by_parameter_order=True), rows).all()
+        stat_counters.add(connection, loan_counter_deltas(
+            connection, [(row['book_id'], row['customer_id']) for row in rows], active=1, total=1, loaned=1))
+        record_changes(connection, 'loans', 'created', [loan.id for loan in loans])
+        record_changes(connection, 'books', 'updated', [row['book_id'] for row in rows])
+        return dict(zip(indexes, loans)), refused
+
+    # One query for the books and one transaction per shard
+    loans, refused = {}, []
+    for shard in shard_router.names:
+        shard_items = {index: clean for index, clean in pending.items() if customer_shards[clean['customer_id']] == shard}
+        if not shard_items:
+            continue
+        moving = shard_router.is_read_only(shard)
+        if not moving:
+            use_shard(shard)
+            available = set(db.session.scalars(select(Books.id).where(
+                Books.id.in_({clean['book_id'] for clean in shard_items.values()}), Books.is_loaned.is_(False), Books.is_active.is_(True))))
+        for index, clean in list(shard_items.items()):
+            if moving:
+                results[index] = {'index': index, 'status': 503, 'error': "The customer's branch is being moved, please try again."}
+            elif clean['book_id'] not in available:
+                results[index] = {'index': index, 'status': 400, 'error': "Book is unavailable or already loaned."}
+            else:
+                continue
+            del pending[index], shard_items[index]
+        if shard_items:
+            shard_loans, shard_refused = run_transaction(lambda connection: checkout(connection, shard_items),
+                                                         f"batch checkout of {len(shard_items)} books")
+            loans.update(shard_loans)
+            refused.extend(shard_refused)
+
+    for index in pending:
+        loan = loans.get(index)
+        if index in refused:
+            limit = app.config['MAX_ACTIVE_LOANS_PER_CUSTOMER']
+            results[index] = {'index': index, 'status': 400, 'error': f"Customer already has {limit} active loans."}
+            continue
+        if loan is None:
+            results[index] = {'index': index, 'status': 400, 'error': "Book is unavailable or already loaned."}
+            continue
+        overdue_trackers[customer_shards[pending[index]['customer_id']]].add(loan.id, loan.return_date)
+        results[index] = {'index': index, 'status': 201, 'loan': LOAN_ROW(loan)}
+    if loans:
+        invalidate_responses('loans', 'books')
+
+    log_message('INFO', f"Batch checkout: {len(loans)} of {len(items)} books loaned.")
+    return batch_response(results)
+
+@app.route('/returns/batch', methods=['POST'])
+@jwt_required()
+def return_loans_batch():
+    """Return several loans at once. Each loan gets its own result; the valid ones are applied in one transaction."""
+    items = batch_items('loan_ids')
+    results = [None] * len(items)
+    pending = {}  # index -> loan id
+    loan_ids = set()
+
+    for index, item in enumerate(items):
+        try:
+            loan_id = parse_int(item)
+        except ValueError:
+            results[index] = {'index': index, 'status': 400, 'error': "Loan id must be an integer."}
+            continue
+        if loan_id in loan_ids:
+            results[index] = {'index': index, 'loan_id': loan_id, 'status': 400, 'error': "Loan appears more than once in the batch."}
+            continue
+        loan_ids.add(loan_id)
+        pending[index] = loan_id
+
+    loan_shards, active = {}, {}
+    if pending:
+        for shard, (loan_id, is_active) in rows_by_shard(select(Loans.id, Loans.is_active).where(Loans.id.in_(loan_ids))):
+            loan_shards[loan_id], active[loan_id] = shard, is_active
+        for index, loan_id in list(pending.items()):
+            if loan_id not in active:
+                results[index] = {'index': index, 'loan_id': loan_id, 'status': 404, 'error': "Loan not found."}
+                del pending[index]
+            elif not active[loan_id]:
+                results[index] = {'index': index, 'loan_id': loan_id, 'status': 400, 'error': "Loan already returned."}
+                del pending[index]
+
+    def return_loans(connection, shard_loan_ids):
+        return {loan_id for loan_id, _ in close_loans(connection, shard_loan_ids)}
+
+    # One transaction per shard
+    returned = set()
+    for shard in shard_router.names:
+        shard_loan_ids = [loan_id for loan_id in pending.values() if loan_shards[loan_id] == shard]
+        if not shard_loan_ids:
+            continue
+        if shard_router.is_read_only(shard):
+            for index, loan_id in list(pending.items()):
+                if loan_shards[loan_id] == shard:
+                    results[index] = {'index': index, 'loan_id': loan_id, 'status': 503, 'error': "The loan's branch is being moved, please try again."}
+                    del pending[index]
+            continue
+        use_shard(shard)
+        returned |= run_transaction(lambda connection: return_loans(connection, shard_loan_ids), f"batch return of {len(shard_loan_ids)} loans")
+
+    for index, loan_id in pending.items():
+        if loan_id not in returned:
+            results[index] = {'index': index, 'loan_id': loan_id, 'status': 400, 'error': "Loan already returned."}
+            continue
+        overdue_trackers[loan_shards[loan_id]].remove(loan_id)
+        results[index] = {'index': index, 'loan_id': loan_id, 'status': 200}
+    if returned:
+        invalidate_responses('loans', 'books')
+
+    log_message('INFO', f"Batch return: {len(returned)} of {len(items)} loans returned.")
+    return batch_response(results)
 
 @app.route('/loans', methods=['GET'])
+@read_replica
+@cached_response('loans', 'books', 'customers')  # Loan listings embed book and customer data
 def get_loans():
     """Retrieve loans based on specified status: active, inactive, or late."""
-    status = request.args.get('status', default='active', type=str)
-
-    # Use get_status to retrieve loans with related book and customer data
-    loans = get_status(Loans, status, eager_load=[joinedload(Loans.book), joinedload(Loans.customer)])
+    # Book and customer data come from the same row through outer joins
+    return list_records(Loans, LOAN_DETAILS_ROW, joins=LOAN_DETAILS_JOINS)
+
+# Aggregated statistics, read from the counters instead of scanning the tables
+def book_stats(values):
+    books = values.get('books', {})
+    return {key: books.get(key, 0) for key in ('total', 'active', 'loaned')}
+
+def loan_stats(values):
+    loans = values.get('loans', {})
+
+    def grouped(group, enum_class):
+        active, total = values.get(f'active_loans_by_{group}', {}), values.get(f'loans_by_{group}', {})
+        return {name: {'active': active.get(name, 0), 'total': total.get(name, 0)} for name in enum_class.__members__}
+
+    return {'active': loans.get('active', 0), 'total': loans.get('total', 0),
+            'by_city': grouped('city', City), 'by_category': grouped('category', BookCategory)}
+
+def read_stats(*names):
+    """The counters, summed over the shards the request covers."""
+    values = {}
+    for shard_values in scatter(lambda: stat_counters.read(db.session.connection(), *names)):
+        for name, keys in shard_values.items():
+            totals = values.setdefault(name, {})
+            for key, value in keys.items():
+                totals[key] = totals.get(key, 0) + value
+    return values
+
+def overdue_stats():
+    """Open loans past their return date, counted over each shard's tracker ids or due-date index."""
+    return {'overdue': sum(scatter(lambda: db.session.scalar(select(func.count()).select_from(Loans).where(*late_loan_criteria()))))}
+
+@app.route('/stats', methods=['GET'])
+@read_replica
+def get_stats():
+    """All statistics: book totals, loans per city and category, and overdue loans."""
+    values = read_stats()
+    return jsonify({'books': book_stats(values), 'loans': loan_stats(values), **overdue_stats()}), 200
+
+@app.route('/stats/books', methods=['GET'])
+@read_replica
+def get_book_stats():
+    """Books in the catalogue, active and currently loaned."""
+    return jsonify(book_stats(read_stats('books'))), 200
+
+@app.route('/stats/loans', methods=['GET'])
+@read_replica
+def get_loan_stats():
+    """Active and total loans, overall and per customer city and book category."""
+    return jsonify(loan_stats(read_stats())), 200
+
+@app.route('/stats/overdue', methods=['GET'])
+@read_replica
+def get_overdue_stats():
+    """Number of open loans past their return date."""
+    return jsonify(overdue_stats()), 200
+
+# Change feed routes
+def change_feed_args(since):
+    """The ?entity= list and ?limit= of a change feed request, after checking `since` is still in the log.
+
+    Aborts with 410 when entries after `since` have been compacted away; the client then reloads the
+    lists and follows on from the latest seq.
+    """
+    entities = [entity for entity in request.args.get('entity', '').split(',') if entity]
+    unknown = [entity for entity in entities if entity not in CHANGE_ROWS]
+    if unknown:
+        abort(400, description=f"Invalid entity: {', '.join(unknown)}. Use {', '.join(CHANGE_ROWS)}.")
+    limit = min(request.args.get('limit', default=app.config['CHANGES_DEFAULT_LIMIT'], type=int), app.config['CHANGES_MAX_LIMIT'])
+    if limit < 1:
+        abort(400, description="limit must be a positive integer.")
+
+    oldest, _ = change_log_bounds()
+    if oldest is not None and since < oldest - 1:
+        log_message('WARNING', f"Change feed request from seq {since}, log starts at {oldest}")
+        abort(410, description=f"Changes after seq {since} are no longer available; reload and follow from the latest seq.")
+    return entities, limit
+
+def feed_busy_response():
+    response = jsonify({'error': "Too many change feed requests waiting, please try again."})
+    response.headers['Retry-After'] = str(int(app.config['CHANGES_POLL_INTERVAL']) + 1)
+    return response, 503
+
+@app.route('/changes', methods=['GET'])
+def get_changes():
+    """Changes after ?since=<seq>, oldest first, waiting up to ?wait= seconds for one (long-poll).
+
+    Without ?since= the current seq is returned: read it, load the lists, then follow from it.
+    ?consumer=<name> records that the named client has everything up to since, for compaction; it needs a JWT,
+    as a recorded consumer holds back compaction until it is forgotten.
+    Each shard keeps its own feed and seqs: ?branch= follows that branch's shard, else the default one.
+    """
+    since = request.args.get('since', type=int)
+    if since is None:
+        return jsonify({'changes': [], 'next': change_log_bounds()[1] or 0, 'more': False}), 200
+
+    entities, limit = change_feed_args(since)
+    consumer = request.args.get('consumer')
+    if consumer:
+        verify_jwt_in_request()
+        register_consumer(consumer, since)
+
+    wait = max(0.0, min(request.args.get('wait', default=0.0, type=float), app.config['CHANGES_MAX_WAIT']))
+    if not wait:
+        changes = fetch_changes(since, limit, entities)
+    elif change_notifier.acquire():
+        try:
+            changes = change_notifier.wait_for(lambda: fetch_changes(since, limit, entities), wait)
+        finally:
+            change_notifier.release()
+    else:
+        return feed_busy_response()
+
+    return jsonify({'changes': changes, 'next': changes[-1]['seq'] if changes else since, 'more': len(changes) == limit}), 200
+
+@app.route('/changes/stream', methods=['GET'])
+def stream_changes():
+    """Server-Sent Events stream of changes after ?since= or the Last-Event-ID header, or from now."""
+    since = request.headers.get('Last-Event-ID', type=int)
+    if since is None:
+        since = request.args.get('since', type=int)
+    if since is None:
+        since = change_log_bounds()[1] or 0
+    entities, limit = change_feed_args(since)
+    if not change_notifier.acquire():
+        return feed_busy_response()
+
+    heartbeat = app.config['CHANGES_HEARTBEAT']
+    deadline = time.monotonic() + app.config['CHANGES_STREAM_MAX_SECONDS']
+
+    def generate(cursor):
+        try:
+            yield f'retry: {int(app.config["CHANGES_POLL_INTERVAL"] * 1000)}\n\n'
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return  # EventSource reconnects with Last-Event-ID
+                changes = change_notifier.wait_for(lambda: fetch_changes(cursor, limit, entities), min(heartbeat, remaining))
+                if not changes:
+                    yield ': keepalive\n\n'
+                    continue
+                for change in changes:
+                    yield f"id: {change['seq']}\nevent: change\ndata: {app.json.dumps(change)}\n\n"
+                cursor = changes[-1]['seq']
+        finally:
+            change_notifier.release()
+
+    return Response(stream_with_context(generate(since)), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.cli.command('purge-tokens')
+def purge_tokens_command():
+    """Delete expired entries from the token blacklist."""
+    print(f"Purged {purge_expired_tokens()} expired token(s).")
+
+# Bulk import and export
+def loan_days(loan_time_type):
+    """Number of days a loan type allows, e.g. 10 for LoanType.TEN_DAYS."""
+    return int(loan_time_type.value.split()[0])
+
+def parse_datetime(value):
+    """Naive UTC datetime, like the stored timestamps, from an ISO 8601 string with or without an offset."""
+    try:
+        parsed = datetime.fromisoformat(str(value).strip())
+    except ValueError:
+        raise ValueError("must be an ISO 8601 date") from None
+    return parsed.astimezone(timezone.utc).replace(tzinfo=None) if parsed.tzinfo else parsed
+
+def check_new_books(rows, report):
+    """Reject books whose name already exists on any shard or earlier in the import. Returns (shard, row) pairs."""
+    names = {row['name'] for _, row in rows}
+    taken = {name for _, (name,) in rows_by_shard(select(Books.name).where(Books.name.in_(names)), shard_router.names)} if names else set()
+
+    accepted = []
+    for row_number, row in rows:
+        if row['name'] in taken:
+            report.add_error(row_number, [f"name: book '{row['name']}' already exists"])
+            continue
+        taken.add(row['name'])
+        accepted.append((shard_router.shard_for(row['branch'] and row['branch'].name), row))
+    return accepted
+
+def check_new_customers(rows, report):
+    """Reject customers whose email already exists on any shard or earlier in the import. Returns (shard, row) pairs."""
+    emails = {row['email'] for _, row in rows}
+    taken = {email for _, (email,) in rows_by_shard(select(Customers.email).where(Customers.email.in_(emails)), shard_router.names)} if emails else set()
+
+    accepted = []
+    for row_number, row in rows:
+        if row['email'] in taken:
+            report.add_error(row_number, [f"email: customer '{row['email']}' already exists"])
+            continue
+        taken.add(row['email'])
+        accepted.append((shard_router.shard_for(row['city'].name), row))
+    return accepted
+
+def check_new_loans(rows, report):
+    """Check loans as checkout_book() would, then fill in the loan and return dates.
+
+    Customers must exist, books must be active, free and on the customer's shard, and a customer
+    may not go over MAX_ACTIVE_LOANS_PER_CUSTOMER, counting the loans accepted earlier in the
+    import. Returns (shard, row) pairs.
+    """
+    customer_ids = {row['customer_id'] for _, row in rows}
+    book_ids = {row['book_id'] for _, row in rows}
+    customer_shards = {customer_id: shard for shard, (customer_id,) in rows_by_shard(
+        select(Customers.id).where(Customers.id.in_(customer_ids)), shard_router.names)} if customer_ids else {}
+    available_books = {book_id: shard for shard, (book_id,) in rows_by_shard(
+        select(Books.id).where(Books.id.in_(book_ids), Books.is_loaned.is_(False), Books.is_active.is_(True)),
+        shard_router.names)} if book_ids else {}
+    limit = app.config['MAX_ACTIVE_LOANS_PER_CUSTOMER']
+    open_loans = Counter()
+    if limit > 0:
+        for shard in set(customer_shards.values()):
+            shard_customers = [customer_id for customer_id, name in customer_shards.items() if name == shard]
+            open_loans.update(on_shard(shard, lambda: active_loan_counts(db.session.connection(), shard_customers)))
+
+    accepted = []
+    for row_number, row in rows:
+        errors = []
+        shard = customer_shards.get(row['customer_id'])
+        if shard is None:
+            errors.append(f"customer_id: customer {row['customer_id']} not found")
+        if row['book_id'] not in available_books:
+            errors.append(f"book_id: book {row['book_id']} is unavailable or already loaned")
+        elif shard is not None and available_books[row['book_id']] != shard:
+            errors.append(f"book_id: book {row['book_id']} belongs to a branch on another shard than the customer's")
+        if shard is not None and limit > 0 and open_loans[row['customer_id']] >= limit:
+            errors.append(f"customer_id: customer {row['customer_id']} already has {limit} active loans")
+        if errors:
+            report.add_error(row_number, errors)
+            continue
+
+        del available_books[row['book_id']]  # A book can only be loaned once per import
+        open_loans[row['customer_id']] += 1
+        loan_date = row.pop('loan_date') or datetime.utcnow()  # Naive UTC, as checkout stores it
+        row['loan_date'] = loan_date
+        row['return_date'] = loan_date + timedelta(days=loan_days(row['loan_time_type']))
+        accepted.append((shard, row))
+    return accepted
+
+def count_new_books(rows):
+    stat_counters.add(db.session.connection(), book_counter_deltas([(row['is_active'], row['is_loaned']) for row in rows]))
+
+def mark_books_loaned(rows):
+    """Mark the books of imported loans as loaned and count the loans."""
+    db.session.execute(update(Books).where(Books.id.in_([row['book_id'] for row in rows])).values(is_loaned=True))
+    connection = db.session.connection()
+    stat_counters.add(connection, loan_counter_deltas(
+        connection, [(row['book_id'], row['customer_id']) for row in rows], active=1, total=1, loaned=1))
+    record_changes(connection, 'books', 'updated', [row['book_id'] for row in rows])
+
+IMPORTERS = {
+    'books': (Books, RowSchema(
+        required={'name': parse_text, 'author': parse_text, 'year_published': parse_int,
+                  'loan_time_type': parse_enum(LoanType), 'category': parse_enum(BookCategory)},
+        optional={'is_loaned': (parse_bool, False), 'is_active': (parse_bool, True), 'branch': (parse_enum(City), None)}
+    ), check_new_books, count_new_books),
+    'customers': (Customers, RowSchema(
+        required={'full_name': parse_text, 'email': parse_email, 'city': parse_enum(City), 'age': parse_int},
+        optional={'is_active': (parse_bool, True)}
+    ), check_new_customers, None),
+    'loans': (Loans, RowSchema(
+        required={'customer_id': parse_int, 'book_id': parse_int, 'loan_time_type': parse_enum(LoanType)},
+        optional={'loan_date': (parse_datetime, None)}
+    ), check_new_loans, mark_books_loaned)
+}
+
+EXPORT_ROWS = {'books': BOOK_ROW, 'customers': CUSTOMER_ROW, 'loans': LOAN_ROW}
+
+def import_records(kind, stream, fmt):
+    """Validate and insert rows from a CSV or NDJSON stream in batches, collecting per-row errors.
+
+    Input that cannot be read on (bad UTF-8, malformed CSV) ends the import with report.unreadable set.
+    """
+    model_class, schema, check_batch, after_insert = IMPORTERS[kind]
+    report = ImportReport()
+
+    try:
+        for batch in batched(read_rows(stream, fmt), app.config['IMPORT_BATCH_SIZE']):
+            valid = []
+            for row_number, row, error in batch:
+                report.received += 1
+                if error:
+                    report.add_error(row_number, [error])
+                    continue
+                clean, errors = schema.validate(row)
+                if errors:
+                    report.add_error(row_number, errors)
+                    continue
+                valid.append((row_number, clean))
+
+            accepted = check_batch(valid, report) if valid else []
+            for shard in shard_router.names:
+                rows = [row for row_shard, row in accepted if row_shard == shard]
+                if not rows:
+                    continue
+                # One executemany insert and one commit per batch and shard
+                route_to_shard(shard)
+                ids = db.session.scalars(insert(model_class).returning(model_class.id, sort_by_parameter_order=True), rows).all()
+                record_changes(db.session.connection(), kind, 'created', ids)
+                if after_insert:
+                    after_insert(rows)
+                db.session.commit()
+                report.inserted += len(rows)
+            if accepted:
+                invalidate_responses(*(['loans', 'books'] if kind == 'loans' else [kind]))
+    except UnreadableInput as error:
+        report.stop(error)  # The batches before it stay imported
+        log_message('WARNING', f"Import of {kind} stopped at unreadable input, {error}")
+
+    log_message('INFO', f"Imported {report.inserted} of {report.received} {kind} ({report.failed} rejected).")
+    return report
+
+def import_format(filename=None):
+    """Pick the import format from ?format= and the content type, or from the file extension."""
+    if not has_request_context():
+        return 'csv' if filename.endswith('.csv') else 'ndjson'
+    return request.args.get('format') or ('csv' if request.mimetype == 'text/csv' else 'ndjson')
+
+@app.route('/<any(books, customers, loans):kind>/import', methods=['POST'])
+@jwt_required()
+def import_data(kind):
+    """Import books, customers or loans from a CSV or NDJSON request body."""
+    fmt = import_format()
+    if fmt not in ['csv', 'ndjson']:
+        log_message('WARNING', f"Invalid import format: {fmt}")
+        abort(400, description="Invalid format. Use 'csv' or 'ndjson'.")
+
+    report = import_records(kind, request.stream, fmt)
+    return jsonify(report.to_dict()), 400 if report.unreadable else 200
+
+@app.route('/<any(books, customers, loans):kind>/export', methods=['GET'])
+@read_replica
+def export_data(kind):
+    """Stream books, customers or loans as CSV or NDJSON in the import format."""
+    fmt = request.args.get('format', default='csv', type=str)
+    if fmt not in ['csv', 'ndjson']:
+        log_message('WARNING', f"Invalid export format: {fmt}")
+        abort(400, description="Invalid format. Use 'csv' or 'ndjson'.")
+
+    model_class = IMPORTERS[kind][0]
+    serializer = EXPORT_ROWS[kind]
+    status = request.args.get('status', default='all', type=str)
+    return stream_records(model_class, shard_queries(lambda: row_query(model_class, status, serializer)), serializer, fmt)
+
+@app.cli.command('import-data')
+@click.argument('kind', type=click.Choice(list(IMPORTERS)))
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+def import_data_command(kind, path):
+    """Import books, customers or loans from a .csv or .ndjson file."""
+    with open(path, 'rb') as stream:
+        report = import_records(kind, stream, import_format(path))
+    print(json.dumps(report.to_dict(), indent=2))
+
+# Reports, totalled on a process pool from rows streamed out of every shard
+report_pool = ReportPool(workers=app.config['REPORT_WORKERS'], max_queue=app.config['REPORT_MAX_QUEUE'])
+
+metrics.add_gauge('library_reports', "Report jobs waiting or running in this process's pool, queued and refused.", report_pool.stats)
+
+def database_url(shard=None):
+    """URL another process opens a shard's database with, relative SQLite paths resolved as for this app."""
+    return shard_engine(shard).url.render_as_string(hide_password=False)
+
+def report_path(job_id):
+    return os.path.join(app.config['REPORT_DIR'], f'{job_id}.csv')
+
+def find_report(job_id):
+    job = db.session.get(ReportJob, job_id)
+    if job is None:
+        log_message('WARNING', f"Report not found: {job_id}")
+        abort(404, description="Report not found.")
+    fail_stale_report(job)
+    return job
+
+def fail_stale_report(job):
+    """Mark a running job failed once its pool process wrote no progress for REPORT_STALE_AFTER seconds."""
+    if job.status != 'running' or not app.config['REPORT_STALE_AFTER']:
+        return
+    cutoff = datetime.utcnow() - timedelta(seconds=app.config['REPORT_STALE_AFTER'])
+    if (job.updated_at or job.started_at or job.created_at) >= cutoff:
+        return
+    failed = db.session.execute(
+        update(ReportJob).where(ReportJob.id == job.id, ReportJob.status == 'running',
+                                func.coalesce(ReportJob.updated_at, ReportJob.started_at, ReportJob.created_at) < cutoff)
+        .values(status='failed', finished_at=datetime.utcnow(), error="No progress from the report process; it stopped.")
+    ).rowcount
+    db.session.commit()
+    db.session.refresh(job)
+    if failed:
+        log_message('WARNING', f"Report {job.id} made no progress for {app.config['REPORT_STALE_AFTER']} seconds, marked failed")
+
+def close_reports():
+    """Stop this process's report pool and mark the jobs it dropped cancelled, so none is left queued. Returns their ids."""
+    dropped = report_pool.close()
+    if not dropped:
+        return dropped
+    with app.app_context():
+        with db.engine.begin() as connection:
+            connection.execute(update(ReportJob).where(ReportJob.id.in_(dropped), ReportJob.status == 'queued')
+                               .values(status='cancelled', finished_at=datetime.utcnow()))
+        log_message('WARNING', f"Cancelled {len(dropped)} queued report(s) as the report pool closed")
+    return dropped
+
+def report_json(job):
+    data = job.to_dict()
+    data['download'] = f'/reports/{job.id}/download' if job.status == 'done' else None
+    return data
+
+@app.route('/reports', methods=['POST'])
+@jwt_required()
+def create_report():
+    """Queue a report: overdue, circulation or inventory. Poll GET /reports/<id>, then download the CSV."""
+    data = request.json
+    validate_fields(data, ['kind'])
+    kind = data['kind']
+    if kind not in REPORTS:
+        log_message('ERROR', f"Invalid report kind: {kind}")
+        abort(400, description=f"Invalid report kind. Must be one of: {', '.join(REPORTS)}.")
+
+    os.makedirs(app.config['REPORT_DIR'], exist_ok=True)
+    job = ReportJob(kind=kind)
+    db.session.add(job)
+    db.session.commit()
+    try:
+        report_pool.submit(job.id, kind, database_url(DEFAULT_SHARD), [database_url(shard) for shard in shard_router.names],
+                           report_path(job.id), app.config['REPORT_CHUNK_SIZE'], job.created_at)
+    except ReportsBusy:
+        db.session.delete(job)
+        db.session.commit()
+        log_message('WARNING', "Report pool is saturated")
+        response = jsonify({'error': "Too many reports are being generated, please try again later."})
+        response.status_code = 503
+        response.headers['Retry-After'] = '30'
+        return response
+
+    log_message('INFO', f"Queued {kind} report {job.id}")
+    response = jsonify(report_json(job))
+    response.status_code = 202
+    response.headers['Location'] = f'/reports/{job.id}'
+    return response
+
+@app.route('/reports/<int:job_id>', methods=['GET'])
+@jwt_required()
+def get_report(job_id):
+    """A report job's status and progress, with the download link once it is done."""
+    return jsonify(report_json(find_report(job_id))), 200
 
-    # Transform loans to include books and customer data
-    loan_data = []
-    for loan in loans:
-        loan_info = loan.to_dict()  # Convert loan to dictionary
-        
-        # Ensure book and customer are included if they exist
-        loan_info['book'] = loan.book.to_dict() if loan.book else None  # Access single book
-        loan_info['customer'] = loan.customer.to_dict() if loan.customer else None  # Access customer
-        loan_info['is_active'] = loan.is_active        
-        loan_data.append(loan_info)
+@app.route('/reports/<int:job_id>/download', methods=['GET'])
+@jwt_required()
+def download_report(job_id):
+    """The CSV file of a finished report."""
+    job = find_report(job_id)
+    if job.status != 'done':
+        abort(409, description=f"Report is {job.status}, not done.")
+    return send_file(report_path(job.id), mimetype='text/csv', as_attachment=True, download_name=f'{job.kind}-report-{job.id}.csv')
+
+@app.route('/reports/<int:job_id>', methods=['DELETE'])
+@jwt_required()
+def delete_report(job_id):
+    """Cancel a queued or running report, or delete a finished one and its file."""
+    job = find_report(job_id)
+    if job.status in ('queued', 'running'):
+        if report_pool.cancel(job.id):  # Still waiting in this process's pool
+            job.status, job.finished_at = 'cancelled', datetime.utcnow()
+        else:
+            job.cancel_requested = True  # The pool process stops after its current chunk
+        db.session.commit()
+        log_message('INFO', f"Cancelled report {job.id}")
+        return jsonify(report_json(job)), 202
 
-    return jsonify(loan_data), 200
+    if os.path.exists(report_path(job.id)):
+        os.remove(report_path(job.id))
+    db.session.delete(job)
+    db.session.commit()
+    log_message('INFO', f"Deleted report {job.id}")
+    return jsonify({'message': f"Report '{job.id}' deleted successfully."}), 200
+
+# Schema migrations
+def named_indexes(*names):
+    """Look up Index objects declared on the models by name."""
+    indexes = {index.name: index for table in db.metadata.tables.values() for index in table.indexes}
+    return [indexes[name] for name in names]
+
+def install_sharding(connection):
+    migrations.add_columns(Books.__table__, 'branch')(connection)
+    migrations.create_tables(db.metadata, ShardDirectory.__table__, ShardIdSequence.__table__)(connection)  # Sequences start synced
+
+MIGRATIONS = [
+    migrations.Migration(1, "Create the library tables", migrations.create_tables(
+        db.metadata, User.__table__, TokenBlacklist.__table__, Books.__table__, Customers.__table__, Loans.__table__, Log.__table__
+    )),
+    migrations.Migration(2, "Full-text search indexes", install_search_indexes),
+    migrations.Migration(3, "Indexes for status, due-date and foreign-key filters", migrations.create_indexes(*named_indexes(
+        'ix_books_is_active_id', 'ix_books_is_active_is_loaned', 'ix_customers_is_active_id',
+        'ix_loans_is_active_id', 'ix_loans_is_active_return_date', 'ix_loans_open_return_date',
+        'ix_loans_customer_id_is_active', 'ix_loans_book_id_is_active', 'ix_log_timestamp', 'ix_token_blacklist_created_at'
+    ))),
+    migrations.Migration(4, "Hourly log rollups", migrations.create_tables(db.metadata, LogRollup.__table__)),
+    migrations.Migration(5, "Counters for the /stats endpoints", install_stat_counters),
+    migrations.Migration(6, "Change log for the /changes feed", migrations.create_tables(
+        db.metadata, ChangeLog.__table__, ChangeConsumer.__table__
+    )),
+    migrations.Migration(7, "Book branches, shard directory and per-shard id sequences", install_sharding),
+    migrations.Migration(8, "Report jobs", migrations.create_tables(db.metadata, ReportJob.__table__)),
+    migrations.Migration(9, "Progress time of report jobs", migrations.add_columns(ReportJob.__table__, 'updated_at'))
+]
+
+def upgrade_database():
+    """Bring the schema of every shard up to date. Returns the migration versions applied on any of them."""
+    applied = set()
+    for shard in shard_router.names:
+        applied.update(migrations.upgrade(shard_engine(shard), MIGRATIONS))
+        with shard_engine(shard).begin() as connection:
+            sync_id_sequences(connection)  # Rows may have been added while SHARDS was unset
+    return sorted(applied)
+
+# Listing queries that must be served from an index, as (name, model, status)
+INDEXED_LISTINGS = [
+    ('active books', Books, 'active'), ('inactive books', Books, 'inactive'),
+    ('active customers', Customers, 'active'), ('inactive customers', Customers, 'inactive'),
+    ('active loans', Loans, 'active'), ('inactive loans', Loans, 'inactive'), ('late loans', Loans, 'late')
+]
+
+def check_listing_indexes():
+    """Run EXPLAIN QUERY PLAN on each listing query. Returns (name, uses_index, plan) tuples."""
+    results = []
+    with db.engine.connect() as connection:
+        for name, model_class, status in INDEXED_LISTINGS:
+            statement = (select(model_class).where(*status_filter(model_class, status))
+                         .order_by(model_class.id).limit(app.config['DEFAULT_PAGE_SIZE']))
+            plan = migrations.explain_query_plan(connection, statement)
+            results.append((name, migrations.uses_index(plan, model_class.__tablename__), plan))
+    return results
+
+db_cli = AppGroup('db', help="Database schema commands.")
+
+@db_cli.command('upgrade')
+def upgrade_command():
+    """Apply pending schema migrations."""
+    applied = upgrade_database()
+    print(f"Applied migrations: {applied}" if applied else "Database is up to date.")
+    print(f"Schema version: {migrations.current_version(db.engine)}")
+
+@db_cli.command('check-indexes')
+def check_indexes_command():
+    """Check that every listing query is planned with an index."""
+    failed = False
+    for name, indexed, plan in check_listing_indexes():
+        print(f"{'OK  ' if indexed else 'SCAN'} {name}: {'; '.join(plan)}")
+        failed = failed or not indexed
+    if failed:
+        raise SystemExit(1)
+
+app.cli.add_command(db_cli)
+
+logs_cli = AppGroup('logs', help="Log retention commands.")
+
+@logs_cli.command('rotate')
+def rotate_logs_command():
+    """Roll up completed hours, then archive and delete records past LOG_RETENTION_DAYS."""
+    result = run_log_retention()
+    if result is None:
+        raise SystemExit("Another process is running log retention.")
+    print(f"Added {result[0]} rollup row(s), archived {result[1]} record(s) to {log_archive.directory}.")
+
+@logs_cli.command('query')
+@click.option('--since', help="ISO 8601 start time (inclusive).")
+@click.option('--until', help="ISO 8601 end time (exclusive).")
+@click.option('--level', help="Only records of this level, e.g. ERROR.")
+@click.option('--contains', help="Only records whose message contains this text (case-insensitive).")
+@click.option('--limit', type=int, default=10000, show_default=True)
+def query_logs_command(since, until, level, contains, limit):
+    """Print archived records as NDJSON."""
+    records, truncated = log_archive.query(since and parse_datetime(since), until and parse_datetime(until), level, contains, limit)
+    for record in records:
+        print(json.dumps(record))
+    if truncated:
+        click.echo(f"Stopped after {limit} records; narrow the range or raise --limit.", err=True)
+
+app.cli.add_command(logs_cli)
+
+stats_cli = AppGroup('stats', help="Statistics counter commands.")
+
+@stats_cli.command('rebuild')
+def rebuild_stats_command():
+    """Recount the /stats counters from the books and loans tables, repairing any drift."""
+    drift = rebuild_stats()
+    for (name, key), (old, new) in sorted(drift.items()):
+        print(f"{name}[{key}]: {old} -> {new}")
+    print(f"Rebuilt statistics counters; {len(drift)} had drifted.")
+
+app.cli.add_command(stats_cli)
+
+@app.cli.command('compact-changes')
+def compact_changes_command():
+    """Delete change-log entries every consumer has read or that are past CHANGE_LOG_RETENTION_DAYS."""
+    print(f"Deleted {compact_changes()} change-log entries.")
+
+# Moving branches between shards
+def forget_moved_branches(branches):
+    """Drop what this process derived from the shards' rows once branches moved between them."""
+    for tracker in overdue_trackers.values():
+        tracker.reset()
+    for index in availability_indexes.values():
+        index.reset()
+    entity_cache.clear()
+    response_cache.invalidate('books', 'customers', 'loans')
+    log_message('INFO', f"Branches moved to another shard: {', '.join(sorted(branches))}")
+
+shard_router.subscribe(forget_moved_branches)
+
+def set_branch_shard(branch, shard, moving):
+    """Point a branch at a shard in the directory, flagged while it is being moved."""
+    with db.engine.begin() as connection:
+        updated = connection.execute(
+            update(ShardDirectory).where(ShardDirectory.branch == City[branch]).values(shard=shard, moving=moving)
+        ).rowcount
+        if not updated:
+            connection.execute(insert(ShardDirectory).values(branch=City[branch], shard=shard, moving=moving))
+    shard_router.invalidate()
+
+def recount_stats(shard):
+    transaction_retry.run(shard_engine(shard), lambda connection: stat_counters.replace(connection, count_stats(connection)))
+
+def move_branch(branch, target, wait=None):
+    """Move a branch's customers, books and loans to another shard, keeping their ids. Returns {table: rows moved}.
+
+    The source shard turns read-only first, and the move waits SHARD_DIRECTORY_TTL for every
+    process to notice. Rows are then copied in chunks, deleted from the source, and the directory
+    points the branch at the target. Loans follow their customer; open loans between the branch
+    and other branches stop the move. A failed move leaves the branch where it was and can be re-run.
+    """
+    shard_router.invalidate()
+    source = shard_router.shard_for(branch)
+    if target not in shard_router.names:
+        raise ValueError(f"Unknown shard '{target}'. Shards: {', '.join(shard_router.names)}.")
+    if source == target:
+        raise ValueError(f"Branch {branch} is already on shard '{target}'.")
+
+    set_branch_shard(branch, source, moving=True)
+    moved = False
+    try:
+        time.sleep(app.config['SHARD_DIRECTORY_TTL'] if wait is None else wait)  # No process writes to the source after this
+
+        customers = select(Customers.id).where(Customers.city == City[branch])
+        books = select(Books.id).where(Books.branch == City[branch])
+        with shard_engine(source).connect() as connection:
+            crossing = connection.scalar(select(func.count()).select_from(Loans).where(
+                Loans.is_active.is_(True),
+                or_(and_(Loans.customer_id.in_(customers), Loans.book_id.not_in(books)),
+                    and_(Loans.customer_id.not_in(customers), Loans.book_id.in_(books)))
+            ))
+            if crossing:
+                raise ValueError(f"{crossing} open loan(s) link branch {branch} with other branches; return them first.")
+            ids = {model_class: connection.scalars(query.order_by(model_class.id)).all() for model_class, query in (
+                (Customers, customers), (Books, books), (Loans, select(Loans.id).where(Loans.customer_id.in_(customers))))}
+
+        for model_class, model_ids in ids.items():
+            for chunk in batched(model_ids, app.config['SHARD_MOVE_BATCH_SIZE']):
+                with shard_engine(source).connect() as connection:
+                    rows = [dict(row) for row in connection.execute(select(model_class.__table__).where(model_class.id.in_(chunk))).mappings()]
+                with shard_engine(target).begin() as connection:
+                    connection.execute(delete(model_class).where(model_class.id.in_(chunk)))  # Copies left by an interrupted move
+                    connection.execute(insert(model_class), rows)
+                    record_changes(connection, model_class.__tablename__, 'created', chunk)
+        recount_stats(target)
+
+        for model_class in reversed(list(ids)):
+            for chunk in batched(ids[model_class], app.config['SHARD_MOVE_BATCH_SIZE']):
+                with shard_engine(source).begin() as connection:
+                    connection.execute(delete(model_class).where(model_class.id.in_(chunk)))
+                    record_changes(connection, model_class.__tablename__, 'deleted', chunk)
+        recount_stats(source)
+
+        set_branch_shard(branch, target, moving=False)
+        moved = True
+    finally:
+        if not moved:
+            set_branch_shard(branch, source, moving=False)
+        invalidate_responses('books', 'customers', 'loans')
+    log_message('INFO', f"Moved branch {branch} from shard {source} to {target}.")
+    return {model_class.__tablename__: len(model_ids) for model_class, model_ids in ids.items()}
+
+shards_cli = AppGroup('shards', help="Sharding commands.")
+
+@shards_cli.command('list')
+def list_shards_command():
+    """Show the shards and the branches each one holds."""
+    shard_router.invalidate()
+    directory = shard_router.directory()
+    for shard in shard_router.names:
+        branches = [branch + (' (moving)' if directory.get(branch, (DEFAULT_SHARD, False))[1] else '')
+                    for branch in City.__members__ if shard_router.shard_for(branch) == shard]
+        print(f"{shard}: {', '.join(branches) or '-'}")
+
+@shards_cli.command('move')
+@click.argument('branch', type=click.Choice(list(City.__members__)))
+@click.argument('shard')
+def move_branch_command(branch, shard):
+    """Move a branch's customers, books and loans to another shard."""
+    try:
+        moved = move_branch(branch, shard)
+    except ValueError as error:
+        raise click.ClickException(str(error))
+    print(f"Moved branch {branch} to shard {shard}: " + ', '.join(f"{count} {table}" for table, count in moved.items()) + '.')
+
+app.cli.add_command(shards_cli)
 
 # Database seeding
 def seed_database():
     """Seed the database with initial data."""
-    db.create_all()  # Create all tables if they don't exist
+    upgrade_database()  # Create or migrate the schema
 
     # Seed books
     if Books.query.count() == 0:
@@ -668,6 +2978,12 @@ def seed_database():
         db.session.commit()
         log_message('INFO', "Database seeded with initial loans.")
 
+    invalidate_responses('books', 'customers', 'loans')  # Cached lists may predate this database
+    rebuild_stats()  # The seed rows were inserted without counting them
+    for index in availability_indexes.values():
+        index.reset()  # Nor logged as changes
+    entity_cache.reset()  # The tables may have been recreated, restarting the change log
+
     # Seed superuser
     if User.query.count() == 0:
         superuser = User(username='admin')
@@ -676,7 +2992,12 @@ def seed_database():
         db.session.commit()
         log_message('INFO', "Superuser created.")
 
+@app.cli.command('seed')
+def seed_command():
+    """Apply pending migrations and add the sample books, customers, loans and superuser to empty tables."""
+    seed_database()
+    log_buffer.flush()
+    print("Database seeded.")
+
 if __name__ == '__main__':
-    with app.app_context():
-        seed_database()  # Seed the database when starting the app
-    app.run(debug=True)
\ No newline at end of file
+    app.run(debug=True)  # Development server; schema changes and seeding are the explicit `flask db upgrade` and `flask seed`
\ No newline at end of file
@@ -0,0 +1,38 @@
+"""ASGI entry point serving the routes of app.py.
+
+The views stay synchronous Flask views: a2wsgi runs them on a pool of ASGI_THREADS threads while
+the event loop holds the client connections, so a process keeps accepting requests while others
+wait on the database instead of tying up a whole worker each.
+
+    flask db upgrade
+    uvicorn asgi:application --workers 4
+    gunicorn asgi:application -k uvicorn.workers.UvicornWorker -w 4
+"""
+import asyncio
+
+from a2wsgi import WSGIMiddleware
+
+from app import app, close_reports, log_buffer
+
+
+wsgi_application = WSGIMiddleware(app, workers=app.config['ASGI_THREADS'])
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            # Like gunicorn's worker_exit hook: cancel waiting reports and write out queued log records before the process goes
+            await asyncio.get_running_loop().run_in_executor(wsgi_application.executor, close_reports)
+            await asyncio.get_running_loop().run_in_executor(wsgi_application.executor, log_buffer.close)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+    await wsgi_application(scope, receive, send)
@@ -0,0 +1,128 @@
+from array import array
+from bisect import bisect_left, bisect_right, insort
+import heapq
+from itertools import islice
+import threading
+import time
+
+
+class AvailabilityIndex:
+    """Ids of the books that can be borrowed right now, grouped by (category, loan type).
+
+    Each group is a sorted array of ids, so filtering by both category and loan type reads one
+    group and leaving either out merges the matching groups. A page is found by bisecting to
+    the cursor in each group: a lookup costs O(groups * log n + limit) whatever the catalogue size.
+
+    load_books() returns (seq, books): the latest change-log seq, read first, and (id, category,
+    loan type) for every available book in id order. load_changes(after) returns (oldest, latest,
+    changes): the oldest and latest seq in the change log, and (seq, id, state) for the book
+    changes after `after` up to latest, where state is (category, loan type) or None once the
+    book cannot be borrowed. States are absolute, so applying a change twice is harmless.
+    """
+
+    def __init__(self, categories, loan_types, load_books, load_changes, max_staleness=1.0, rebuild_interval=3600):
+        self.categories = list(categories)
+        self.loan_types = list(loan_types)
+        self.load_books = load_books
+        self.load_changes = load_changes
+        self.max_staleness = max_staleness
+        self.rebuild_interval = rebuild_interval
+        self._category_index = {name: index for index, name in enumerate(self.categories)}
+        self._loan_type_index = {name: index for index, name in enumerate(self.loan_types)}
+
+        self._lock = threading.Lock()  # Guards the groups
+        self._refresh_lock = threading.Lock()  # One thread loads from the database at a time
+        self._groups = [array('q') for _ in range(len(self.categories) * len(self.loan_types))]
+        self._group_of = {}  # Book id -> group, for the available books only; ids can be sparse, e.g. 2**40 up on a shard
+        self.seq = 0
+        self._rebuilt_at = None
+        self._refreshed_at = 0.0
+        self._stale = True
+
+        self.rebuilds = 0
+        self.refreshes = 0
+        self.changes_applied = 0
+
+    def mark_stale(self):
+        """Catch up on the next lookup rather than after max_staleness, e.g. after this process wrote to books."""
+        self._stale = True
+
+    def reset(self):
+        """Rebuild from the database on the next refresh, e.g. after books were written without logging changes."""
+        self._rebuilt_at = None
+
+    def refresh(self):
+        """Rebuild when due, else apply the changes logged since the last look once the index may be stale."""
+        with self._refresh_lock:
+            now = time.monotonic()
+            if self._rebuilt_at is None or now - self._rebuilt_at >= self.rebuild_interval:
+                self._rebuild()
+            elif not self._stale and now - self._refreshed_at < self.max_staleness:
+                return
+
+            self._stale = False  # Cleared before loading, so a write during the load marks it again
+            oldest, latest, changes = self.load_changes(self.seq)
+            if oldest is not None and self.seq < oldest - 1:
+                # Compaction removed changes we never saw
+                self._rebuild()
+                oldest, latest, changes = self.load_changes(self.seq)
+
+            with self._lock:
+                for _, book_id, state in changes:
+                    self._move(book_id, self._group(*state) if state else -1)
+                self.seq = max(self.seq, latest or 0)
+            self.changes_applied += len(changes)
+            self.refreshes += 1
+            self._refreshed_at = now
+
+    def available(self, category=None, loan_type=None, after=0, limit=100):
+        """(ids, total): up to `limit` available ids above `after` in id order, and how many match in all."""
+        with self._lock:
+            groups = [self._groups[group] for group in self._matching(category, loan_type)]
+            total = sum(len(ids) for ids in groups)
+            pages = []
+            for ids in groups:
+                start = bisect_right(ids, after)
+                pages.append(ids[start:start + limit])
+        return list(islice(heapq.merge(*pages), limit)), total
+
+    def stats(self):
+        return {'available': sum(len(ids) for ids in self._groups), 'seq': self.seq, 'rebuilds': self.rebuilds,
+                'refreshes': self.refreshes, 'changes_applied': self.changes_applied}
+
+    def _rebuild(self):
+        seq, books = self.load_books()
+        groups = [array('q') for _ in self._groups]
+        group_of = {}
+        for book_id, category, loan_type in books:
+            group = self._group(category, loan_type)
+            groups[group].append(book_id)
+            group_of[book_id] = group
+
+        with self._lock:
+            self._groups, self._group_of, self.seq = groups, group_of, seq
+        self._rebuilt_at = time.monotonic()
+        self.rebuilds += 1
+
+    def _group(self, category, loan_type):
+        return self._category_index[category] * len(self.loan_types) + self._loan_type_index[loan_type]
+
+    def _matching(self, category, loan_type):
+        categories = [self._category_index[category]] if category else range(len(self.categories))
+        loan_types = [self._loan_type_index[loan_type]] if loan_type else range(len(self.loan_types))
+        return [c * len(self.loan_types) + t for c in categories for t in loan_types]
+
+    def _move(self, book_id, group):
+        old = self._group_of.get(book_id, -1)
+        if old == group:
+            return
+        if old >= 0:
+            ids = self._groups[old]
+            position = bisect_left(ids, book_id)
+            if position < len(ids) and ids[position] == book_id:
+                del ids[position]
+        if group >= 0:
+            insort(self._groups[group], book_id)
+            self._group_of[book_id] = group
+        else:
+            del self._group_of[book_id]
@@ -0,0 +1,47 @@
+import threading
+
+
+class PeriodicTask:
+    """Run a function every `interval` seconds on a daemon thread."""
+
+    def __init__(self, name, interval, func):
+        self.name = name
+        self.interval = interval
+        self.func = func
+        self.runs = 0
+        self.errors = 0
+        self.last_error = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        """Start the task if it is not already running."""
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+        return self
+
+    def stop(self, timeout=5.0):
+        """Ask the task to stop and wait for the current run to finish."""
+        self._stop.set()
+        thread = self._thread
+        if thread is not None and thread.is_alive() and thread is not threading.current_thread():
+            thread.join(timeout=timeout)
+
+    def run_once(self):
+        """Run the function now on the calling thread, recording any failure."""
+        try:
+            result = self.func()
+        except Exception as exc:
+            self.errors += 1
+            self.last_error = repr(exc)
+            return None
+        self.runs += 1
+        return result
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.run_once()
@@ -0,0 +1,74 @@
+"""Lookup and update latency of the in-memory availability index behind /books/available.
+
+Builds the index from a synthetic catalogue, without a database, then times pages of ids for
+each kind of filter from random cursors, and single-book moves as checkouts and returns apply them.
+
+    python -m benchmarks.availability --books 1m --lookups 2000
+"""
+import argparse
+import random
+import time
+
+from benchmarks import datasets
+from benchmarks.results import summarize
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--books', default='1m', help="Titles in the catalogue: 10k, 100k, 1m or a number (default 1m)")
+    parser.add_argument('--available', type=float, default=0.7, help="Share of the titles that can be borrowed (default 0.7)")
+    parser.add_argument('--lookups', type=int, default=2000, help="Timed operations of each kind (default 2000)")
+    parser.add_argument('--limit', type=int, default=100, help="Page size (default 100)")
+    args = parser.parse_args(argv)
+
+    from app import BookCategory, LoanType
+    from availability import AvailabilityIndex
+
+    rng = random.Random(42)
+    count = datasets.parse_size(args.books)
+    categories, loan_types = list(BookCategory.__members__), list(LoanType.__members__)
+    books = [(book_id, rng.choice(categories), rng.choice(loan_types))
+             for book_id in range(1, count + 1) if rng.random() < args.available]
+    changes = []
+    index = AvailabilityIndex(categories, loan_types, lambda: (0, books),
+                              lambda after: (None, len(changes), changes), max_staleness=0)
+
+    started = time.perf_counter()
+    index.refresh()
+    print(f"Built the index of {len(books)} available books out of {count} in {time.perf_counter() - started:.2f}s")
+
+    lookups = [
+        ('category + loan type', lambda: (rng.choice(categories), rng.choice(loan_types))),
+        ('category', lambda: (rng.choice(categories), None)),
+        ('loan type', lambda: (None, rng.choice(loan_types))),
+        ('no filter', lambda: (None, None)),
+    ]
+    print(f"{'operation':<24}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for name, filters in lookups:
+        latencies = []
+        for _ in range(args.lookups):
+            category, loan_type = filters()
+            after = rng.randint(0, count)
+            started = time.perf_counter()
+            index.available(category, loan_type, after, args.limit)
+            latencies.append(time.perf_counter() - started)
+        report(name, latencies)
+
+    latencies = []
+    for seq in range(1, args.lookups + 1):
+        book_id = rng.randint(1, count)
+        changes[:] = [(seq, book_id, (rng.choice(categories), rng.choice(loan_types)) if seq % 2 else None)]
+        index.mark_stale()
+        started = time.perf_counter()
+        index.refresh()
+        latencies.append(time.perf_counter() - started)
+    report('apply one change', latencies)
+
+
+def report(name, latencies):
+    summary = summarize(latencies, sum(latencies))
+    print(f"{name:<24}{summary['p50_ms']:>10.3f}{summary['p99_ms']:>10.3f}{summary['max_ms']:>10.3f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""Concurrency per process: the sync Procfile setup against the ASGI entry point.
+
+Starts one process of each server in turn: `gunicorn app:app` with a single sync worker (the
+Procfile), and `uvicorn asgi:application` with a single worker. Both are driven over HTTP at
+increasing client concurrency, and the report gives throughput and latency at each level.
+Paginated /books and /loans listings are requested with the response cache off, so every
+request reaches the database. --db-latency-ms adds a simulated network round trip to every SQL
+statement (benchmarks/slow_db.py), as with a database server instead of a local SQLite file.
+
+    python -m benchmarks.concurrency --size 100k --levels 1,16,64 --requests 400
+    python -m benchmarks.concurrency --db-latency-ms 5
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+
+from benchmarks import datasets, results
+from benchmarks.routes import HttpClient, free_port, run_route, start_server
+
+
+def server_command(mode, port, db_latency_ms=0):
+    module = 'benchmarks.slow_db' if db_latency_ms else None
+    if mode == 'sync':
+        return [sys.executable, '-m', 'gunicorn', '-w', '1', '-b', f'127.0.0.1:{port}', f'{module or "app"}:app']
+    return [sys.executable, '-m', 'uvicorn', '--workers', '1', '--host', '127.0.0.1', '--port', str(port),
+            '--no-access-log', f'{module or "asgi"}:application']
+
+
+def make_requests(size, seed=42):
+    """Paginated listings starting at random cursors."""
+    from app import encode_cursor
+    rng = random.Random(seed)
+
+    def make_request(i):
+        path = '/books' if i % 2 else '/loans'
+        after = encode_cursor(rng.randint(0, size))
+        return 'GET', f'{path}?status=all&limit=50&after={after}', None, None
+    return make_request
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', default='10k', help="Rows per table: 10k, 100k, 1m or a number (default 10k)")
+    parser.add_argument('--levels', default='1,16,64', help="Comma-separated client concurrency levels (default 1,16,64)")
+    parser.add_argument('--requests', type=int, default=400, help="Requests per level (default 400)")
+    parser.add_argument('--modes', default='sync,asgi', help="Servers to compare: sync, asgi (default both)")
+    parser.add_argument('--db-latency-ms', type=float, default=0, help="Simulated round trip per SQL statement (default 0)")
+    parser.add_argument('--database', help="SQLite file to use (default: a temporary file)")
+    parser.add_argument('--skip-seed', action='store_true', help="Reuse the data already in --database")
+    args = parser.parse_args(argv)
+
+    database = args.database or os.path.join(tempfile.mkdtemp(), 'bench.db')
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.abspath(database)
+    os.environ.setdefault('JWT_BLOCKLIST_CHANNEL', database + '.channel')
+    os.environ['RESPONSE_CACHE_ENABLED'] = '0'  # Every request should reach the database
+    os.environ['BENCH_DB_LATENCY_MS'] = str(args.db_latency_ms)
+
+    import app as library  # Imported after DATABASE_URL is set
+
+    size = datasets.parse_size(args.size)
+    if not args.skip_seed:
+        datasets.seed(library, books=size, customers=size, loans=size // 2)
+
+    summaries = {}
+    for mode in args.modes.split(','):
+        port = free_port()
+        process = start_server(server_command(mode, port, args.db_latency_ms), port, dict(os.environ))
+        try:
+            for level in [int(level) for level in args.levels.split(',')]:
+                summaries[f'{mode} c={level}'], _ = run_route(
+                    HttpClient('127.0.0.1', port), mode, args.requests, level, make_requests(size))
+        finally:
+            process.terminate()
+            process.wait(timeout=30)
+
+    results.print_table(summaries)
+
+
+if __name__ == '__main__':
+    main()
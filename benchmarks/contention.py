@@ -0,0 +1,140 @@
+"""Contention test for loan checkout: many clients fight over a handful of books.
+
+Each client repeatedly checks out a random book from a small pool and returns it when the
+checkout succeeds. Afterwards the loans table is audited: a book may never have two active
+loans, nor a loan that starts before the previous loan of the same book was returned.
+
+    python -m benchmarks.contention --books 20 --requests 2000 --concurrency 32
+    python -m benchmarks.contention --books 20 --requests 5000 --concurrency 64 --gunicorn --workers 8
+"""
+import argparse
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import os
+import random
+import tempfile
+import threading
+import time
+
+from benchmarks import datasets, results
+from benchmarks.routes import HttpClient, InProcessClient, start_gunicorn
+
+
+def run_checkouts(client, auth, book_ids, customer_ids, requests, concurrency, seed=42):
+    """Fire `requests` checkouts at random books, returning each successful loan. Returns (statuses, summary)."""
+    statuses = Counter()
+    latencies = []
+    lock = threading.Lock()
+
+    def call(i):
+        rng = random.Random(seed + i)
+        body = {'customer_id': rng.choice(customer_ids), 'book_id': rng.choice(book_ids), 'loan_time_type': 'ONE_DAY'}
+        started = time.perf_counter()
+        try:
+            status, data = client.request('POST', '/loan', body, auth)
+        except Exception:
+            status, data = None, None
+        elapsed = time.perf_counter() - started
+        if status == 201:
+            client.request('POST', f"/return/{data['id']}", None, auth)  # Free the book for the next round
+        with lock:
+            statuses[status] += 1
+            latencies.append(elapsed)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(call, range(requests)))
+    elapsed = time.perf_counter() - started
+    errors = sum(count for status, count in statuses.items() if status is None or status >= 500)
+    return statuses, results.summarize(latencies, elapsed, errors)
+
+
+def audit_loans(library, book_ids):
+    """Problems found in the loans of the contended books: overlapping or doubled loans."""
+    problems = []
+    with library.app.app_context():
+        loans = (library.db.session.query(library.Loans.book_id, library.Loans.id, library.Loans.loan_date,
+                                          library.Loans.return_date, library.Loans.is_active)
+                 .filter(library.Loans.book_id.in_(book_ids))
+                 .order_by(library.Loans.book_id, library.Loans.loan_date, library.Loans.id)
+                 .all())
+        loaned = dict(library.db.session.query(library.Books.id, library.Books.is_loaned)
+                      .filter(library.Books.id.in_(book_ids)).all())
+
+    by_book = {}
+    for loan in loans:
+        by_book.setdefault(loan.book_id, []).append(loan)
+    for book_id, book_loans in by_book.items():
+        active = [loan.id for loan in book_loans if loan.is_active]
+        if len(active) > 1:
+            problems.append(f'book {book_id} has {len(active)} active loans: {active}')
+        if bool(active) != bool(loaned.get(book_id)):
+            problems.append(f'book {book_id} is_loaned={loaned.get(book_id)} with active loans {active}')
+        for previous, loan in zip(book_loans, book_loans[1:]):
+            if previous.is_active or previous.return_date > loan.loan_date:
+                problems.append(f'book {book_id}: loan {loan.id} started before loan {previous.id} was returned')
+    return problems, len(loans)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--books', type=int, default=20, help="Books the clients compete for (default 20)")
+    parser.add_argument('--customers', type=int, default=1000, help="Customers to borrow as (default 1000)")
+    parser.add_argument('--requests', type=int, default=2000, help="Checkout attempts (default 2000)")
+    parser.add_argument('--concurrency', type=int, default=32, help="Concurrent clients (default 32)")
+    parser.add_argument('--database', help="SQLite file to use (default: a temporary file)")
+    parser.add_argument('--gunicorn', action='store_true', help="Benchmark a gunicorn server instead of the in-process app")
+    parser.add_argument('--workers', type=int, default=8, help="gunicorn workers (default 8)")
+    parser.add_argument('--threads', type=int, default=1, help="gunicorn threads per worker (default 1)")
+    parser.add_argument('--app', default='app:app', help="gunicorn application (default app:app)")
+    args = parser.parse_args(argv)
+
+    database = args.database or os.path.join(tempfile.mkdtemp(), 'bench.db')
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.abspath(database)
+    os.environ.setdefault('JWT_BLOCKLIST_CHANNEL', database + '.channel')
+    os.environ.setdefault('RESPONSE_CACHE_SHARED_PATH', database + '.cache')
+
+    import app as library  # Imported after DATABASE_URL is set
+
+    datasets.seed(library, books=args.books, customers=args.customers, loans=0)
+    with library.app.app_context():
+        library.db.session.query(library.Books).update({'is_active': True, 'is_loaned': False})
+        library.db.session.commit()
+        book_ids = [book_id for (book_id,) in library.db.session.query(library.Books.id)]
+        customer_ids = [customer_id for (customer_id,) in library.db.session.query(library.Customers.id)]
+
+    process = None
+    if args.gunicorn:
+        process, port = start_gunicorn(args, dict(os.environ))
+        client = HttpClient('127.0.0.1', port)
+    else:
+        client = InProcessClient(library)
+
+    try:
+        status, data = client.request('POST', '/login', {'username': 'bench', 'password': 'bench'})
+        if status != 200:
+            raise SystemExit(f'Login failed with status {status}.')
+        auth = {'Authorization': f"Bearer {data['access_token']}"}
+        statuses, summary = run_checkouts(client, auth, book_ids, customer_ids, args.requests, args.concurrency)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait(timeout=30)
+
+    results.print_table({'POST /loan (contended)': summary})
+    print('Statuses: ' + ', '.join(f'{status}: {count}' for status, count in sorted(statuses.items(), key=str)))
+    if not args.gunicorn:
+        print(f'Transactions: {library.transaction_retry.stats()}')
+
+    problems, loans = audit_loans(library, book_ids)
+    if statuses[201] != loans:
+        problems.append(f'{statuses[201]} checkouts succeeded but {loans} loans were written')
+    for problem in problems:
+        print('DOUBLE LOAN: ' + problem)
+    if problems:
+        raise SystemExit(1)
+    print(f'Audited {loans} loans of {len(book_ids)} books: no double loans.')
+
+
+if __name__ == '__main__':
+    main()
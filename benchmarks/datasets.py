@@ -0,0 +1,112 @@
+"""Synthetic library datasets for benchmarks, inserted with batched executemany."""
+from datetime import datetime, timedelta
+import random
+
+from sqlalchemy import insert
+
+SIZES = {'10k': 10_000, '100k': 100_000, '1m': 1_000_000}
+CHUNK_SIZE = 10_000
+
+FIRST_NAMES = ['John', 'Jane', 'Alice', 'Bob', 'Charlie', 'Diana', 'Ethan', 'Fiona', 'George', 'Hannah']
+LAST_NAMES = ['Doe', 'Smith', 'Johnson', 'Brown', 'Davis', 'Evans', 'Green', 'Harris', 'King', 'Lee']
+TITLE_WORDS = ['Shadow', 'River', 'Empire', 'Garden', 'Winter', 'Stone', 'Crown', 'Letter', 'Machine', 'Island']
+
+
+def parse_size(value):
+    """Accept '10k', '100k', '1m' or a plain number of rows."""
+    return SIZES.get(value.lower()) or int(value)
+
+
+def generate_books(count, rng, LoanType, BookCategory):
+    loan_types = list(LoanType)
+    categories = list(BookCategory)
+    for i in range(1, count + 1):
+        yield {
+            'name': f'{rng.choice(TITLE_WORDS)} {rng.choice(TITLE_WORDS)} {i}',
+            'author': f'{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}',
+            'year_published': rng.randint(1800, 2024),
+            'loan_time_type': rng.choice(loan_types),
+            'category': rng.choice(categories),
+            'is_active': rng.random() > 0.05,
+            'is_loaned': False
+        }
+
+
+def generate_customers(count, rng, City):
+    cities = list(City)
+    for i in range(1, count + 1):
+        first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+        yield {
+            'full_name': f'{first} {last}',
+            'email': f'{first.lower()}.{last.lower()}{i}@example.com',
+            'city': rng.choice(cities),
+            'age': rng.randint(16, 90),
+            'is_active': rng.random() > 0.05
+        }
+
+
+def generate_loans(count, book_count, customer_count, rng, LoanType):
+    """Loans over distinct books: a third returned, a tenth overdue, the rest active and on time."""
+    loan_types = list(LoanType)
+    now = datetime.utcnow()
+    for book_id in rng.sample(range(1, book_count + 1), min(count, book_count)):
+        loan_type = rng.choice(loan_types)
+        days = int(loan_type.value.split()[0])
+        roll = rng.random()
+        if roll < 0.33:
+            loan_date = now - timedelta(days=rng.randint(days + 1, 400))
+            is_active = False
+        elif roll < 0.43:
+            loan_date = now - timedelta(days=days + rng.randint(1, 30))
+            is_active = True
+        else:
+            loan_date = now - timedelta(days=rng.randint(0, days - 1) if days > 1 else 0)
+            is_active = True
+        yield {
+            'customer_id': rng.randint(1, customer_count),
+            'book_id': book_id,
+            'loan_time_type': loan_type,
+            'loan_date': loan_date,
+            'return_date': loan_date + timedelta(days=days),
+            'is_active': is_active
+        }
+
+
+def insert_chunked(connection, table, rows):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= CHUNK_SIZE:
+            connection.execute(insert(table), chunk)
+            chunk = []
+    if chunk:
+        connection.execute(insert(table), chunk)
+
+
+def seed(library, books, customers, loans, seed=42):
+    """Create the schema and fill it with synthetic rows. `library` is the imported app module."""
+    rng = random.Random(seed)
+    with library.app.app_context():
+        library.db.drop_all()
+        library.db.create_all()
+        with library.db.engine.begin() as connection:
+            insert_chunked(connection, library.Books.__table__, generate_books(books, rng, library.LoanType, library.BookCategory))
+            insert_chunked(connection, library.Customers.__table__, generate_customers(customers, rng, library.City))
+            loan_rows = list(generate_loans(loans, books, customers, rng, library.LoanType))
+            insert_chunked(connection, library.Loans.__table__, loan_rows)
+
+            # Books with an active loan are out
+            active_book_ids = [row['book_id'] for row in loan_rows if row['is_active']]
+            for start in range(0, len(active_book_ids), CHUNK_SIZE):
+                connection.execute(
+                    library.Books.__table__.update()
+                    .where(library.Books.id.in_(active_book_ids[start:start + CHUNK_SIZE]))
+                    .values(is_loaned=True)
+                )
+
+        library.rebuild_stats()  # Rows inserted in bulk are not counted as they go
+
+        user = library.User(username='bench')
+        user.set_password('bench')
+        library.db.session.add(user)
+        library.db.session.commit()
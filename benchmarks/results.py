@@ -0,0 +1,76 @@
+"""Latency summaries and JSON baselines shared by the benchmark scripts."""
+import json
+import platform
+from datetime import datetime, timezone
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def summarize(latencies, elapsed, errors=0, queries=None):
+    """Summarize one route's latencies (seconds) measured over `elapsed` wall-clock seconds."""
+    values = sorted(latencies)
+    summary = {
+        'requests': len(values),
+        'errors': errors,
+        'throughput_rps': round(len(values) / elapsed, 2) if elapsed else None,
+        'p50_ms': _ms(percentile(values, 0.50)),
+        'p95_ms': _ms(percentile(values, 0.95)),
+        'p99_ms': _ms(percentile(values, 0.99)),
+        'max_ms': _ms(values[-1] if values else None)
+    }
+    if queries is not None:
+        summary['queries_per_request'] = round(queries / len(values), 2) if values else None
+    return summary
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 3)
+
+
+def save(path, results, settings):
+    """Write results and the settings that produced them as a JSON baseline."""
+    document = {
+        'created_at': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'settings': settings,
+        'results': results
+    }
+    with open(path, 'w') as output:
+        json.dump(document, output, indent=2)
+
+
+def compare(path, results, tolerance=0.2, metric='p95_ms'):
+    """Print each result against a saved baseline. Returns the names that regressed by more than tolerance."""
+    with open(path) as baseline_file:
+        baseline = json.load(baseline_file)['results']
+
+    regressions = []
+    for name, current in results.items():
+        previous = baseline.get(name)
+        if not previous or previous.get(metric) in (None, 0) or current.get(metric) is None:
+            print(f'{name:<28} {metric}: {current.get(metric)} (no baseline)')
+            continue
+        change = (current[metric] - previous[metric]) / previous[metric]
+        flag = 'REGRESSION' if change > tolerance else ''
+        print(f'{name:<28} {metric}: {previous[metric]} -> {current[metric]} ({change:+.1%}) {flag}')
+        if flag:
+            regressions.append(name)
+    return regressions
+
+
+def print_table(results):
+    print(f"{'route':<28}{'reqs':>7}{'err':>5}{'rps':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'queries':>9}")
+    for name, summary in results.items():
+        print(f"{name:<28}{summary['requests']:>7}{summary['errors']:>5}{_fmt(summary['throughput_rps']):>10}"
+              f"{_fmt(summary['p50_ms']):>10}{_fmt(summary['p95_ms']):>10}{_fmt(summary['p99_ms']):>10}"
+              f"{_fmt(summary.get('queries_per_request')):>9}")
+
+
+def _fmt(value):
+    return '-' if value is None else f'{value:g}'
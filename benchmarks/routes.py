@@ -0,0 +1,252 @@
+"""Load test for the main routes of app.py.
+
+Seeds a synthetic dataset, drives each route with concurrent clients, either in-process
+through the Flask test client or over HTTP against gunicorn, and reports p50/p95/p99 latency,
+throughput and (in-process) SQL statements per request.
+
+    python -m benchmarks.routes --size 10k --requests 200 --concurrency 8
+    python -m benchmarks.routes --size 100k --gunicorn --workers 4 --save baseline.json
+    python -m benchmarks.routes --size 100k --compare baseline.json
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import http.client
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from benchmarks import datasets, results
+
+
+ROUTES = ['GET /books', 'GET /loans?status=late', 'POST /book/search', 'POST /loan', 'POST /return/<id>', 'POST /login']
+
+
+class InProcessClient:
+    """Calls the app through Flask test clients, one per thread."""
+
+    def __init__(self, library):
+        self.library = library
+        self._local = threading.local()
+
+    def request(self, method, path, body=None, headers=None):
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = self.library.app.test_client()
+        response = client.open(path, method=method, json=body, headers=headers)
+        return response.status_code, response.get_json(silent=True)
+
+
+class HttpClient:
+    """Calls a running server over HTTP, one keep-alive connection per thread."""
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self._local = threading.local()
+
+    def request(self, method, path, body=None, headers=None):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._local.connection = http.client.HTTPConnection(self.host, self.port, timeout=60)
+        headers = dict(headers or {})
+        payload = None
+        if body is not None:
+            payload = json.dumps(body)
+            headers['Content-Type'] = 'application/json'
+        try:
+            connection.request(method, path, body=payload, headers=headers)
+            response = connection.getresponse()
+            data = response.read()
+        except (http.client.HTTPException, OSError):
+            self._local.connection = None
+            raise
+        try:
+            return response.status, json.loads(data) if data else None
+        except ValueError:
+            return response.status, None
+
+
+class QueryCounter:
+    """Counts SQL statements issued on benchmark threads while counting is switched on."""
+
+    def __init__(self, engine):
+        from sqlalchemy import event
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.count = 0
+        event.listen(engine, 'before_cursor_execute', self._on_execute)
+
+    def _on_execute(self, *args):
+        if getattr(self._local, 'active', False):
+            with self._lock:
+                self.count += 1
+
+    def active(self, value):
+        self._local.active = value
+
+
+def run_route(client, name, requests, concurrency, make_request, counter=None):
+    """Fire `requests` calls built by make_request(i) with `concurrency` threads and summarize them."""
+    latencies, errors, responses = [], 0, []
+    lock = threading.Lock()
+    if counter:
+        counter.count = 0
+
+    def call(i):
+        nonlocal errors
+        method, path, body, headers = make_request(i)
+        if counter:
+            counter.active(True)
+        started = time.perf_counter()
+        try:
+            status, data = client.request(method, path, body, headers)
+        except Exception:
+            status, data = None, None
+        elapsed = time.perf_counter() - started
+        if counter:
+            counter.active(False)
+        with lock:
+            latencies.append(elapsed)
+            responses.append(data)
+            if status is None or status >= 400:
+                errors += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(call, range(requests)))
+    elapsed = time.perf_counter() - started
+
+    return results.summarize(latencies, elapsed, errors, counter.count if counter else None), responses
+
+
+def run_suite(client, library, args, counter=None):
+    """Run every route in ROUTES and return {route: summary}."""
+    status, data = client.request('POST', '/login', {'username': 'bench', 'password': 'bench'})
+    if status != 200:
+        raise SystemExit(f'Login failed with status {status}.')
+    auth = {'Authorization': f"Bearer {data['access_token']}"}
+
+    # Pick free books and customers for the checkout phase up front
+    with library.app.app_context():
+        free_books = [book_id for (book_id,) in library.db.session.query(library.Books.id)
+                      .filter_by(is_active=True, is_loaned=False).limit(args.requests)]
+        customer_ids = [customer_id for (customer_id,) in library.db.session.query(library.Customers.id).limit(1000)]
+        book_names = [name for (name,) in library.db.session.query(library.Books.name).limit(1000)]
+    if len(free_books) < args.requests:
+        raise SystemExit('Not enough free books for the checkout phase; use a larger --size.')
+
+    summaries = {}
+    summaries['GET /books'], _ = run_route(
+        client, 'GET /books', args.requests, args.concurrency,
+        lambda i: ('GET', '/books', None, None), counter)
+    summaries['GET /loans?status=late'], _ = run_route(
+        client, 'GET /loans?status=late', args.requests, args.concurrency,
+        lambda i: ('GET', '/loans?status=late', None, None), counter)
+    summaries['POST /book/search'], _ = run_route(
+        client, 'POST /book/search', args.requests, args.concurrency,
+        lambda i: ('POST', '/book/search', {'name': book_names[i % len(book_names)]}, None), counter)
+    summaries['POST /loan'], loans = run_route(
+        client, 'POST /loan', args.requests, args.concurrency,
+        lambda i: ('POST', '/loan', {'customer_id': customer_ids[i % len(customer_ids)], 'book_id': free_books[i],
+                                     'loan_time_type': 'TEN_DAYS'}, auth), counter)
+
+    loan_ids = [loan['id'] for loan in loans if loan and 'id' in loan]
+    summaries['POST /return/<id>'], _ = run_route(
+        client, 'POST /return/<id>', len(loan_ids), args.concurrency,
+        lambda i: ('POST', f'/return/{loan_ids[i]}', None, auth), counter)
+    summaries['POST /login'], _ = run_route(
+        client, 'POST /login', args.requests, args.concurrency,
+        lambda i: ('POST', '/login', {'username': 'bench', 'password': 'bench'}, None), counter)
+    return summaries
+
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+def start_server(command, port, env):
+    """Start a server process listening on port and wait until it answers."""
+    process = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return process
+        except OSError:
+            time.sleep(0.2)
+    process.terminate()
+    raise SystemExit(f'{command[2]} did not start.')
+
+
+def start_gunicorn(args, env):
+    """Start gunicorn on a free port and wait until it answers."""
+    port = free_port()
+    command = [sys.executable, '-m', 'gunicorn', '-w', str(args.workers), '--threads', str(args.threads),
+               '-b', f'127.0.0.1:{port}', args.app]
+    return start_server(command, port, env), port
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', default='10k', help="Rows per table: 10k, 100k, 1m or a number (default 10k)")
+    parser.add_argument('--requests', type=int, default=200, help="Requests per route (default 200)")
+    parser.add_argument('--concurrency', type=int, default=8, help="Concurrent clients (default 8)")
+    parser.add_argument('--database', help="SQLite file to use (default: a temporary file)")
+    parser.add_argument('--skip-seed', action='store_true', help="Reuse the data already in --database")
+    parser.add_argument('--gunicorn', action='store_true', help="Benchmark a gunicorn server instead of the in-process app")
+    parser.add_argument('--workers', type=int, default=4, help="gunicorn workers (default 4)")
+    parser.add_argument('--threads', type=int, default=1, help="gunicorn threads per worker (default 1)")
+    parser.add_argument('--app', default='app:app', help="gunicorn application (default app:app)")
+    parser.add_argument('--save', help="Write the results to this JSON file")
+    parser.add_argument('--compare', help="Compare against a JSON baseline written with --save")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="p95 increase flagged as a regression (default 0.2)")
+    args = parser.parse_args(argv)
+
+    database = args.database or os.path.join(tempfile.mkdtemp(), 'bench.db')
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.abspath(database)
+    os.environ.setdefault('JWT_BLOCKLIST_CHANNEL', database + '.channel')
+    os.environ.setdefault('LOGIN_RATE_LIMIT_ENABLED', '0')  # The /login route logs in the same user repeatedly
+
+    import app as library  # Imported after DATABASE_URL is set
+
+    size = datasets.parse_size(args.size)
+    if not args.skip_seed:
+        started = time.perf_counter()
+        datasets.seed(library, books=size, customers=size, loans=size // 2)
+        print(f'Seeded {size} books, {size} customers and {size // 2} loans in {time.perf_counter() - started:.1f}s')
+
+    if args.gunicorn:
+        process, port = start_gunicorn(args, dict(os.environ))
+        try:
+            summaries = run_suite(HttpClient('127.0.0.1', port), library, args)
+        finally:
+            process.terminate()
+            process.wait(timeout=30)
+    else:
+        with library.app.app_context():
+            counter = QueryCounter(library.db.engine)
+        summaries = run_suite(InProcessClient(library), library, args, counter)
+
+    results.print_table(summaries)
+
+    settings = {'size': size, 'requests': args.requests, 'concurrency': args.concurrency,
+                'mode': 'gunicorn' if args.gunicorn else 'in-process',
+                'workers': args.workers if args.gunicorn else None}
+    if args.save:
+        results.save(args.save, summaries, settings)
+    if args.compare:
+        regressions = results.compare(args.compare, summaries, args.tolerance)
+        if regressions:
+            raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""Throughput of the /loans serialization paths, in bytes of JSON produced per second.
+
+Compares the ORM path the listings used to take (joinedload + to_dict() + stdlib json), the
+row-tuple serializers with the stdlib encoder, the row-tuple serializers with the app's JSON
+provider (orjson when installed), and the /loans route end to end with the response cache off.
+
+    python -m benchmarks.serialization --loans 100k
+    python -m benchmarks.serialization --loans 100k --repeat 5 --database /tmp/bench.db --skip-seed
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+
+from benchmarks import datasets
+
+
+def legacy_loans(library):
+    from sqlalchemy.orm import joinedload
+    loans = library.Loans.query.options(joinedload(library.Loans.book), joinedload(library.Loans.customer)).all()
+    data = []
+    for loan in loans:
+        loan_info = loan.to_dict()
+        loan_info['book'] = loan.book.to_dict() if loan.book else None
+        loan_info['customer'] = loan.customer.to_dict() if loan.customer else None
+        data.append(loan_info)
+    return json.dumps(data, sort_keys=True).encode()
+
+
+def row_loans(library, dumps):
+    serializer = library.LOAN_DETAILS_ROW
+    rows = library.row_query(library.Loans, 'all', serializer, library.LOAN_DETAILS_JOINS).all()
+    return dumps([serializer(row) for row in rows]).encode()
+
+
+def route_loans(library, client):
+    response = client.get('/loans?status=all')
+    assert response.status_code == 200, response.status_code
+    return response.data
+
+
+def measure(func, repeat):
+    """Best of `repeat` runs: (seconds, bytes produced)."""
+    best, size = None, 0
+    for _ in range(repeat):
+        started = time.perf_counter()
+        size = len(func())
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, size
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--loans', default='100k', help="Loans to serialize: 10k, 100k, 1m or a number (default 100k)")
+    parser.add_argument('--repeat', type=int, default=3, help="Runs per path, the best one is reported (default 3)")
+    parser.add_argument('--database', help="SQLite file to use (default: a temporary file)")
+    parser.add_argument('--skip-seed', action='store_true', help="Reuse the data already in --database")
+    args = parser.parse_args(argv)
+
+    database = args.database or os.path.join(tempfile.mkdtemp(), 'bench.db')
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.abspath(database)
+    os.environ.setdefault('JWT_BLOCKLIST_CHANNEL', database + '.channel')
+    os.environ['RESPONSE_CACHE_ENABLED'] = '0'  # Measure the work, not the cache
+
+    import app as library  # Imported after DATABASE_URL is set
+    from serializers import json_backend
+
+    loans = datasets.parse_size(args.loans)
+    if not args.skip_seed:
+        started = time.perf_counter()
+        datasets.seed(library, books=loans // 2, customers=loans // 4, loans=loans)
+        print(f'Seeded {loans} loans in {time.perf_counter() - started:.1f}s')
+
+    client = library.app.test_client()
+    paths = [
+        ('orm + to_dict + json', lambda: legacy_loans(library)),
+        ('rows + json', lambda: row_loans(library, lambda obj: json.dumps(obj, sort_keys=True))),
+        (f'rows + {json_backend()}', lambda: row_loans(library, library.app.json.dumps)),
+        ('GET /loans?status=all', lambda: route_loans(library, client)),
+    ]
+
+    print(f"{'path':<26} {'seconds':>8} {'MB':>8} {'MB/s':>8}")
+    with library.app.app_context():
+        for name, func in paths:
+            seconds, size = measure(func, args.repeat)
+            library.db.session.remove()  # Do not let the identity map carry over between paths
+            print(f'{name:<26} {seconds:>8.3f} {size / 1e6:>8.2f} {size / 1e6 / seconds:>8.2f}')
+
+
+if __name__ == '__main__':
+    main()
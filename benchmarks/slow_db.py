@@ -0,0 +1,26 @@
+"""The app with a simulated database round trip, for benchmarking servers against a remote database.
+
+Every SQL statement sleeps BENCH_DB_LATENCY_MS first, the way a query to a database server waits
+on the network; the sleep releases the GIL like a real socket wait would.
+
+    gunicorn benchmarks.slow_db:app
+    uvicorn benchmarks.slow_db:application
+"""
+import os
+import time
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from app import app
+from asgi import application
+
+LATENCY = float(os.environ.get('BENCH_DB_LATENCY_MS', 5)) / 1000.0
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def simulate_round_trip(conn, cursor, statement, parameters, context, executemany):
+    time.sleep(LATENCY)
+
+
+__all__ = ['app', 'application']
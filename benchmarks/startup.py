@@ -0,0 +1,96 @@
+"""Startup cost: importing app.py, and gunicorn workers booting with and without preload.
+
+Imports the app in fresh interpreters and reports the median import time. Then starts gunicorn
+with the repository's gunicorn.conf.py, once with preload_app off (every worker imports the app
+itself) and once with it on (the master imports it and forks), and reports how long after launch
+the first and the last worker were ready to serve (medians over --runs).
+
+    python -m benchmarks.startup --workers 4 --runs 5
+"""
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from benchmarks.routes import free_port
+
+READY_HOOK = '''
+exec(open({config!r}).read())
+
+def post_worker_init(worker):
+    import sys, time
+    print(f'bench-worker-ready {{time.time()}}', file=sys.stderr, flush=True)
+'''
+READY_LINE = re.compile(r'bench-worker-ready ([0-9.]+)')
+
+
+def import_time(env):
+    """Seconds a fresh interpreter spends importing app.py."""
+    output = subprocess.run(
+        [sys.executable, '-c', 'import time; started = time.perf_counter(); import app; print(time.perf_counter() - started)'],
+        env=env, capture_output=True, text=True, check=True
+    ).stdout
+    return float(output.strip().splitlines()[-1])
+
+
+def boot_time(workers, preload, env, config_path):
+    """(first, last) seconds from launching gunicorn until its workers had loaded the app."""
+    port = free_port()
+    env = dict(env, GUNICORN_PRELOAD='1' if preload else '0')
+    started = time.time()
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', config_path, '-w', str(workers), '-b', f'127.0.0.1:{port}', 'app:app'],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True
+    )
+    ready = []
+    done = threading.Event()
+
+    def read_stderr():
+        for line in process.stderr:
+            match = READY_LINE.search(line)
+            if match:
+                ready.append(float(match.group(1)) - started)
+                if len(ready) == workers:
+                    done.set()
+
+    threading.Thread(target=read_stderr, daemon=True).start()
+    try:
+        if not done.wait(60):
+            raise SystemExit('gunicorn workers did not start.')
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
+    return min(ready), max(ready)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=4, help="gunicorn workers (default 4)")
+    parser.add_argument('--runs', type=int, default=5, help="Repetitions of each measurement (default 5)")
+    args = parser.parse_args(argv)
+
+    directory = tempfile.mkdtemp()
+    env = dict(os.environ,
+               DATABASE_URL='sqlite:///' + os.path.join(directory, 'bench.db'),
+               JWT_BLOCKLIST_CHANNEL=os.path.join(directory, 'token_blocklist.channel'))
+    config_path = os.path.join(directory, 'gunicorn_bench.conf.py')
+    with open(config_path, 'w') as config:
+        config.write(READY_HOOK.format(config=os.path.abspath('gunicorn.conf.py')))
+
+    imports = [import_time(env) for _ in range(args.runs)]
+    print(f"import app: median {statistics.median(imports) * 1000:.1f} ms, min {min(imports) * 1000:.1f} ms")
+
+    print(f"{'gunicorn -w ' + str(args.workers):<24}{'first worker ms':>17}{'all workers ms':>16}")
+    for preload in (False, True):
+        boots = [boot_time(args.workers, preload, env, config_path) for _ in range(args.runs)]
+        print(f"{'preload ' + ('on' if preload else 'off'):<24}{statistics.median(first for first, _ in boots) * 1000:>17.1f}"
+              f"{statistics.median(last for _, last in boots) * 1000:>16.1f}")
+
+
+if __name__ == '__main__':
+    main()
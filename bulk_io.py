@@ -0,0 +1,195 @@
+import csv
+import io
+import json
+import re
+
+
+EMAIL_PATTERN = re.compile(r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$')
+
+
+def parse_int(value):
+    if isinstance(value, bool):
+        raise ValueError("must be an integer")
+    if isinstance(value, int):
+        return value
+    try:
+        return int(str(value).strip())
+    except ValueError:
+        raise ValueError("must be an integer") from None
+
+
+def parse_bool(value):
+    if isinstance(value, bool):
+        return value
+    text = str(value).strip().lower()
+    if text in ('1', 'true', 'yes'):
+        return True
+    if text in ('0', 'false', 'no', ''):
+        return False
+    raise ValueError("must be true or false")
+
+
+def parse_text(value):
+    text = str(value).strip()
+    if not text:
+        raise ValueError("must not be empty")
+    return text
+
+
+def parse_email(value):
+    email = str(value).strip()
+    if not EMAIL_PATTERN.match(email):
+        raise ValueError("invalid email format")
+    return email
+
+
+def parse_enum(enum_class):
+    """Converter accepting enum member names, e.g. 'TEN_DAYS' for LoanType."""
+    members = enum_class.__members__
+
+    def convert(value):
+        member = members.get(str(value).strip())
+        if member is None:
+            raise ValueError(f"must be one of: {', '.join(members)}")
+        return member
+    return convert
+
+
+class RowSchema:
+    """Field converters for imported rows: required fields and optional fields with defaults."""
+
+    def __init__(self, required, optional=None):
+        self.required = required  # field -> converter
+        self.optional = optional or {}  # field -> (converter, default)
+
+    def validate(self, row):
+        """Return (clean_row, errors) for one raw row."""
+        clean, errors = {}, []
+        for field, convert in self.required.items():
+            value = row.get(field)
+            if value is None or value == '':
+                errors.append(f"{field}: missing")
+                continue
+            try:
+                clean[field] = convert(value)
+            except ValueError as exc:
+                errors.append(f"{field}: {exc}")
+
+        for field, (convert, default) in self.optional.items():
+            value = row.get(field)
+            if value is None or value == '':
+                clean[field] = default
+                continue
+            try:
+                clean[field] = convert(value)
+            except ValueError as exc:
+                errors.append(f"{field}: {exc}")
+        return clean, errors
+
+
+class UnreadableInput(ValueError):
+    """Raised by read_rows() when the stream cannot be read on: bad UTF-8 or malformed CSV at `line`."""
+
+    def __init__(self, line, message):
+        super().__init__(f"line {line}: {message}")
+        self.line = line
+        self.message = message
+
+
+class ImportReport:
+    """Counts and per-row errors collected while importing."""
+
+    def __init__(self, max_errors=1000):
+        self.max_errors = max_errors
+        self.received = 0
+        self.inserted = 0
+        self.failed = 0
+        self.errors = []
+        self.unreadable = None  # {'line', 'error'} when the input stopped being readable
+
+    def add_error(self, row_number, messages):
+        self.failed += 1
+        if len(self.errors) < self.max_errors:
+            self.errors.append({'row': row_number, 'errors': messages})
+
+    def stop(self, error):
+        self.unreadable = {'line': error.line, 'error': error.message}
+
+    def to_dict(self):
+        data = {
+            'received': self.received,
+            'inserted': self.inserted,
+            'failed': self.failed,
+            'errors': self.errors,
+            'errors_truncated': self.failed > len(self.errors)
+        }
+        if self.unreadable:
+            data['unreadable'] = self.unreadable
+        return data
+
+
+def read_rows(stream, fmt):
+    """Yield (row_number, row, error) from a binary CSV or NDJSON stream, one row at a time.
+
+    Raises UnreadableInput at a line that is not UTF-8 or a CSV record that is malformed, as the
+    rows after it cannot be told apart.
+    """
+    lines = decoded_lines(stream)
+
+    if fmt == 'csv':
+        # Row numbers count the header as row 1, like a spreadsheet
+        reader = csv.DictReader(lines)
+        try:
+            for row_number, row in enumerate(reader, start=2):
+                yield row_number, row, None
+        except csv.Error as error:
+            raise UnreadableInput(reader.line_num + 1, f"malformed CSV ({error})") from None  # line_num leaves out the failing line
+        return
+
+    for row_number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            yield row_number, None, "invalid JSON"
+            continue
+        if not isinstance(row, dict):
+            yield row_number, None, "expected a JSON object"
+            continue
+        yield row_number, row, None
+
+
+def decoded_lines(stream):
+    """Lines of a binary stream as text, decoded one at a time so a bad byte is reported on its own line."""
+    for line_number, line in enumerate(stream, start=1):
+        try:
+            yield line.decode('utf-8')
+        except UnicodeDecodeError:
+            raise UnreadableInput(line_number, "not valid UTF-8") from None
+
+
+def batched(iterable, size):
+    """Group an iterable into lists of at most size items."""
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def csv_lines(rows, fieldnames):
+    """Yield CSV text for a header plus rows of dicts, one line at a time."""
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=fieldnames, extrasaction='ignore')
+
+    writer.writeheader()
+    yield buffer.getvalue()
+    for row in rows:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerow(row)
+        yield buffer.getvalue()
@@ -0,0 +1,58 @@
+import threading
+import time
+
+
+class ChangeNotifier:
+    """Wakes long-poll and stream requests waiting for new change-log entries.
+
+    notify() is called after this process commits a change. Changes committed by other worker
+    processes are not announced, so waiters also re-check every `poll_interval` seconds. At most
+    `max_waiters` requests may wait at once, since each one holds a worker thread.
+    """
+
+    def __init__(self, poll_interval=1.0, max_waiters=32):
+        self.poll_interval = poll_interval
+        self.max_waiters = max_waiters
+        self._condition = threading.Condition()
+        self._version = 0
+        self._waiters = 0
+
+        self.notified = 0
+        self.refused = 0  # No free waiter slot
+
+    def notify(self):
+        with self._condition:
+            self._version += 1
+            self.notified += 1
+            self._condition.notify_all()
+
+    def acquire(self):
+        """Take a waiter slot. Returns False when all of them are in use."""
+        with self._condition:
+            if self._waiters >= self.max_waiters:
+                self.refused += 1
+                return False
+            self._waiters += 1
+            return True
+
+    def release(self):
+        with self._condition:
+            self._waiters -= 1
+
+    def wait_for(self, fetch, timeout):
+        """Call fetch() until it returns something truthy or `timeout` seconds pass. Returns its last result."""
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._condition:
+                version = self._version  # Taken before fetching, so a notify() during the fetch is not missed
+            result = fetch()
+            remaining = deadline - time.monotonic()
+            if result or remaining <= 0:
+                return result
+            with self._condition:
+                if self._version == version:
+                    self._condition.wait(min(self.poll_interval, remaining))
+
+    def stats(self):
+        with self._condition:
+            return {'waiters': self._waiters, 'notified': self.notified, 'refused': self.refused}
@@ -0,0 +1,69 @@
+from sqlalchemy import delete, insert, select, update
+
+
+class CounterTable:
+    """Integer counters keyed by (name, key) in a table with name, key and value columns.
+
+    add() applies deltas on the caller's connection, so the counters change in the same
+    transaction as the rows they count. Each delta is added to the stored value rather than
+    written over it, so concurrent writers do not lose each other's changes.
+    """
+
+    def __init__(self, table):
+        self.table = table
+
+    def add(self, connection, deltas):
+        """Add {(name, key): delta} to the counters, creating missing ones."""
+        rows = [{'name': name, 'key': key, 'value': delta} for (name, key), delta in deltas.items() if delta]
+        if not rows:
+            return
+
+        upsert = self._upsert(connection.dialect.name)
+        if upsert is not None:
+            statement = upsert(self.table)
+            connection.execute(statement.on_conflict_do_update(
+                index_elements=[self.table.c.name, self.table.c.key],
+                set_={'value': self.table.c.value + statement.excluded.value}
+            ), rows)
+            return
+
+        for row in rows:
+            changed = connection.execute(
+                update(self.table)
+                .where(self.table.c.name == row['name'], self.table.c.key == row['key'])
+                .values(value=self.table.c.value + row['value'])
+            ).rowcount
+            if not changed:
+                connection.execute(insert(self.table).values(row))
+
+    def read(self, connection, *names):
+        """{name: {key: value}} for the given counter names, or for all of them."""
+        query = select(self.table.c.name, self.table.c.key, self.table.c.value)
+        if names:
+            query = query.where(self.table.c.name.in_(names))
+        values = {}
+        for name, key, value in connection.execute(query):
+            values.setdefault(name, {})[key] = value
+        return values
+
+    def replace(self, connection, values):
+        """Overwrite every counter with {(name, key): value}. Returns {(name, key): (old, new)} for those that changed."""
+        old = {(name, key): value for name, keys in self.read(connection).items() for key, value in keys.items()}
+        drift = {counter: (old.get(counter, 0), values.get(counter, 0))
+                 for counter in set(old) | set(values) if old.get(counter, 0) != values.get(counter, 0)}
+
+        connection.execute(delete(self.table))
+        rows = [{'name': name, 'key': key, 'value': value} for (name, key), value in values.items()]
+        if rows:
+            connection.execute(insert(self.table), rows)
+        return drift
+
+    @staticmethod
+    def _upsert(dialect):
+        if dialect == 'sqlite':
+            from sqlalchemy.dialects.sqlite import insert as upsert
+            return upsert
+        if dialect == 'postgresql':
+            from sqlalchemy.dialects.postgresql import insert as upsert
+            return upsert
+        return None
@@ -0,0 +1,106 @@
+from flask import g, has_app_context
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event, inspect
+from sqlalchemy.engine import make_url
+
+from sharding import DEFAULT_SHARD
+
+
+REPLICA_BIND = 'replica'
+SHARD_BIND_PREFIX = 'shard_'
+
+
+def backend_name(url):
+    return make_url(url).get_backend_name()
+
+
+def is_sqlite(url):
+    return backend_name(url) == 'sqlite'
+
+
+def pool_options(pool_size=5, max_overflow=10, pool_timeout=30, pool_recycle=1800, pool_pre_ping=True):
+    """Engine options for server databases: a bounded pool per worker, with stale connections detected and recycled."""
+    return {'pool_size': pool_size, 'max_overflow': max_overflow, 'pool_timeout': pool_timeout,
+            'pool_recycle': pool_recycle, 'pool_pre_ping': pool_pre_ping}
+
+
+def sqlite_pragmas(journal_mode='WAL', synchronous='NORMAL', busy_timeout_ms=5000, mmap_size=0, cache_size_kib=0):
+    """PRAGMA statements run on every new SQLite connection (zero or empty values are left at SQLite's default)."""
+    pragmas = []
+    if journal_mode:
+        pragmas.append(f'PRAGMA journal_mode={journal_mode}')  # WAL lets readers run alongside the writer
+    if synchronous:
+        pragmas.append(f'PRAGMA synchronous={synchronous}')  # NORMAL is durable across crashes in WAL mode
+    if busy_timeout_ms:
+        pragmas.append(f'PRAGMA busy_timeout={int(busy_timeout_ms)}')
+    if mmap_size:
+        pragmas.append(f'PRAGMA mmap_size={int(mmap_size)}')
+    if cache_size_kib:
+        pragmas.append(f'PRAGMA cache_size=-{int(cache_size_kib)}')  # Negative means KiB rather than pages
+    return pragmas
+
+
+def apply_sqlite_pragmas(engine, pragmas):
+    """Run the pragmas on each connection the engine opens. Does nothing for other backends."""
+    if engine.dialect.name != 'sqlite' or not pragmas:
+        return
+
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for pragma in pragmas:
+                cursor.execute(pragma)
+        finally:
+            cursor.close()
+
+
+def current_pragmas(connection, names=('journal_mode', 'synchronous', 'busy_timeout', 'mmap_size', 'cache_size')):
+    """Values of the given pragmas on a SQLite connection, for checking the profile took effect."""
+    return {name: connection.exec_driver_sql(f'PRAGMA {name}').scalar() for name in names}
+
+
+def use_read_replica(enabled=True):
+    """Send this request's reads to the replica bind, when one is configured."""
+    g.use_read_replica = enabled
+
+
+def reading_replica():
+    return has_app_context() and bool(g.get('use_read_replica'))
+
+
+def shard_bind(shard):
+    """Bind key of a shard's database; the default shard is the primary (bind key None)."""
+    return None if shard in (None, DEFAULT_SHARD) else SHARD_BIND_PREFIX + shard
+
+
+def use_shard(shard):
+    """Send this request's statements on sharded tables to a shard (None for the default one)."""
+    g.shard = shard
+
+
+def current_shard():
+    return (g.get('shard') if has_app_context() else None) or DEFAULT_SHARD
+
+
+class RoutingSession(Session):
+    """Session that sends statements to the shard chosen with use_shard(), and reads to the replica
+    bind while use_read_replica() is on for the request.
+
+    Tables in `global_tables` always live on the primary; every other table, and statements the
+    session cannot tie to a table, follow the shard. The replica only serves the default shard.
+    Flushes and INSERT/UPDATE/DELETE statements always go to the primary.
+    """
+
+    global_tables = frozenset()
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and has_app_context() and g.get('shard') not in (None, DEFAULT_SHARD):
+            if mapper is None or inspect(mapper).local_table.name not in self.global_tables:
+                return self._db.engines[SHARD_BIND_PREFIX + g.shard]
+        if (bind is None and not self._flushing and has_app_context() and g.get('use_read_replica')
+                and not getattr(clause, 'is_dml', False)):
+            engine = self._db.engines.get(REPLICA_BIND)
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
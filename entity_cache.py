@@ -0,0 +1,143 @@
+from collections import OrderedDict
+import threading
+import time
+
+
+class EntityCache:
+    """Rows of books and customers by id, and by a unique field such as a name or an email.
+
+    A size-bounded LRU shared by a process's requests. Each entry holds the row as a dictionary,
+    which callers must not modify, and the shard it was read from. An entry is dropped when its
+    row changes: at once for this process's writes, and for other processes' writes when the
+    change log is next read, right after this process wrote or at most `max_staleness` seconds
+    after the last look.
+
+    load_changes(shard, after) returns (oldest, latest, changes): the oldest and latest seq in a
+    shard's change log, and (kind, id) for the changes after `after` up to latest, or none when
+    `after` is None. Every invalidation bumps the kind's version: a row read from the database is
+    stored only if its version is unchanged since the read began, so a slow read cannot put back
+    a row that changed meanwhile.
+    """
+
+    def __init__(self, load_changes, shards, max_entries=10000, max_staleness=1.0):
+        self.load_changes = load_changes
+        self.shards = list(shards)
+        self.max_entries = max_entries
+        self.max_staleness = max_staleness
+
+        self._lock = threading.Lock()  # Guards the entries and versions
+        self._refresh_lock = threading.Lock()  # One thread reads the change log at a time
+        self._entries = OrderedDict()  # (kind, id) -> (shard, row, alias keys), least recently used first
+        self._aliases = {}  # (kind, field, value) -> id
+        self._versions = {}
+        self._seqs = dict.fromkeys(self.shards)  # Last change seen per shard, None until the first look
+        self._refreshed_at = 0.0
+        self._stale = True
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+        self.rejected = 0
+
+    def version(self, kind):
+        """Token to pass to put() for a row about to be read from the database."""
+        with self._lock:
+            return self._versions.get(kind, 0)
+
+    def get(self, kind, record_id):
+        """(shard, row) of a cached record, or None."""
+        with self._lock:
+            entry = self._entries.get((kind, record_id))
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end((kind, record_id))
+            self.hits += 1
+            return entry[0], entry[1]
+
+    def get_by(self, kind, field, value):
+        """(shard, row) of the cached record whose `field` equals value, or None."""
+        with self._lock:
+            record_id = self._aliases.get((kind, field, value))
+            if record_id is None:
+                self.misses += 1
+                return None
+        return self.get(kind, record_id)
+
+    def put(self, kind, shard, row, version, fields=()):
+        """Cache a row read when version() was `version`, also under its values of `fields`."""
+        with self._lock:
+            if self._versions.get(kind, 0) != version:
+                self.rejected += 1
+                return False
+            key = (kind, row['id'])
+            self._drop(key)
+            aliases = [(kind, field, row[field]) for field in fields]
+            self._entries[key] = (shard, row, aliases)
+            for alias in aliases:
+                self._aliases[alias] = row['id']
+            while len(self._entries) > self.max_entries:
+                self._drop(next(iter(self._entries)))
+                self.evictions += 1
+            return True
+
+    def invalidate(self, kind, ids):
+        """Drop records that changed, and refuse rows read before now."""
+        with self._lock:
+            self._versions[kind] = self._versions.get(kind, 0) + 1
+            for record_id in ids:
+                if self._drop((kind, record_id)):
+                    self.invalidations += 1
+
+    def clear(self):
+        """Drop every entry, e.g. after branches moved between shards."""
+        with self._lock:
+            for kind, _ in self._entries:
+                self._versions[kind] = self._versions.get(kind, 0) + 1
+            self._entries.clear()
+            self._aliases.clear()
+
+    def reset(self):
+        """Clear, and take the change logs' current position as the start, e.g. after the tables were recreated."""
+        with self._refresh_lock:
+            self.clear()
+            self._seqs = dict.fromkeys(self.shards)
+            self._stale = True
+
+    def mark_stale(self):
+        """Read the change log on the next lookup rather than after max_staleness, e.g. after this process wrote."""
+        self._stale = True
+
+    def refresh(self):
+        """Drop the records other processes changed, once the cache may be stale."""
+        with self._refresh_lock:
+            now = time.monotonic()
+            if not self._stale and now - self._refreshed_at < self.max_staleness:
+                return
+            self._stale = False  # Cleared before loading, so a write during the load marks it again
+            for shard in self.shards:
+                after = self._seqs[shard]
+                oldest, latest, changes = self.load_changes(shard, after)
+                if after is not None and oldest is not None and after < oldest - 1:
+                    self.clear()  # Compaction removed changes we never saw
+                changed = {}
+                for kind, record_id in changes:
+                    changed.setdefault(kind, []).append(record_id)
+                for kind, ids in changed.items():
+                    self.invalidate(kind, ids)
+                self._seqs[shard] = max(after or 0, latest or 0)
+            self._refreshed_at = now
+
+    def stats(self):
+        return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses,
+                'invalidations': self.invalidations, 'evictions': self.evictions, 'rejected': self.rejected}
+
+    def _drop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return False
+        for alias in entry[2]:
+            if self._aliases.get(alias) == key[1]:
+                del self._aliases[alias]
+        return True
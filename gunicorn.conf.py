@@ -0,0 +1,22 @@
+# Gunicorn picks this file up automatically from the working directory.
+import os
+
+# Import the app once in the master and fork the workers from it: a worker then starts serving in
+# milliseconds instead of importing Flask and SQLAlchemy itself, and shares the imported code pages.
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1') == '1'
+
+
+def post_fork(server, worker):
+    """Drop database connections inherited from the master; each worker opens its own and builds its availability index."""
+    from app import app, db, warm_availability_index
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)  # Leave the master's sockets alone
+    warm_availability_index()
+
+
+def worker_exit(server, worker):
+    """Stop the report processes and flush buffered log records before the worker process exits."""
+    from app import close_reports, log_buffer
+    close_reports()
+    log_buffer.close()
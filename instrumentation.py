@@ -0,0 +1,201 @@
+from collections import deque
+import threading
+import time
+
+from flask import g, has_request_context, jsonify, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class RouteStats:
+    """Running totals for one (method, route) pair."""
+
+    def __init__(self):
+        self.requests = 0
+        self.statuses = {}
+        self.duration = 0.0
+        self.buckets = [0] * len(DURATION_BUCKETS)
+        self.queries = 0
+        self.db_time = 0.0
+        self.serialization_time = 0.0
+        self.log_messages = 0
+        self.slow = 0
+
+
+class RequestMetrics:
+    """Per-request SQL counts and timings, aggregated per route and exported for Prometheus.
+
+    SQL statements are counted through engine events, serialization time through the app's
+    JSON provider, and log records through count_log_message().
+    """
+
+    def __init__(self, slow_threshold_ms=0, server_timing=False, max_slow_requests=100, max_captured_statements=200):
+        self.slow_threshold = slow_threshold_ms / 1000.0
+        self.server_timing = server_timing
+        self.max_captured_statements = max_captured_statements
+        self.slow_requests = deque(maxlen=max_slow_requests)
+        self._routes = {}
+        self._gauges = []
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        event.listen(Engine, 'before_cursor_execute', self._before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', self._after_cursor_execute)
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        self._instrument_json(app.json)
+
+        app.add_url_rule('/metrics', 'metrics', self.metrics_view, methods=['GET'])
+        app.add_url_rule('/metrics/slow', 'slow_requests', self.slow_requests_view, methods=['GET'])
+
+    def add_gauge(self, name, help_text, func):
+        """Export func() (a number, or a dict of label value -> number) as a gauge."""
+        self._gauges.append((name, help_text, func))
+
+    def count_log_message(self):
+        if has_request_context() and '_metrics' in g:
+            g._metrics['log_messages'] += 1
+
+    # Hooks
+    def _before_request(self):
+        g._metrics = {'started': time.perf_counter(), 'queries': 0, 'db_time': 0.0,
+                      'serialization_time': 0.0, 'log_messages': 0, 'statements': []}
+
+    def _after_request(self, response):
+        state = g.pop('_metrics', None)
+        if state is None:
+            return response
+
+        duration = time.perf_counter() - state['started']
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        key = (request.method, route)
+        slow = self.slow_threshold > 0 and duration >= self.slow_threshold
+
+        with self._lock:
+            stats = self._routes.get(key)
+            if stats is None:
+                stats = self._routes[key] = RouteStats()
+            stats.requests += 1
+            stats.statuses[response.status_code] = stats.statuses.get(response.status_code, 0) + 1
+            stats.duration += duration
+            for index, bound in enumerate(DURATION_BUCKETS):
+                if duration <= bound:
+                    stats.buckets[index] += 1
+            stats.queries += state['queries']
+            stats.db_time += state['db_time']
+            stats.serialization_time += state['serialization_time']
+            stats.log_messages += state['log_messages']
+            if slow:
+                stats.slow += 1
+                self.slow_requests.append({
+                    'method': request.method,
+                    'path': request.full_path.rstrip('?'),
+                    'route': route,
+                    'status': response.status_code,
+                    'duration_ms': round(duration * 1000, 3),
+                    'queries': state['queries'],
+                    'db_ms': round(state['db_time'] * 1000, 3),
+                    'statements': state['statements']
+                })
+
+        if self.server_timing:
+            response.headers['Server-Timing'] = (
+                f"db;desc=\"{state['queries']} queries\";dur={state['db_time'] * 1000:.2f}, "
+                f"ser;dur={state['serialization_time'] * 1000:.2f}, "
+                f"total;dur={duration * 1000:.2f}"
+            )
+        return response
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if has_request_context() and '_metrics' in g:
+            conn.info.setdefault('_metrics_started', []).append(time.perf_counter())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        started = conn.info.get('_metrics_started')
+        if not started or not has_request_context() or '_metrics' not in g:
+            return
+        state = g._metrics
+        state['queries'] += 1
+        state['db_time'] += time.perf_counter() - started.pop()
+        if self.slow_threshold > 0 and len(state['statements']) < self.max_captured_statements:
+            state['statements'].append(statement)
+
+    def _instrument_json(self, provider):
+        dumps = provider.dumps
+
+        def timed_dumps(obj, **kwargs):
+            started = time.perf_counter()
+            try:
+                return dumps(obj, **kwargs)
+            finally:
+                if has_request_context() and '_metrics' in g:
+                    g._metrics['serialization_time'] += time.perf_counter() - started
+
+        provider.dumps = timed_dumps
+
+    # Export
+    def render_prometheus(self):
+        """Render the collected metrics in the Prometheus text exposition format."""
+        lines = []
+
+        def family(name, kind, help_text):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+
+        with self._lock:
+            routes = sorted(self._routes.items())
+
+            family('library_requests_total', 'counter', 'HTTP requests handled.')
+            for (method, route), stats in routes:
+                for status, count in sorted(stats.statuses.items()):
+                    lines.append(f'library_requests_total{{{_labels(method, route)},status="{status}"}} {count}')
+
+            family('library_request_duration_seconds', 'histogram', 'Time spent handling requests.')
+            for (method, route), stats in routes:
+                labels = _labels(method, route)
+                for bound, count in zip(DURATION_BUCKETS, stats.buckets):
+                    lines.append(f'library_request_duration_seconds_bucket{{{labels},le="{bound}"}} {count}')
+                lines.append(f'library_request_duration_seconds_bucket{{{labels},le="+Inf"}} {stats.requests}')
+                lines.append(f'library_request_duration_seconds_sum{{{labels}}} {stats.duration:.6f}')
+                lines.append(f'library_request_duration_seconds_count{{{labels}}} {stats.requests}')
+
+            for name, attribute, help_text in (
+                ('library_db_queries_total', 'queries', 'SQL statements executed while handling requests.'),
+                ('library_db_seconds_total', 'db_time', 'Time spent executing SQL while handling requests.'),
+                ('library_serialization_seconds_total', 'serialization_time', 'Time spent encoding JSON responses.'),
+                ('library_log_messages_total', 'log_messages', 'log_message calls made while handling requests.'),
+                ('library_slow_requests_total', 'slow', 'Requests slower than the slow-request threshold.')
+            ):
+                family(name, 'counter', help_text)
+                for (method, route), stats in routes:
+                    value = getattr(stats, attribute)
+                    lines.append(f'{name}{{{_labels(method, route)}}} {value:.6f}' if isinstance(value, float)
+                                 else f'{name}{{{_labels(method, route)}}} {value}')
+
+        for name, help_text, func in self._gauges:
+            family(name, 'gauge', help_text)
+            value = func()
+            if isinstance(value, dict):
+                for label, number in sorted(value.items()):
+                    lines.append(f'{name}{{key="{_escape(label)}"}} {number}')
+            else:
+                lines.append(f'{name} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+    def metrics_view(self):
+        return self.render_prometheus(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+    def slow_requests_view(self):
+        return jsonify(list(self.slow_requests)), 200
+
+
+def _labels(method, route):
+    return f'method="{method}",route="{_escape(route)}"'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
@@ -0,0 +1,172 @@
+import atexit
+import queue
+import threading
+import time
+
+
+class LogBuffer:
+    """Bounded in-process queue of log records flushed in batches by a background thread.
+
+    A batch whose write fails is tried again up to `flush_attempts` times, `retry_backoff` seconds
+    apart, and only then counted as lost. After close() records are written as they are put.
+    """
+
+    def __init__(self, flush_func, max_size=10000, batch_size=500, flush_interval=1.0, policy='drop', block_timeout=1.0,
+                 flush_attempts=3, retry_backoff=0.5):
+        if policy not in ('drop', 'block'):
+            raise ValueError("policy must be 'drop' or 'block'.")
+
+        self.flush_func = flush_func  # Called with a list of record dicts
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.flush_attempts = max(1, flush_attempts)
+        self.retry_backoff = retry_backoff
+
+        self._queue = queue.Queue(maxsize=max_size)
+        self._flush_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()  # Guards the counters
+        self._stop = threading.Event()
+        self._closed = False
+        self._thread = None
+
+        # Counters exposed through stats()
+        self.enqueued = 0
+        self.dropped = 0
+        self.flushed = 0
+        self.flush_count = 0
+        self.flush_errors = 0
+        self.lost = 0
+        self.last_flush_seconds = 0.0
+        self.total_flush_seconds = 0.0
+        self.max_flush_seconds = 0.0
+
+    def put(self, record):
+        """Queue a record, dropping or blocking when the queue is full. Returns True if queued.
+
+        Once closed the record is written at once instead, and True means it was written.
+        """
+        if self._closed:
+            with self._flush_lock:
+                return self._write([record])
+
+        self._ensure_started()
+        try:
+            if self.policy == 'block':
+                self._queue.put(record, timeout=self.block_timeout)
+            else:
+                self._queue.put_nowait(record)
+        except queue.Full:
+            with self._stats_lock:
+                self.dropped += 1
+            return False
+
+        with self._stats_lock:
+            self.enqueued += 1
+        if self._closed:
+            self.flush()  # close() may have flushed between the check above and the put
+        return True
+
+    def flush(self):
+        """Write out everything currently queued. Safe to call from any thread."""
+        with self._flush_lock:
+            while True:
+                batch = self._drain(self.batch_size)
+                if not batch:
+                    return
+                self._write(batch)
+
+    def close(self):
+        """Stop the flusher thread and write out any remaining records."""
+        self._closed = True
+        self._stop.set()
+        thread = self._thread
+        if thread is not None and thread.is_alive() and thread is not threading.current_thread():
+            thread.join(timeout=max(self.flush_interval * 2, 5.0))
+        self.flush()
+
+    def stats(self):
+        """Return queue-depth and flush-latency counters."""
+        with self._stats_lock:
+            return {
+                'queue_depth': self._queue.qsize(),
+                'queue_capacity': self._queue.maxsize,
+                'policy': self.policy,
+                'enqueued': self.enqueued,
+                'dropped': self.dropped,
+                'flushed': self.flushed,
+                'flush_count': self.flush_count,
+                'flush_errors': self.flush_errors,
+                'lost': self.lost,
+                'last_flush_seconds': self.last_flush_seconds,
+                'avg_flush_seconds': self.total_flush_seconds / self.flush_count if self.flush_count else 0.0,
+                'max_flush_seconds': self.max_flush_seconds
+            }
+
+    def _ensure_started(self):
+        if self._thread is not None or self._stop.is_set():
+            return
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='log-buffer-flusher', daemon=True)
+                self._thread.start()
+                atexit.register(self.close)
+
+    def _run(self):
+        while not self._stop.is_set():
+            # Wait for the first record, then gather until the batch is full or the interval elapses
+            try:
+                first = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                continue
+
+            batch = [first]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            with self._flush_lock:
+                self._write(batch)
+
+    def _drain(self, limit):
+        batch = []
+        while len(batch) < limit:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch):
+        """Hand a batch to flush_func, retrying failed attempts. Returns False if the batch was lost."""
+        for attempt in range(self.flush_attempts):
+            if attempt:
+                time.sleep(self.retry_backoff * attempt)
+            started = time.perf_counter()
+            try:
+                self.flush_func(batch)
+            except Exception:
+                with self._stats_lock:
+                    self.flush_errors += 1
+                continue
+            elapsed = time.perf_counter() - started
+
+            with self._stats_lock:
+                self.flushed += len(batch)
+                self.flush_count += 1
+                self.last_flush_seconds = elapsed
+                self.total_flush_seconds += elapsed
+                self.max_flush_seconds = max(self.max_flush_seconds, elapsed)
+            return True
+
+        with self._stats_lock:
+            self.lost += len(batch)
+        return False
@@ -0,0 +1,106 @@
+from contextlib import contextmanager
+from datetime import date, datetime
+import gzip
+import json
+import os
+import re
+import threading
+
+try:
+    import fcntl
+except ImportError:  # Windows: only one process should run the retention job
+    fcntl = None
+
+
+ARCHIVE_FILE = re.compile(r'^log-(\d{4}-\d{2}-\d{2})\.ndjson\.gz$')
+
+
+class LogArchive:
+    """Compressed NDJSON archive of log records, one gzip file per UTC day.
+
+    Every append adds a new gzip member to the day's file, so archiving never rewrites what is
+    already there; gzip readers see the members as one stream. Records carry their Log id, and
+    queries skip ids they have already returned in case a chunk was archived twice.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._lock = threading.Lock()
+
+    def path_for(self, day):
+        return os.path.join(self.directory, f'log-{day:%Y-%m-%d}.ndjson.gz')
+
+    def append(self, records):
+        """Archive records (dicts with id, timestamp, level and message) and sync them to disk."""
+        by_day = {}
+        for record in records:
+            by_day.setdefault(record['timestamp'].date(), []).append(record)
+
+        os.makedirs(self.directory, exist_ok=True)
+        with self._lock:
+            for day, day_records in sorted(by_day.items()):
+                lines = ''.join(json.dumps({'id': record['id'], 'timestamp': record['timestamp'].isoformat(),
+                                            'level': record['level'], 'message': record['message']}) + '\n'
+                                for record in day_records)
+                with open(self.path_for(day), 'ab') as raw:
+                    with gzip.GzipFile(fileobj=raw, mode='ab') as archive:
+                        archive.write(lines.encode('utf-8'))
+                    raw.flush()
+                    os.fsync(raw.fileno())  # The caller deletes the rows once this returns
+
+    def days(self):
+        """Days that have an archive file, in order."""
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(date.fromisoformat(match.group(1))
+                      for match in map(ARCHIVE_FILE.match, os.listdir(self.directory)) if match)
+
+    def query(self, since=None, until=None, level=None, contains=None, limit=1000):
+        """Archived records with since <= timestamp < until, optionally of one level or containing a substring.
+
+        Returns (records, truncated), oldest first.
+        """
+        records, seen = [], set()
+        for day in self.days():
+            if (since and day < since.date()) or (until and day > until.date()):
+                continue
+            with gzip.open(self.path_for(day), 'rt', encoding='utf-8') as archive:
+                for line in archive:
+                    record = json.loads(line)
+                    if record['id'] in seen:
+                        continue
+                    timestamp = datetime.fromisoformat(record['timestamp'])
+                    if (since and timestamp < since) or (until and timestamp >= until):
+                        continue
+                    if level and record['level'] != level:
+                        continue
+                    if contains and contains.lower() not in record['message'].lower():
+                        continue
+                    if len(records) == limit:
+                        return records, True
+                    seen.add(record['id'])
+                    records.append(record)
+        return records, False
+
+    @contextmanager
+    def exclusive(self):
+        """Try to become the process running retention; yields False when another process already is."""
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, '.lock'), 'a') as lock_file:
+            if fcntl is None:
+                yield True
+                return
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def stats(self):
+        days = self.days()
+        size = sum(os.path.getsize(self.path_for(day)) for day in days)
+        return {'files': len(days), 'bytes': size}
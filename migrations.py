@@ -0,0 +1,90 @@
+from datetime import datetime
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, insert, inspect, select, text
+
+
+schema_metadata = MetaData()
+
+schema_version = Table(
+    'schema_version', schema_metadata,
+    Column('version', Integer, primary_key=True),
+    Column('description', String(200), nullable=False),
+    Column('applied_at', DateTime, nullable=False)
+)
+
+
+class Migration:
+    """One versioned schema change. `upgrade` is called with a connection inside a transaction."""
+
+    def __init__(self, version, description, upgrade):
+        self.version = version
+        self.description = description
+        self.upgrade = upgrade
+
+
+def applied_versions(connection):
+    schema_version.create(connection, checkfirst=True)
+    return {version for (version,) in connection.execute(select(schema_version.c.version))}
+
+
+def upgrade(engine, migrations):
+    """Apply every migration not yet recorded in schema_version, in order. Returns the versions applied."""
+    with engine.begin() as connection:
+        done = applied_versions(connection)
+
+    applied = []
+    for migration in sorted(migrations, key=lambda migration: migration.version):
+        if migration.version in done:
+            continue
+        # Each migration runs in its own transaction together with its schema_version row
+        with engine.begin() as connection:
+            migration.upgrade(connection)
+            connection.execute(insert(schema_version).values(
+                version=migration.version, description=migration.description, applied_at=datetime.utcnow()
+            ))
+        applied.append(migration.version)
+    return applied
+
+
+def current_version(engine):
+    with engine.begin() as connection:
+        versions = applied_versions(connection)
+    return max(versions) if versions else 0
+
+
+def create_indexes(*indexes):
+    """Migration step creating the given sqlalchemy Index objects if they are missing."""
+    def run(connection):
+        for index in indexes:
+            index.create(connection, checkfirst=True)
+    return run
+
+
+def create_tables(metadata, *tables):
+    """Migration step creating the given tables (with their indexes) if they are missing."""
+    def run(connection):
+        metadata.create_all(connection, tables=list(tables), checkfirst=True)
+    return run
+
+
+def explain_query_plan(connection, statement):
+    """Return the SQLite EXPLAIN QUERY PLAN detail lines for a SQLAlchemy statement."""
+    compiled = statement.compile(connection, compile_kwargs={'literal_binds': True})
+    return [row[-1] for row in connection.exec_driver_sql(f'EXPLAIN QUERY PLAN {compiled}')]
+
+
+def uses_index(plan, table):
+    """True when the plan reads `table` through an index rather than a full scan."""
+    return any(detail.split(' ')[1:2] == [table] and 'INDEX' in detail
+               for detail in plan if detail.startswith(('SEARCH', 'SCAN')))
+
+
+def add_columns(table, *names):
+    """Migration step adding columns declared on `table` that the database table lacks (without constraints)."""
+    def run(connection):
+        existing = {column['name'] for column in inspect(connection).get_columns(table.name)}
+        for name in names:
+            if name not in existing:
+                column_type = table.c[name].type.compile(dialect=connection.dialect)
+                connection.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {name} {column_type}'))
+    return run
@@ -0,0 +1,129 @@
+from collections import deque
+from datetime import datetime, timezone
+import heapq
+import threading
+import time
+
+
+def as_utc_naive(moment):
+    """Normalize a datetime to naive UTC, the way SQLite hands them back."""
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+    return moment
+
+
+class OverdueTracker:
+    """Materialized set of late loans, fed by a min-heap of open loans ordered by return date.
+
+    `load_func(after_id)` returns (loan_id, return_date) pairs for open loans with an id above
+    after_id; it is used for the initial build and to pick up loans created by other workers.
+    Loans returned elsewhere may linger until the next rebuild, so callers should still filter
+    the late ids on is_active.
+    """
+
+    def __init__(self, load_func, rebuild_interval=3600, max_events=10000):
+        self.load_func = load_func
+        self.rebuild_interval = rebuild_interval
+        self.events = deque(maxlen=max_events)  # (loan_id, return_date) of loans that became late
+
+        self._heap = []  # (return_date, loan_id) of open loans not yet late, with lazy deletion
+        self._due = {}  # loan_id -> return_date for entries of the heap that are still valid
+        self._late = {}  # loan_id -> return_date
+        self._high_water = 0
+        self._rebuilt_at = 0.0
+        self._subscribers = []
+        self._lock = threading.RLock()
+        self.built = False
+
+    def subscribe(self, callback):
+        """Call callback(list of (loan_id, return_date)) whenever loans become late."""
+        self._subscribers.append(callback)
+
+    def rebuild(self, now=None):
+        """Reload every open loan from the database."""
+        rows = list(self.load_func(0))
+        with self._lock:
+            was_built, previously_late = self.built, self._late
+            self._heap, self._due, self._late = [], {}, {}
+            self._high_water = 0
+            self._add_rows(rows)
+            self.built = True
+            self._rebuilt_at = time.monotonic()
+            if not was_built:
+                # Loans already late when the tracker starts are not news
+                self.promote(now, notify=False)
+                return
+        newly_late = [pair for pair in self.promote(now, notify=False) if pair[0] not in previously_late]
+        self._notify(newly_late)
+
+    def reset(self):
+        """Forget everything; the next refresh rebuilds from the database."""
+        with self._lock:
+            self._heap, self._due, self._late = [], {}, {}
+            self._high_water = 0
+            self.built = False
+
+    def refresh(self, now=None):
+        """Pick up loans created since the last refresh, then promote the ones now due."""
+        if not self.built or time.monotonic() - self._rebuilt_at >= self.rebuild_interval:
+            self.rebuild(now)  # The periodic rebuild also drops loans closed by other workers
+            return
+        rows = list(self.load_func(self._high_water))
+        with self._lock:
+            self._add_rows(rows)
+        self.promote(now)
+
+    def add(self, loan_id, return_date):
+        """Track a newly created loan."""
+        if not self.built:
+            return
+        with self._lock:
+            self._add_rows([(loan_id, return_date)])
+
+    def remove(self, loan_id):
+        """Stop tracking a returned or deleted loan."""
+        with self._lock:
+            self._due.pop(loan_id, None)  # Its heap entry is skipped when it surfaces
+            self._late.pop(loan_id, None)
+
+    def promote(self, now=None, notify=True):
+        """Move loans whose return date has passed into the late set. Returns the newly late pairs."""
+        now = as_utc_naive(now or datetime.now(timezone.utc))
+        newly_late = []
+        with self._lock:
+            while self._heap and self._heap[0][0] < now:
+                return_date, loan_id = heapq.heappop(self._heap)
+                if self._due.get(loan_id) != return_date:
+                    continue  # Removed or re-added since this entry was pushed
+                del self._due[loan_id]
+                self._late[loan_id] = return_date
+                newly_late.append((loan_id, return_date))
+
+        if notify:
+            self._notify(newly_late)
+        return newly_late
+
+    def late_ids(self, now=None):
+        """Ids of late loans, in id order. Costs O(late loans), not O(all loans)."""
+        self.promote(now)
+        with self._lock:
+            return sorted(self._late)
+
+    def stats(self):
+        with self._lock:
+            return {'open': len(self._due), 'late': len(self._late), 'heap': len(self._heap), 'high_water': self._high_water}
+
+    def _notify(self, newly_late):
+        if not newly_late:
+            return
+        self.events.extend(newly_late)
+        for callback in self._subscribers:
+            callback(newly_late)
+
+    def _add_rows(self, rows):
+        for loan_id, return_date in rows:
+            return_date = as_utc_naive(return_date)
+            self._due[loan_id] = return_date
+            self._late.pop(loan_id, None)
+            heapq.heappush(self._heap, (return_date, loan_id))
+            self._high_water = max(self._high_water, loan_id)
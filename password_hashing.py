@@ -0,0 +1,79 @@
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+import threading
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+
+class PasswordHashBusy(Exception):
+    """Raised when a hash could not start within the queue timeout, or the queue is full."""
+
+
+class PasswordHasher:
+    """Runs password hashing on a small thread pool so a burst of logins cannot use every worker thread.
+
+    At most `workers` hashes run at once (hashlib releases the GIL while it works), up to
+    `max_queue` more wait, and a hash that has not started after `queue_timeout` seconds is
+    abandoned with PasswordHashBusy. `method` is passed to werkzeug's generate_password_hash;
+    hashes made with other parameters are reported by verify() as needing a rehash.
+    """
+
+    def __init__(self, method='scrypt', workers=2, max_queue=32, queue_timeout=2.0):
+        self.method = method
+        self.workers = workers
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='password-hash')
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._method_prefix = None
+
+        self.hashed = 0
+        self.verified = 0
+        self.rehashed = 0
+        self.rejected = 0  # Queue full
+        self.timed_out = 0  # Did not start in time
+
+    def hash(self, password):
+        """Hash a password with the configured method."""
+        self.hashed += 1
+        return self._run(generate_password_hash, password, self.method)
+
+    def verify(self, password_hash, password):
+        """Return (matches, needs_rehash) for a stored hash."""
+        self.verified += 1
+        matches = self._run(check_password_hash, password_hash, password)
+        return matches, matches and self.needs_rehash(password_hash)
+
+    def needs_rehash(self, password_hash):
+        """True when the stored hash was not made with the configured method and parameters."""
+        if self._method_prefix is None:
+            # werkzeug fills in default parameters (e.g. 'scrypt' -> 'scrypt:32768:8:1'); let it tell us which
+            self._method_prefix = generate_password_hash('', self.method).split('$', 1)[0]
+        return password_hash.split('$', 1)[0] != self._method_prefix
+
+    def stats(self):
+        with self._lock:
+            pending = self._pending
+        return {'pending': pending, 'hashed': self.hashed, 'verified': self.verified, 'rehashed': self.rehashed,
+                'rejected': self.rejected, 'timed_out': self.timed_out}
+
+    def _run(self, func, *args):
+        with self._lock:
+            if self._pending >= self.workers + self.max_queue:
+                self.rejected += 1
+                raise PasswordHashBusy()
+            self._pending += 1
+
+        future = self._executor.submit(func, *args)
+        future.add_done_callback(self._finished)
+        try:
+            return future.result(timeout=self.queue_timeout)
+        except TimeoutError:
+            if future.cancel():
+                self.timed_out += 1
+                raise PasswordHashBusy() from None
+            return future.result()  # Already running: waiting costs less than starting over
+
+    def _finished(self, future):
+        with self._lock:
+            self._pending -= 1
@@ -0,0 +1,52 @@
+from collections import OrderedDict
+import threading
+import time
+
+
+class TokenBucketLimiter:
+    """In-memory token buckets keyed by an arbitrary string, e.g. a username or a client address.
+
+    Each key may spend `burst` requests at once and regains `per_minute` tokens a minute. Only
+    the `max_keys` most recently seen keys are kept; a forgotten key starts again with a full bucket.
+    """
+
+    def __init__(self, burst, per_minute, max_keys=100000):
+        if per_minute <= 0:
+            raise ValueError("per_minute must be greater than 0; disable the limiter instead.")
+
+        self.burst = burst
+        self.rate = per_minute / 60.0
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()  # key -> [tokens, last refill time]
+        self._lock = threading.Lock()
+        self.allowed = 0
+        self.rejected = 0
+
+    def acquire(self, key, now=None):
+        """Spend a token for key. Returns 0 when allowed, else the seconds until a token is available."""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [float(self.burst), now]
+                while len(self._buckets) > self.max_keys:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                self.allowed += 1
+                return 0
+            self.rejected += 1
+            return (1 - bucket[0]) / self.rate
+
+    def reset(self):
+        with self._lock:
+            self._buckets.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'keys': len(self._buckets), 'allowed': self.allowed, 'rejected': self.rejected}
@@ -0,0 +1,263 @@
+from concurrent.futures import ProcessPoolExecutor
+import csv
+from datetime import datetime
+import multiprocessing
+import os
+import threading
+
+from sqlalchemy import Boolean, DateTime, Integer, String, column, create_engine, func, select, table, update
+
+try:
+    import numpy
+except ImportError:  # Optional: groups are totalled in plain Python instead
+    numpy = None
+
+# The columns the reports read, declared here so pool processes need not import the app
+books = table('books', column('id', Integer), column('category', String), column('branch', String),
+              column('is_active', Boolean), column('is_loaned', Boolean))
+customers = table('customers', column('id', Integer), column('city', String))
+loans = table('loans', column('customer_id', Integer), column('book_id', Integer), column('loan_date', DateTime),
+              column('return_date', DateTime), column('is_active', Boolean))
+report_jobs = table('report_jobs', column('id', Integer), column('status', String), column('started_at', DateTime),
+                    column('finished_at', DateTime), column('rows_total', Integer), column('rows_done', Integer),
+                    column('updated_at', DateTime), column('cancel_requested', Boolean), column('error', String))
+
+
+class ReportsBusy(Exception):
+    """Raised when every pool process is busy and the queue is full."""
+
+
+class ReportCancelled(Exception):
+    pass
+
+
+class GroupTotals:
+    """Row counts and sums of value columns per group key, added a chunk of columns at a time.
+
+    With NumPy a chunk is grouped with unique() and summed with bincount(); without it, row by row.
+    """
+
+    def __init__(self, width):
+        self.width = width
+        self.totals = {}  # key -> [rows, *sums]
+
+    def add(self, keys, values):
+        """keys: one tuple of strings per row; values: `width` columns of numbers."""
+        if not keys:
+            return
+        if numpy is not None:
+            labels, inverse = numpy.unique(numpy.array(keys, dtype=str), axis=0, return_inverse=True)
+            inverse = inverse.reshape(-1)
+            sums = [numpy.bincount(inverse, minlength=len(labels))]
+            sums += [numpy.bincount(inverse, weights=numpy.asarray(value, dtype=float), minlength=len(labels)) for value in values]
+            for position, label in enumerate(labels):
+                self._merge(tuple(label.tolist()), [float(total[position]) for total in sums])
+        else:
+            for position, key in enumerate(keys):
+                self._merge(key, [1] + [float(value[position]) for value in values])
+
+    def items(self):
+        return sorted(self.totals.items())
+
+    def _merge(self, key, amounts):
+        totals = self.totals.get(key)
+        if totals is None:
+            self.totals[key] = amounts
+        else:
+            for index, amount in enumerate(amounts):
+                totals[index] += amount
+
+
+def months(dates):
+    """'YYYY-MM' of each datetime."""
+    if numpy is not None:
+        return numpy.array(dates, dtype='datetime64[M]').astype(str).tolist()
+    return [date.strftime('%Y-%m') for date in dates]
+
+
+def days_before(now, dates):
+    """Days from each datetime to now."""
+    if numpy is not None:
+        return (numpy.datetime64(now, 'us') - numpy.array(dates, dtype='datetime64[us]')) / numpy.timedelta64(1, 'D')
+    return [(now - date).total_seconds() / 86400 for date in dates]
+
+
+class OverdueReport:
+    """Open loans past their return date, per customer city, with the average days late."""
+    header = ('city', 'overdue_loans', 'average_days_late')
+    width = 1
+
+    def statement(self, now):
+        return (select(customers.c.city, loans.c.return_date)
+                .select_from(loans.join(customers, customers.c.id == loans.c.customer_id))
+                .where(loans.c.is_active.is_(True), loans.c.return_date < now))
+
+    def group(self, columns, now):
+        cities, due = columns
+        return list(zip(cities)), [days_before(now, due)]
+
+    def rows(self, totals):
+        for (city,), (count, days) in totals.items():
+            yield city, int(count), round(days / count, 1)
+
+
+class CirculationReport:
+    """Loans made per month and book category, and how many of them are still out."""
+    header = ('month', 'category', 'loans', 'still_on_loan')
+    width = 1
+
+    def statement(self, now):
+        return (select(loans.c.loan_date, books.c.category, loans.c.is_active)
+                .select_from(loans.join(books, books.c.id == loans.c.book_id)))
+
+    def group(self, columns, now):
+        loan_dates, categories, active = columns
+        return list(zip(months(loan_dates), categories)), [active]
+
+    def rows(self, totals):
+        for (month, category), (count, active) in totals.items():
+            yield month, category, int(count), int(active)
+
+
+class InventoryReport:
+    """Books per branch and category: in the catalogue, active and on loan right now."""
+    header = ('branch', 'category', 'books', 'active', 'on_loan')
+    width = 2
+
+    def statement(self, now):
+        return select(books.c.branch, books.c.category, books.c.is_active, books.c.is_loaned)
+
+    def group(self, columns, now):
+        branches, categories, active, loaned = columns
+        return list(zip([branch or '' for branch in branches], categories)), [active, loaned]
+
+    def rows(self, totals):
+        for (branch, category), (count, active, loaned) in totals.items():
+            yield branch, category, int(count), int(active), int(loaned)
+
+
+REPORTS = {'overdue': OverdueReport(), 'circulation': CirculationReport(), 'inventory': InventoryReport()}
+
+_engines = {}  # Per pool process, by URL
+
+
+def engine_for(url):
+    if url not in _engines:
+        _engines[url] = create_engine(url)
+    return _engines[url]
+
+
+def run_report(job_id, kind, jobs_url, shard_urls, path, chunk_size, now):
+    """Run a report job in a pool process: stream every shard's rows in chunks, total them, write the CSV to path.
+
+    Progress is written to the job's row after each chunk, and the job stops there once
+    cancel_requested is set. Returns the final status.
+    """
+    report = REPORTS[kind]
+    jobs = engine_for(jobs_url)
+    try:
+        rows_total = sum(count_rows(url, report.statement(now)) for url in shard_urls)
+        if update_job(jobs, job_id, status='running', started_at=datetime.utcnow(), rows_total=rows_total):
+            raise ReportCancelled()  # While it was queued in another process's pool
+
+        totals = GroupTotals(report.width)
+        rows_done = 0
+        for url in shard_urls:
+            with engine_for(url).connect() as connection:
+                result = connection.execution_options(yield_per=chunk_size).execute(report.statement(now))
+                for chunk in result.partitions():
+                    keys, values = report.group(list(zip(*chunk)), now)
+                    totals.add(keys, values)
+                    rows_done += len(chunk)
+                    if update_job(jobs, job_id, rows_done=rows_done):
+                        raise ReportCancelled()
+
+        partial_path = path + '.partial'
+        with open(partial_path, 'w', newline='') as output:
+            writer = csv.writer(output)
+            writer.writerow(report.header)
+            writer.writerows(report.rows(totals))
+        os.replace(partial_path, path)  # Downloads never see a half-written file
+        status, error = 'done', None
+    except ReportCancelled:
+        status, error = 'cancelled', None
+    except Exception as exc:
+        status, error = 'failed', f'{type(exc).__name__}: {exc}'[:256]
+    update_job(jobs, job_id, status=status, finished_at=datetime.utcnow(), error=error)
+    return status
+
+
+def count_rows(url, statement):
+    with engine_for(url).connect() as connection:
+        return connection.scalar(select(func.count()).select_from(statement.subquery()))
+
+
+def update_job(jobs, job_id, **values):
+    """Write to the job's row and stamp updated_at. Returns True once the job was asked to stop."""
+    with jobs.begin() as connection:
+        connection.execute(update(report_jobs).where(report_jobs.c.id == job_id).values(updated_at=datetime.utcnow(), **values))
+        return bool(connection.scalar(select(report_jobs.c.cancel_requested).where(report_jobs.c.id == job_id)))
+
+
+class ReportPool:
+    """Runs report jobs on a process pool, so totalling a large table never holds a web worker.
+
+    The pool starts with the first job, after gunicorn forked the worker, and its processes are
+    spawned rather than forked: they import this module only, not the app and its threads. At
+    most `workers` jobs run at once and up to `max_queue` more wait; beyond that submit() raises
+    ReportsBusy.
+    """
+
+    def __init__(self, workers=2, max_queue=8):
+        self.workers = workers
+        self.max_queue = max_queue
+        self._executor = None
+        self._lock = threading.Lock()
+        self._futures = {}  # job id -> future, until it is done
+
+        self.submitted = 0
+        self.rejected = 0
+        self.cancelled = 0
+
+    def submit(self, job_id, *args):
+        """Queue run_report(job_id, *args)."""
+        with self._lock:
+            if len(self._futures) >= self.workers + self.max_queue:
+                self.rejected += 1
+                raise ReportsBusy()
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'))
+            future = self._executor.submit(run_report, job_id, *args)
+            self._futures[job_id] = future
+            self.submitted += 1
+        future.add_done_callback(lambda _: self._finished(job_id))
+        return future
+
+    def cancel(self, job_id):
+        """Drop a job that has not started in this process's pool. Returns False if it is running or not here."""
+        with self._lock:
+            future = self._futures.get(job_id)
+        if future is not None and future.cancel():
+            self.cancelled += 1
+            return True
+        return False
+
+    def stats(self):
+        with self._lock:
+            pending = len(self._futures)
+        return {'pending': pending, 'submitted': self.submitted, 'rejected': self.rejected, 'cancelled': self.cancelled}
+
+    def close(self):
+        """Shut the pool down, dropping the jobs that have not started. Returns their job ids."""
+        with self._lock:
+            executor, self._executor = self._executor, None
+            futures = list(self._futures.items())
+        dropped = [job_id for job_id, future in futures if future.cancel()]
+        self.cancelled += len(dropped)
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+        return dropped
+
+    def _finished(self, job_id):
+        with self._lock:
+            self._futures.pop(job_id, None)
@@ -0,0 +1,149 @@
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+class CachedResponse:
+    """Body and metadata of a cached response."""
+
+    __slots__ = ('etag', 'body', 'status', 'mimetype', 'expires')
+
+    def __init__(self, etag, body, status, mimetype, expires):
+        self.etag = etag
+        self.body = body
+        self.status = status
+        self.mimetype = mimetype
+        self.expires = expires
+
+
+class ResponseCache:
+    """Two-tier response cache: an in-process LRU and an optional SQLite file shared by workers.
+
+    Every entry belongs to one or more namespaces (e.g. 'books', 'loans'). Writes bump the
+    generation of the namespaces they touch, and an entry is only served while the generations
+    it was built under are current. ETags are derived from the key and those generations, so a
+    conditional request can be answered without building the response.
+    """
+
+    def __init__(self, max_entries=256, ttl=300, shared_path=None, max_shared_entries=2048):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.shared_path = shared_path
+        self.max_shared_entries = max_shared_entries
+
+        self._entries = OrderedDict()  # key -> CachedResponse
+        self._generations = {}  # Used when there is no shared tier
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.not_modified = 0
+
+    # Generations
+    def generations(self, namespaces):
+        """Current generation of each namespace, as a tuple in the given order."""
+        if self.shared_path:
+            rows = dict(self._shared().execute(
+                f"SELECT namespace, generation FROM generations WHERE namespace IN ({','.join('?' * len(namespaces))})",
+                namespaces
+            ).fetchall())
+            return tuple(rows.get(namespace, 0) for namespace in namespaces)
+        with self._lock:
+            return tuple(self._generations.get(namespace, 0) for namespace in namespaces)
+
+    def invalidate(self, *namespaces):
+        """Make every entry built from these namespaces stale, in this worker and the others."""
+        if self.shared_path:
+            self._shared().executemany(
+                "INSERT INTO generations(namespace, generation) VALUES (?, 1) "
+                "ON CONFLICT(namespace) DO UPDATE SET generation = generation + 1",
+                [(namespace,) for namespace in namespaces]
+            )
+        else:
+            with self._lock:
+                for namespace in namespaces:
+                    self._generations[namespace] = self._generations.get(namespace, 0) + 1
+
+    def etag(self, key, generations):
+        """Entity tag (unquoted) for the response stored under key at these generations."""
+        return hashlib.sha1(json.dumps([key, generations]).encode()).hexdigest()[:20]
+
+    # Entries
+    def get(self, key, etag):
+        """Return the entry for key if it was built under the given etag and has not expired."""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.etag == etag and entry.expires > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+
+        if self.shared_path:
+            row = self._shared().execute(
+                "SELECT etag, body, status, mimetype, expires FROM entries WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and row[0] == etag and row[4] > now:
+                entry = CachedResponse(*row)
+                self._store_local(key, entry)
+                self.shared_hits += 1
+                return entry
+
+        self.misses += 1
+        return None
+
+    def put(self, key, etag, body, status, mimetype):
+        entry = CachedResponse(etag, body, status, mimetype, time.time() + self.ttl)
+        self._store_local(key, entry)
+
+        if self.shared_path:
+            connection = self._shared()
+            connection.execute(
+                "INSERT OR REPLACE INTO entries(key, etag, body, status, mimetype, expires) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, etag, body, status, mimetype, entry.expires)
+            )
+            # Keep the shared tier bounded: drop the oldest writes
+            connection.execute(
+                "DELETE FROM entries WHERE rowid <= (SELECT MAX(rowid) FROM entries) - ?", (self.max_shared_entries,)
+            )
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._generations.clear()
+        if self.shared_path:
+            self._shared().execute("DELETE FROM entries")
+
+    def stats(self):
+        with self._lock:
+            size = len(self._entries)
+        return {'entries': size, 'hits': self.hits, 'shared_hits': self.shared_hits,
+                'misses': self.misses, 'not_modified': self.not_modified}
+
+    def _store_local(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _shared(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.shared_path)), exist_ok=True)
+            connection = sqlite3.connect(self.shared_path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS generations (namespace TEXT PRIMARY KEY, generation INTEGER NOT NULL)")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, etag TEXT NOT NULL, body BLOB NOT NULL, "
+                "status INTEGER NOT NULL, mimetype TEXT NOT NULL, expires REAL NOT NULL)"
+            )
+            self._local.connection = connection
+        return connection
@@ -0,0 +1,97 @@
+import re
+
+from sqlalchemy import text
+
+
+TOKEN_PATTERN = re.compile(r'\w+', re.UNICODE)
+
+
+class FullTextIndex:
+    """SQLite FTS5 index over some text columns of a table, kept in sync by triggers."""
+
+    def __init__(self, table, columns):
+        self.table = table
+        self.columns = columns
+        self.name = f'{table}_fts'
+        self._installed = {}  # Database URL -> whether the index exists there
+
+    def install(self, connection):
+        """Create the index and its triggers if missing. Returns False when FTS5 is unavailable."""
+        if not fts5_available(connection):
+            return False
+
+        exists = connection.execute(
+            text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"), {'name': self.name}
+        ).first() is not None
+
+        columns = ', '.join(self.columns)
+        new_values = ', '.join(f'new.{column}' for column in self.columns)
+        old_values = ', '.join(f'old.{column}' for column in self.columns)
+
+        statements = [
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {self.name} USING fts5({columns}, content='{self.table}', content_rowid='id', prefix='2 3')",
+            f"""CREATE TRIGGER IF NOT EXISTS {self.name}_ai AFTER INSERT ON {self.table} BEGIN
+                INSERT INTO {self.name}(rowid, {columns}) VALUES (new.id, {new_values});
+            END""",
+            f"""CREATE TRIGGER IF NOT EXISTS {self.name}_ad AFTER DELETE ON {self.table} BEGIN
+                INSERT INTO {self.name}({self.name}, rowid, {columns}) VALUES ('delete', old.id, {old_values});
+            END""",
+            f"""CREATE TRIGGER IF NOT EXISTS {self.name}_au AFTER UPDATE OF {columns} ON {self.table} BEGIN
+                INSERT INTO {self.name}({self.name}, rowid, {columns}) VALUES ('delete', old.id, {old_values});
+                INSERT INTO {self.name}(rowid, {columns}) VALUES (new.id, {new_values});
+            END"""
+        ]
+        for statement in statements:
+            connection.execute(text(statement))
+
+        if not exists:
+            # Index whatever rows the table already holds
+            connection.execute(text(f"INSERT INTO {self.name}({self.name}) VALUES ('rebuild')"))
+        self._installed[str(connection.engine.url)] = True
+        return True
+
+    def drop(self, connection):
+        """Remove the index; its triggers go away with the indexed table."""
+        if connection.dialect.name == 'sqlite':
+            connection.execute(text(f'DROP TABLE IF EXISTS {self.name}'))
+        self._installed[str(connection.engine.url)] = False
+
+    def is_installed(self, connection):
+        """Check, once per database, whether the index exists."""
+        url = str(connection.engine.url)
+        if url not in self._installed:
+            self._installed[url] = connection.dialect.name == 'sqlite' and connection.execute(
+                text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"), {'name': self.name}
+            ).first() is not None
+        return self._installed[url]
+
+    def search(self, connection, column, value, limit, ranked=False):
+        """Return ids whose column has words starting with every word in value, best match first.
+
+        With ranked=True, (id, rank) pairs are returned, for merging the results of several databases.
+        """
+        expression = match_expression(column, value)
+        if expression is None:
+            return []
+        rows = connection.execute(
+            text(f'SELECT rowid, rank FROM {self.name} WHERE {self.name} MATCH :expression ORDER BY rank LIMIT :limit'),
+            {'expression': expression, 'limit': limit}
+        )
+        return [(row[0], row[1]) if ranked else row[0] for row in rows]
+
+
+def match_expression(column, value):
+    """Build an FTS5 query that prefix-matches every word of value within one column."""
+    tokens = TOKEN_PATTERN.findall(value)
+    if not tokens:
+        return None
+    phrases = ' '.join('"{}"*'.format(token.replace('"', '""')) for token in tokens)
+    return f'{column} : ({phrases})'
+
+
+def fts5_available(connection):
+    """Check whether the connection is SQLite with the FTS5 extension compiled in."""
+    if connection.dialect.name != 'sqlite':
+        return False
+    options = {row[0] for row in connection.execute(text('PRAGMA compile_options'))}
+    return 'ENABLE_FTS5' in options
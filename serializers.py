@@ -0,0 +1,104 @@
+from flask.json.provider import DefaultJSONProvider
+from sqlalchemy import DateTime, Enum
+
+try:
+    import orjson
+except ImportError:  # Optional: the stdlib encoder is used instead
+    orjson = None
+
+
+def enum_name(value):
+    return value.name
+
+
+def isoformat(value):
+    return value.isoformat()
+
+
+class ModelSerializer:
+    """Precompiled column-to-JSON mapping for a model, applied to plain row tuples.
+
+    Produces the same dictionaries as the model's to_dict() from a row holding the model's
+    columns in `columns` order, so list endpoints can select columns instead of ORM entities.
+    """
+
+    def __init__(self, model_class):
+        self.model_class = model_class
+        self.columns = list(model_class.__table__.columns)
+        self._fields = []  # (key, index, converter or None), in column order like to_dict()
+
+        for index, column in enumerate(self.columns):
+            if isinstance(column.type, Enum):
+                self._fields.append((column.key, index, enum_name))
+            elif isinstance(column.type, DateTime):
+                self._fields.append((column.key, index, isoformat))
+            else:
+                self._fields.append((column.key, index, None))
+
+    def from_row(self, row, offset=0):
+        """Dictionary for the model's columns found in row starting at offset."""
+        data = {}
+        for key, index, convert in self._fields:
+            value = row[offset + index]
+            data[key] = value if convert is None or value is None else convert(value)
+        return data
+
+    def __call__(self, row):
+        return self.from_row(row)
+
+    def __len__(self):
+        return len(self.columns)
+
+
+class NestedSerializer:
+    """Serializer for a row holding a model's columns followed by those of related models.
+
+    Each related model is embedded under its key, or None when its columns are all NULL
+    (an outer join that found nothing).
+    """
+
+    def __init__(self, base, **embedded):
+        self.base = base
+        self.embedded = []  # (key, serializer, offset)
+        self.columns = list(base.columns)
+        for key, serializer in embedded.items():
+            self.embedded.append((key, serializer, len(self.columns)))
+            self.columns.extend(serializer.columns)
+
+    def from_row(self, row, offset=0):
+        data = self.base.from_row(row, offset)
+        for key, serializer, start in self.embedded:
+            start += offset
+            data[key] = None if row[start] is None else serializer.from_row(row, start)  # The first column is the primary key
+        return data
+
+    def __call__(self, row):
+        return self.from_row(row)
+
+    def __len__(self):
+        return len(self.columns)
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """Flask JSON provider that encodes with orjson when it is installed."""
+
+    def dumps(self, obj, **kwargs):
+        if orjson is None:
+            return super().dumps(obj, **kwargs)
+
+        options = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS  # Dates go through default() like in Flask
+        if kwargs.get('sort_keys', self.sort_keys):
+            options |= orjson.OPT_SORT_KEYS
+        if kwargs.get('indent'):
+            options |= orjson.OPT_INDENT_2
+        try:
+            return orjson.dumps(obj, default=kwargs.get('default', self.default), option=options).decode()
+        except TypeError:
+            # orjson is stricter about some types (e.g. integers beyond 64 bits); let the stdlib handle them
+            return super().dumps(obj, **kwargs)
+
+
+def json_backend():
+    """Name of the JSON encoder in use."""
+    return 'orjson' if orjson is not None else 'json'
+
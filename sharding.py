@@ -0,0 +1,114 @@
+import heapq
+from itertools import islice
+import threading
+import time
+
+DEFAULT_SHARD = 'default'
+ID_RANGE = 2 ** 40  # Ids each shard hands out; 8191 shards stay below 2 ** 53, the largest id JSON clients read exactly
+
+
+def parse_shards(value):
+    """{name: url} from 'name=url' pairs separated by whitespace or commas, in the order given."""
+    shards = {}
+    for entry in value.replace(',', ' ').split():
+        name, separator, url = entry.partition('=')
+        if not separator or not name or not url:
+            raise ValueError(f"Invalid shard '{entry}': use name=url.")
+        if name == DEFAULT_SHARD or name in shards:
+            raise ValueError(f"Shard name '{name}' is reserved or used twice.")
+        shards[name] = url
+    return shards
+
+
+class ShardRouter:
+    """Says which shard holds each branch, and which shard hands out which ids.
+
+    `names` lists the shards, the default one (the primary database) first; their order fixes the
+    id ranges, so new shards go at the end. load() returns {branch: (shard, moving)} from the
+    directory table; branches missing from it live on the default shard. Each process keeps its
+    copy for `ttl` seconds. A shard that a branch is being moved off is read-only meanwhile.
+    """
+
+    def __init__(self, names, load, ttl=5.0):
+        self.names = list(names)
+        self.load = load
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._directory = {}
+        self._loaded_at = None
+        self._subscribers = []
+
+        self.reloads = 0
+
+    @property
+    def sharded(self):
+        return len(self.names) > 1
+
+    def subscribe(self, callback):
+        """Call callback(branches) with the branches whose shard changed when the directory is reloaded."""
+        self._subscribers.append(callback)
+
+    def shard_for(self, branch):
+        if not self.sharded or branch is None:
+            return DEFAULT_SHARD
+        return self.directory().get(branch, (DEFAULT_SHARD, False))[0]
+
+    def branches(self, shard):
+        """Branches the directory places on a shard (branches not listed live on the default one)."""
+        return sorted(branch for branch, (name, _) in self.directory().items() if name == shard)
+
+    def is_read_only(self, shard):
+        return self.sharded and any(moving and name == shard for name, moving in self.directory().values())
+
+    def home_shard(self, record_id):
+        """The shard whose id range holds record_id; the row is there unless its branch was moved since."""
+        position = record_id // ID_RANGE
+        return self.names[position] if 0 <= position < len(self.names) else None
+
+    def id_base(self, shard):
+        return self.names.index(shard) * ID_RANGE
+
+    def directory(self):
+        with self._lock:
+            if self._loaded_at is not None and time.monotonic() - self._loaded_at < self.ttl:
+                return self._directory
+        directory = self.load()
+        with self._lock:
+            previous, self._directory = self._directory, directory
+            self._loaded_at = time.monotonic()
+            self.reloads += 1
+        moved = [branch for branch in set(previous) | set(directory)
+                 if previous.get(branch, (DEFAULT_SHARD,))[0] != directory.get(branch, (DEFAULT_SHARD,))[0]]
+        if moved and self.reloads > 1:  # The first load is not a move
+            for callback in self._subscribers:
+                callback(moved)
+        return directory
+
+    def invalidate(self):
+        """Reload the directory on the next lookup."""
+        with self._lock:
+            self._loaded_at = None
+
+    def stats(self):
+        directory = self._directory
+        return {'shards': len(self.names), 'mapped_branches': len(directory),
+                'moving_branches': sum(1 for _, moving in directory.values() if moving), 'reloads': self.reloads}
+
+
+def merge_sorted(streams, key=None, limit=None):
+    """Merge per-shard streams that are each sorted by key, lazily, stopping after `limit` items.
+
+    An item with the same key as the one before is skipped: while a branch is being moved its
+    rows are on both shards for a moment.
+    """
+    merged = distinct(heapq.merge(*streams, key=key), key or (lambda item: item))
+    return merged if limit is None else islice(merged, limit)
+
+
+def distinct(items, key):
+    previous = object()
+    for item in items:
+        value = key(item)
+        if value != previous:
+            previous = value
+            yield item
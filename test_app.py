@@ -1,6 +1,39 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
 import unittest
+
+# Point the app at a throwaway database before it is imported
+TEST_DIR = tempfile.mkdtemp()
+os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(TEST_DIR, 'test_library.db'))
+os.environ.setdefault('JWT_BLOCKLIST_CHANNEL', os.path.join(TEST_DIR, 'token_blocklist.channel'))
+os.environ.setdefault('RESPONSE_CACHE_SHARED_PATH', os.path.join(TEST_DIR, 'response_cache.db'))
+os.environ.setdefault('LOG_ARCHIVE_DIR', os.path.join(TEST_DIR, 'log_archive'))
+os.environ.setdefault('REPORT_DIR', os.path.join(TEST_DIR, 'reports'))
+os.environ.setdefault('PASSWORD_HASH_METHOD', 'pbkdf2:sha256:1000')  # scrypt costs ~120 ms per hash, twice per setUp
+os.environ.setdefault('SHARDS', 'east=sqlite:///' + os.path.join(TEST_DIR, 'test_library_east.db'))  # Sharded, with no branch moved yet
+os.environ.setdefault('SHARD_DIRECTORY_TTL', '0')
+
 from flask import Flask
-from app import app, db, User, Books, Customers, Loans  # Adjust imports as necessary
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import column, create_engine, insert, table, text
+from sqlalchemy.exc import OperationalError
+from app import app, address_limiter, availability_indexes, compact_changes, db, entity_cache, log_buffer, password_hasher, username_limiter, overdue_trackers, purge_expired_tokens, rebuild_stats, response_cache, run_log_retention, User, Books, Customers, Loans, Log, LoanType, BookCategory, City, TokenBlacklist  # Adjust imports as necessary
+from db_profile import REPLICA_BIND, RoutingSession, current_pragmas, use_read_replica
+from log_buffer import LogBuffer
+from password_hashing import PasswordHashBusy, PasswordHasher
+from rate_limit import TokenBucketLimiter
+from availability import AvailabilityIndex
+from entity_cache import EntityCache
+from overdue import OverdueTracker
+from token_blocklist import BlocklistCache
+from transactions import TransactionRetry
 
 class LibraryManagementSystemTestCase(unittest.TestCase):
 
@@ -12,6 +45,14 @@ class LibraryManagementSystemTestCase(unittest.TestCase):
         self.app_context = self.app.app_context()
         self.app_context.push()
         db.create_all()  # Create the database tables
+        for tracker in overdue_trackers.values():
+            tracker.reset()  # Forget loans from the previous test's database
+        for index in availability_indexes.values():
+            index.reset()
+        entity_cache.reset()
+        response_cache.clear()
+        username_limiter.reset()
+        address_limiter.reset()
 
         # Create a test user
         self.test_user = User(username='testuser')
@@ -36,12 +77,12 @@ class LibraryManagementSystemTestCase(unittest.TestCase):
 
     def test_create_user(self):
         """Test creating a new user."""
-        response = self.app.test_client().post('/user', json={
+        response = self.app.test_client().post('/register', json={
             'username': 'newuser',
             'password': 'newpass'
         })
         self.assertEqual(response.status_code, 201)
-        self.assertIn(b'User created successfully', response.data)
+        self.assertIn(b'User registered successfully', response.data)
 
     def test_create_book(self):
         """Test creating a new book."""
@@ -49,7 +90,8 @@ class LibraryManagementSystemTestCase(unittest.TestCase):
             'name': '1984',
             'author': 'George Orwell',
             'year_published': 1949,
-            'loan_time_type': 'TEN_DAYS'
+            'loan_time_type': 'TEN_DAYS',
+            'category': 'SCIENCE_FICTION'
         }, headers={'Authorization': f'Bearer {self.token}'})  # Include the token
         self.assertEqual(response.status_code, 201)
         self.assertIn(b'1984', response.data)
@@ -60,12 +102,923 @@ class LibraryManagementSystemTestCase(unittest.TestCase):
             'name': '1984',
             'author': 'George Orwell',
             'year_published': 1949,
-            'loan_time_type': 'TEN_DAYS'
+            'loan_time_type': 'TEN_DAYS',
+            'category': 'SCIENCE_FICTION'
         }, headers={'Authorization': f'Bearer {self.token}'})  # Include the token
 
         response = self.app.test_client().post('/book/search', json={'name': '1984'}, headers={'Authorization': f'Bearer {self.token}'})  # Include the token
         self.assertEqual(response.status_code, 200)
         self.assertIn(b'1984', response.data)
 
+    def add_books(self, count):
+        """Insert a number of books directly into the database."""
+        db.session.add_all([
+            Books(name=f'Book {i}', author='Author', year_published=2000, loan_time_type=LoanType.TEN_DAYS, category=BookCategory.MYSTERY)
+            for i in range(count)
+        ])
+        db.session.commit()
+
+    def test_books_keyset_pagination(self):
+        """Following next_cursor walks every book exactly once."""
+        self.add_books(5)
+        client = self.app.test_client()
+
+        names, cursor = [], None
+        while True:
+            url = '/books?limit=2' + (f'&after={cursor}' if cursor else '')
+            response = client.get(url)
+            self.assertEqual(response.status_code, 200)
+            names += [book['name'] for book in response.json['items']]
+            cursor = response.json['next_cursor']
+            if cursor is None:
+                break
+
+        self.assertEqual(names, [f'Book {i}' for i in range(5)])
+        self.assertEqual(client.get('/books?after=not-a-cursor').status_code, 400)
+        self.assertEqual(client.get('/books?limit=abc').status_code, 400)
+        self.assertEqual(client.get('/books?limit=0').status_code, 400)
+
+    def test_books_streaming(self):
+        """Streaming modes return every book as a JSON array or NDJSON lines."""
+        self.add_books(3)
+        client = self.app.test_client()
+
+        response = client.get('/books?stream=ndjson')
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        self.assertEqual(len(response.get_data(as_text=True).splitlines()), 3)
+
+        response = client.get('/books?stream=json')
+        self.assertEqual([book['name'] for book in response.json], ['Book 0', 'Book 1', 'Book 2'])
+
+    def test_full_text_search(self):
+        """Searches match word prefixes, follow later edits and respect the limit."""
+        self.add_books(3)
+        db.session.add(Customers(full_name='Jane Smith', email='jane@example.com', city=City.HAIFA, age=30))
+        db.session.commit()
+        client = self.app.test_client()
+
+        response = client.post('/book/search', json={'name': 'boo 1'})
+        self.assertEqual([book['name'] for book in response.json], ['Book 1'])
+        self.assertEqual(len(client.post('/author/search', json={'author': 'auth', 'limit': 2}).json), 2)
+        self.assertEqual(client.post('/author/search', json={'author': 'auth', 'limit': 0}).status_code, 400)
+        self.assertEqual(client.post('/customer/search', json={'email': 'jane@example'}).json[0]['full_name'], 'Jane Smith')
+
+        Books.query.filter_by(name='Book 1').first().name = 'Renamed'
+        db.session.commit()
+        self.assertEqual(client.post('/book/search', json={'name': 'boo 1'}).status_code, 404)
+        self.assertEqual(client.post('/book/search', json={'name': 'renam'}).json[0]['name'], 'Renamed')
+
+    def test_bulk_import_and_export(self):
+        """Bulk imports insert the valid rows, report the bad ones, and round-trip through export."""
+        client = self.app.test_client()
+        headers = {'Authorization': f'Bearer {self.token}'}
+        books_csv = (
+            'name,author,year_published,loan_time_type,category\n'
+            'Dune,Frank Herbert,1965,TEN_DAYS,SCIENCE_FICTION\n'
+            'Emma,Jane Austen,1815,FOREVER,ROMANCE\n'
+            'Dune,Someone Else,2000,TWO_DAYS,MYSTERY\n'
+            'Ulysses,James Joyce,1922,FIVE_DAYS,NON_FICTION\n'
+        )
+        response = client.post('/books/import', data=books_csv, content_type='text/csv', headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json['inserted'], 2)
+        self.assertEqual([error['row'] for error in response.json['errors']], [3, 4])
+
+        customers_ndjson = '{"full_name": "Ann Lee", "email": "ann@example.com", "city": "HAIFA", "age": 40}\nnot json\n'
+        response = client.post('/customers/import', data=customers_ndjson, content_type='application/x-ndjson', headers=headers)
+        self.assertEqual((response.json['inserted'], response.json['failed']), (1, 1))
+
+        dune = Books.query.filter_by(name='Dune').first()
+        loans_ndjson = f'{{"customer_id": 1, "book_id": {dune.id}, "loan_time_type": "TWO_DAYS"}}\n' * 2
+        response = client.post('/loans/import', data=loans_ndjson, content_type='application/x-ndjson', headers=headers)
+        self.assertEqual((response.json['inserted'], response.json['failed']), (1, 1))
+        db.session.refresh(dune)
+        self.assertTrue(dune.is_loaned)
+
+        # Inactive books and customers at the loan limit are refused as at checkout; dates are stored as naive UTC
+        ulysses = Books.query.filter_by(name='Ulysses').first()
+        ulysses_loan = f'{{"customer_id": 1, "book_id": {ulysses.id}, "loan_time_type": "FIVE_DAYS", "loan_date": "2024-01-01T12:00:00+02:00"}}\n'
+        client.post('/book/status', json={'name': 'Ulysses'}, headers=headers)
+        response = client.post('/loans/import', data=ulysses_loan, content_type='application/x-ndjson', headers=headers)
+        self.assertEqual((response.json['inserted'], response.json['failed']), (0, 1))
+        client.post('/book/status', json={'name': 'Ulysses'}, headers=headers)
+        self.app.config['MAX_ACTIVE_LOANS_PER_CUSTOMER'] = 1
+        try:
+            response = client.post('/loans/import', data=ulysses_loan, content_type='application/x-ndjson', headers=headers)
+            self.assertEqual((response.json['inserted'], response.json['failed']), (0, 1))
+        finally:
+            self.app.config['MAX_ACTIVE_LOANS_PER_CUSTOMER'] = 0
+        response = client.post('/loans/import', data=ulysses_loan, content_type='application/x-ndjson', headers=headers)
+        self.assertEqual(response.json['inserted'], 1)
+        self.assertEqual(Loans.query.filter_by(book_id=ulysses.id).one().loan_date, datetime(2024, 1, 1, 10))
+
+        # Input that cannot be read on stops the import with a 400 naming the line
+        response = client.post('/books/import', data=b'name,author,year_published,loan_time_type,category\nCaf\xe9,A,2000,TEN_DAYS,MYSTERY\n',
+                               content_type='text/csv', headers=headers)
+        self.assertEqual((response.status_code, response.json['unreadable']['line']), (400, 2))
+        response = client.post('/customers/import', data=b'{"full_name": "Bo"}\n\xff\n', content_type='application/x-ndjson', headers=headers)
+        self.assertEqual((response.status_code, response.json['unreadable']['line']), (400, 2))
+
+        exported = client.get('/books/export?format=csv').get_data(as_text=True).splitlines()
+        self.assertEqual(exported[0].split(',')[:3], ['id', 'name', 'author'])
+        self.assertEqual(len(exported), 3)
+
+    def test_metrics_endpoint(self):
+        """Requests are counted per route with their SQL statements, and slow ones keep their SQL."""
+        from app import metrics
+        client = self.app.test_client()
+        self.add_books(2)
+        metrics.slow_threshold, threshold = 1e-9, metrics.slow_threshold  # Treat every request as slow
+        try:
+            client.get('/books')
+        finally:
+            metrics.slow_threshold = threshold
+
+        body = client.get('/metrics').get_data(as_text=True)
+        self.assertIn('library_requests_total{method="GET",route="/books",status="200"}', body)
+        self.assertRegex(body, r'library_db_queries_total\{method="GET",route="/books"\} [1-9]')
+        self.assertIn('library_log_buffer{key="queue_depth"}', body)
+        slow = client.get('/metrics/slow').json
+        self.assertTrue(any(entry['route'] == '/books' and entry['statements'] for entry in slow))
+
+    def test_migrations_create_indexed_schema(self):
+        """Migrating an empty database creates the schema, and every listing query uses an index."""
+        from app import MIGRATIONS, upgrade_database, check_listing_indexes
+        import migrations
+        db.session.remove()
+        db.drop_all()
+        migrations.schema_version.drop(db.engine, checkfirst=True)
+        try:
+            self.assertEqual(upgrade_database(), [migration.version for migration in MIGRATIONS])
+            self.assertEqual(upgrade_database(), [])
+            for name, indexed, plan in check_listing_indexes():
+                self.assertTrue(indexed, f"{name} does not use an index: {plan}")
+        finally:
+            migrations.schema_version.drop(db.engine, checkfirst=True)
+
+    def test_late_loans_exclude_returned(self):
+        """Only open loans past their return date are late, and returning one removes it."""
+        self.add_books(3)
+        db.session.add(Customers(full_name='Jane Smith', email='jane@example.com', city=City.HAIFA, age=30))
+        past, future = datetime.utcnow() - timedelta(days=1), datetime.utcnow() + timedelta(days=1)
+        db.session.add_all([
+            Loans(customer_id=1, book_id=1, loan_time_type=LoanType.ONE_DAY, return_date=past),
+            Loans(customer_id=1, book_id=2, loan_time_type=LoanType.ONE_DAY, return_date=past, is_active=False),
+            Loans(customer_id=1, book_id=3, loan_time_type=LoanType.ONE_DAY, return_date=future)
+        ])
+        db.session.commit()
+        client = self.app.test_client()
+
+        self.assertEqual([loan['id'] for loan in client.get('/loans?status=late').json], [1])
+        client.post('/return/1', headers={'Authorization': f'Bearer {self.token}'})
+        self.assertEqual(client.get('/loans?status=late').json, [])
+
+    def test_loan_listing_matches_to_dict(self):
+        """Loan listings built from row tuples match the ORM to_dict() output, embedded records included."""
+        self.add_books(2)
+        db.session.add(Customers(full_name='Jane Smith', email='jane@example.com', city=City.HAIFA, age=30))
+        db.session.add_all([
+            Loans(customer_id=1, book_id=1, loan_time_type=LoanType.ONE_DAY, return_date=datetime.utcnow()),
+            Loans(customer_id=1, book_id=99, loan_time_type=LoanType.TEN_DAYS, return_date=datetime.utcnow())  # Book is gone
+        ])
+        db.session.commit()
+
+        expected = []
+        for loan in Loans.query.order_by(Loans.id):
+            loan_info = loan.to_dict()
+            loan_info['book'] = loan.book.to_dict() if loan.book else None
+            loan_info['customer'] = loan.customer.to_dict() if loan.customer else None
+            expected.append(loan_info)
+
+        client = self.app.test_client()
+        self.assertEqual(client.get('/loans').json, expected)
+        self.assertEqual(client.get('/loans?limit=1').json['items'], expected[:1])
+        self.assertEqual(client.get('/books').json, [book.to_dict() for book in Books.query.order_by(Books.id)])
+
+    def test_response_cache_and_etags(self):
+        """Book listings are served from the cache with an ETag until a write invalidates them."""
+        self.add_books(1)
+        client = self.app.test_client()
+        headers = {'Authorization': f'Bearer {self.token}'}
+
+        first = client.get('/books')
+        etag = first.headers['ETag']
+        self.assertEqual(client.get('/books', headers={'If-None-Match': etag}).status_code, 304)
+        db.session.add(Books(name='Sneaky', author='Direct insert', year_published=2000,
+                             loan_time_type=LoanType.TEN_DAYS, category=BookCategory.MYSTERY))
+        db.session.commit()
+        self.assertEqual(client.get('/books').json, first.json)  # Not written through the API, so still cached
+
+        client.post('/book/status', json={'name': 'Book 0'}, headers=headers)
+        response = client.get('/books', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+        self.assertEqual([book['name'] for book in response.json], ['Sneaky'])
+
+    def test_logout_revokes_token(self):
+        """A token stops working as soon as it is logged out."""
+        client = self.app.test_client()
+        headers = {'Authorization': f'Bearer {self.token}'}
+        self.assertEqual(client.post('/check_login', headers=headers).status_code, 200)
+        self.assertEqual(client.post('/logout', headers=headers).status_code, 200)
+        self.assertEqual(client.post('/check_login', headers=headers).status_code, 401)
+
+    def test_purge_expired_tokens(self):
+        """Blacklist rows older than the access token lifetime are purged."""
+        db.session.add(TokenBlacklist(jti='old', created_at=datetime.utcnow() - timedelta(days=2)))
+        db.session.add(TokenBlacklist(jti='recent'))
+        db.session.commit()
+
+        self.assertEqual(purge_expired_tokens(), 1)
+        self.assertEqual([token.jti for token in TokenBlacklist.query.all()], ['recent'])
+
+    def test_concurrent_checkouts_loan_a_book_once(self):
+        """Of many parallel checkouts of one book exactly one succeeds, and a missing customer releases the book."""
+        self.add_books(1)
+        db.session.add(Customers(full_name='Jane Smith', email='jane@example.com', city=City.HAIFA, age=30))
+        db.session.commit()
+        headers = {'Authorization': f'Bearer {self.token}'}
+
+        response = self.app.test_client().post('/loan', json={'customer_id': 99, 'book_id': 1, 'loan_time_type': 'ONE_DAY'}, headers=headers)
+        self.assertEqual(response.status_code, 404)
+
+        def checkout(_):
+            return self.app.test_client().post('/loan', json={'customer_id': 1, 'book_id': 1, 'loan_time_type': 'ONE_DAY'}, headers=headers).status_code
+
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            statuses = list(pool.map(checkout, range(16)))
+        self.assertEqual(sorted(statuses), [201] + [400] * 15)
+        db.session.expire_all()
+        self.assertEqual(Loans.query.count(), 1)
+        self.assertTrue(db.session.get(Books, 1).is_loaned)
+
+    def test_return_and_delete_act_once(self):
+        """A loan is returned once, and deleting a returned loan leaves its book with the newer loan that took it."""
+        client = self.app.test_client()
+        headers = {'Authorization': f'Bearer {self.token}'}
+        self.add_books(1)
+        db.session.add(Customers(full_name='Jane Smith', email='jane@example.com', city=City.HAIFA, age=30))
+        db.session.commit()
+
+        first = client.post('/loan', json={'customer_id': 1, 'book_id': 1, 'loan_time_type': 'ONE_DAY'}, headers=headers).json['id']
+        self.assertEqual(client.post(f'/return/{first}', headers=headers).status_code, 200)
+        self.assertEqual(client.post(f'/return/{first}', headers=headers).status_code, 400)
+        second = client.post('/loan', json={'customer_id': 1, 'book_id': 1, 'loan_time_type': 'ONE_DAY'}, headers=headers).json['id']
+
+        self.assertEqual(client.delete(f'/loan/{first}', headers=headers).status_code, 200)
+        self.assertEqual(client.delete(f'/loan/{first}', headers=headers).status_code, 404)
+        self.assertEqual(client.post(f'/return/{first}', headers=headers).status_code, 404)
+        response = client.post('/loan', json={'customer_id': 1, 'book_id': 1, 'loan_time_type': 'ONE_DAY'}, headers=headers)
+        self.assertEqual(response.status_code, 400)  # Still out on the second loan
+        self.assertEqual(client.get('/stats/books').json['loaned'], 1)
+        self.assertEqual(client.delete(f'/loan/{second}', headers=headers).status_code, 200)
+        self.assertEqual(client.get('/stats/books').json['loaned'], 0)
+
+    def test_concurrent_returns_count_once(self):
+        """Parallel returns and deletes of one loan change the counters once."""
+        self.add_books(2)
+        db.session.add(Customers(full_name='Jane Smith', email='jane@example.com', city=City.HAIFA, age=30))
+        db.session.commit()
+        headers = {'Authorization': f'Bearer {self.token}'}
+        for book_id in (1, 2):
+            self.app.test_client().post('/loan', json={'customer_id': 1, 'book_id': book_id, 'loan_time_type': 'ONE_DAY'}, headers=headers)
+
+        def send(request):
+            method, path = request
+            return getattr(self.app.test_client(), method)(path, headers=headers).status_code
+
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            statuses = list(pool.map(send, [('post', '/return/1')] * 8 + [('delete', '/loan/2')] * 8))
+        self.assertEqual(sorted(statuses[:8]), [200] + [400] * 7)
+        self.assertEqual(sorted(statuses[8:]), [200] + [404] * 7)
+        stats = self.app.test_client().get('/stats').json
+        self.assertEqual((stats['books']['loaned'], stats['loans']['active'], stats['loans']['total']), (0, 0, 1))
+        self.assertEqual(stats['loans']['by_city']['HAIFA'], {'active': 0, 'total': 1})
+
+    def test_batch_checkout_and_return(self):
+        """Batch endpoints report each item and apply the valid ones together."""
+        self.add_books(3)
+        db.session.add(Customers(full_name='Jane Smith', email='jane@example.com', city=City.HAIFA, age=30))
+        db.session.commit()
+        client = self.app.test_client()
+        headers = {'Authorization': f'Bearer {self.token}'}
+
+        response = client.post('/loans/batch', json={'items': [
+            {'customer_id': 1, 'book_id': 1, 'loan_time_type': 'ONE_DAY'},
+            {'customer_id': 1, 'book_id': 2, 'loan_time_type': 'TEN_DAYS'},
+            {'customer_id': 1, 'book_id': 1, 'loan_time_type': 'ONE_DAY'},  # Same book twice
+            {'customer_id': 99, 'book_id': 3, 'loan_time_type': 'ONE_DAY'},
+            {'customer_id': 1, 'book_id': 42, 'loan_time_type': 'ONE_DAY'},
+            {'customer_id': 1, 'book_id': 3, 'loan_time_type': 'FOREVER'}
+        ]}, headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([result['status'] for result in response.json['results']], [201, 201, 400, 404, 400, 400])
+        self.assertEqual(response.json['succeeded'], 2)
+        loan_ids = [result['loan']['id'] for result in response.json['results'][:2]]
+        self.assertEqual([book.is_loaned for book in Books.query.order_by(Books.id)], [True, True, False])
+
+        response = client.post('/returns/batch', json={'loan_ids': loan_ids + [loan_ids[0], 99]}, headers=headers)
+        self.assertEqual([result['status'] for result in response.json['results']], [200, 200, 400, 404])
+        db.session.expire_all()
+        self.assertEqual(Loans.query.filter_by(is_active=True).count(), 0)
+        self.assertFalse(any(book.is_loaned for book in Books.query))
+
+        response = client.post('/returns/batch', json={'loan_ids': loan_ids}, headers=headers)
+        self.assertEqual(response.json['failed'], 2)
+
+    def test_stats_counters_follow_writes(self):
+        """The /stats counters match a full recount after every kind of write."""
+        client = self.app.test_client()
+        headers = {'Authorization': f'Bearer {self.token}'}
+        for i, category in enumerate(['MYSTERY', 'MYSTERY', 'ROMANCE', 'FANTASY']):
+            client.post('/book', json={'name': f'Book {i}', 'author': 'Author', 'year_published': 2000,
+                                       'loan_time_type': 'TEN_DAYS', 'category': category}, headers=headers)
+        db.session.add_all([Customers(full_name='Jane Smith', email='jane@example.com', city=City.HAIFA, age=30),
+                            Customers(full_name='John Doe', email='john@example.com', city=City.EILAT, age=40)])
+        db.session.commit()
+
+        loan_id = client.post('/loan', json={'customer_id': 1, 'book_id': 1, 'loan_time_type': 'ONE_DAY'}, headers=headers).json['id']
+        client.post('/loans/batch', json={'items': [{'customer_id': 2, 'book_id': 2, 'loan_time_type': 'ONE_DAY'},
+                                                    {'customer_id': 2, 'book_id': 3, 'loan_time_type': 'ONE_DAY'}]}, headers=headers)
+        client.post(f'/return/{loan_id}', headers=headers)
+        client.post('/returns/batch', json={'loan_ids': [2]}, headers=headers)
+        client.delete('/loan/3', headers=headers)
+        client.post('/book/status', json={'name': 'Book 3'}, headers=headers)
+
+        stats = client.get('/stats').json
+        self.assertEqual(stats['books'], {'total': 4, 'active': 3, 'loaned': 0})
+        self.assertEqual((stats['loans']['active'], stats['loans']['total']), (0, 2))
+        self.assertEqual(stats['loans']['by_city']['EILAT'], {'active': 0, 'total': 1})
+        self.assertEqual(stats['loans']['by_category']['MYSTERY'], {'active': 0, 'total': 2})
+        self.assertEqual(stats['overdue'], 0)
+        self.assertEqual(client.get('/stats/loans').json, stats['loans'])
+        self.assertEqual(rebuild_stats(), {})  # Nothing drifted
+
+        db.session.execute(text("UPDATE stat_counters SET value = 99 WHERE name = 'books' AND key = 'total'"))
+        db.session.commit()
+        self.assertEqual(rebuild_stats(), {('books', 'total'): (99, 4)})
+        self.assertEqual(client.get('/stats/books').json['total'], 4)
+
+    def test_change_feed(self):
+        """Writes show up on /changes in order, long-polls wake on a write, and compaction keeps unread entries."""
+        client = self.app.test_client()
+        headers = {'Authorization': f'Bearer {self.token}'}
+        start = client.get('/changes').json['next']
+        client.post('/book', json={'name': 'Dune', 'author': 'Frank Herbert', 'year_published': 1965,
+                                   'loan_time_type': 'TEN_DAYS', 'category': 'SCIENCE_FICTION'}, headers=headers)
+        client.post('/book/status', json={'name': 'Dune'}, headers=headers)
+
+        self.assertEqual(client.get(f'/changes?since={start}&consumer=anonymous').status_code, 401)
+        feed = client.get(f'/changes?since={start}&consumer=desk', headers=headers).json
+        self.assertEqual([(change['entity'], change['action']) for change in feed['changes']],
+                         [('books', 'created'), ('books', 'updated')])
+        self.assertFalse(feed['changes'][1]['data']['is_active'])
+
+        timer = threading.Timer(0.2, lambda: self.app.test_client().post('/customer', json={
+            'full_name': 'Jane Smith', 'email': 'jane@example.com', 'city': 'HAIFA', 'age': 30}, headers=headers))
+        timer.start()
+        started = time.monotonic()
+        waited = client.get(f"/changes?since={feed['next']}&wait=10&entity=customers").json
+        timer.join()
+        self.assertLess(time.monotonic() - started, 5)
+        self.assertEqual([change['entity'] for change in waited['changes']], ['customers'])
+
+        self.app.config['CHANGES_STREAM_MAX_SECONDS'] = 0.2
+        try:
+            stream = client.get(f'/changes/stream?since={start}').get_data(as_text=True)
+        finally:
+            self.app.config['CHANGES_STREAM_MAX_SECONDS'] = 300
+        self.assertEqual(stream.count('event: change'), 3)
+        self.assertIn(f"id: {waited['next']}\n", stream)
+
+        # The consumer has read up to the first change, so only that one can go
+        client.get(f"/changes?since={feed['changes'][0]['seq']}&consumer=desk", headers=headers)
+        self.assertEqual(compact_changes(), 1)
+        self.assertEqual(client.get(f'/changes?since={start}').status_code, 410)
+        self.assertEqual(len(client.get(f"/changes?since={feed['changes'][0]['seq']}").json['changes']), 2)
+
+        # On server databases seqs come from the shard's change_log sequence, which starts past the entries there
+        from app import ShardIdSequence, sync_id_sequences
+        with db.engine.begin() as connection:
+            sync_id_sequences(connection)
+        self.assertEqual(db.session.get(ShardIdSequence, 'change_log').last_id, client.get('/changes').json['next'])
+
+    def test_available_books(self):
+        """/books/available follows checkouts, returns, status changes and new books, and pages in id order."""
+        client = self.app.test_client()
+        headers = {'Authorization': f'Bearer {self.token}'}
+        for i, (category, loan_type) in enumerate([('MYSTERY', 'TEN_DAYS'), ('MYSTERY', 'TWO_DAYS'),
+                                                   ('MYSTERY', 'TEN_DAYS'), ('ROMANCE', 'TEN_DAYS')]):
+            client.post('/book', json={'name': f'Book {i}', 'author': 'Author', 'year_published': 2000,
+                                       'loan_time_type': loan_type, 'category': category}, headers=headers)
+        client.post('/customer', json={'full_name': 'Jane Smith', 'email': 'jane@example.com', 'city': 'HAIFA', 'age': 30}, headers=headers)
+
+        def available(query=''):
+            response = client.get('/books/available' + query)
+            self.assertEqual(response.status_code, 200)
+            return [book['id'] for book in response.json['items']]
+
+        self.assertEqual(available('?category=MYSTERY&loan_time_type=TEN_DAYS'), [1, 3])
+        loan_id = client.post('/loan', json={'customer_id': 1, 'book_id': 1, 'loan_time_type': 'ONE_DAY'}, headers=headers).json['id']
+        client.post('/book/status', json={'name': 'Book 2'}, headers=headers)
+        self.assertEqual(available('?category=MYSTERY'), [2])
+        self.assertEqual(available('?loan_time_type=TEN_DAYS'), [4])
+
+        client.post(f'/return/{loan_id}', headers=headers)
+        client.post('/book', json={'name': 'Book 4', 'author': 'Author', 'year_published': 2000,
+                                   'loan_time_type': 'TEN_DAYS', 'category': 'MYSTERY'}, headers=headers)
+        self.assertEqual(available('?category=MYSTERY&loan_time_type=TEN_DAYS'), [1, 5])
+
+        page = client.get('/books/available?limit=2').json
+        self.assertEqual(([book['id'] for book in page['items']], page['count']), ([1, 2], 4))
+        self.assertEqual(available(f"?limit=2&after={page['next_cursor']}"), [4, 5])
+
+        self.app.config['AVAILABILITY_INDEX_ENABLED'] = False
+        try:
+            self.assertEqual(available('?category=MYSTERY'), [1, 2, 5])
+        finally:
+            self.app.config['AVAILABILITY_INDEX_ENABLED'] = True
+        self.assertEqual(client.get('/books/available?category=POETRY').status_code, 400)
+
+    def test_customer_loan_history(self):
+        """/customer/<id>/loans pages a customer's loans newest first with their books; the loan limit and delete guard hold."""
+        client = self.app.test_client()
+        headers = {'Authorization': f'Bearer {self.token}'}
+        self.add_books(4)
+        client.post('/customer', json={'full_name': 'Jane Smith', 'email': 'jane@example.com', 'city': 'HAIFA', 'age': 30}, headers=headers)
+        loan_ids = [client.post('/loan', json={'customer_id': 1, 'book_id': book_id, 'loan_time_type': 'ONE_DAY'},
+                                headers=headers).json['id'] for book_id in (1, 2, 3)]
+        client.post(f'/return/{loan_ids[0]}', headers=headers)
+
+        page = client.get('/customer/1/loans?limit=2').json
+        self.assertEqual([loan['id'] for loan in page['items']], [3, 2])
+        self.assertEqual(page['items'][0]['book']['id'], 3)
+        self.assertEqual([loan['id'] for loan in client.get(f"/customer/1/loans?after={page['next_cursor']}").json['items']], [1])
+        self.assertEqual([loan['id'] for loan in client.get('/customer/1/loans?status=returned').json['items']], [1])
+        self.assertEqual(client.get('/customer/2/loans').status_code, 404)
+        client.post('/customer', json={'full_name': 'John Doe', 'email': 'john@example.com', 'city': 'HAIFA', 'age': 40}, headers=headers)
+        self.assertEqual(client.get('/customer/2/loans').json['items'], [])
+        client.delete('/customer/john@example.com', headers=headers)
+        self.assertEqual(client.get('/customer/2/loans').status_code, 404)  # Not served from the cached page
+
+        self.app.config['MAX_ACTIVE_LOANS_PER_CUSTOMER'] = 2
+        try:
+            response = client.post('/loan', json={'customer_id': 1, 'book_id': 4, 'loan_time_type': 'ONE_DAY'}, headers=headers)
+            self.assertEqual(response.status_code, 400)
+            client.post(f'/return/{loan_ids[1]}', headers=headers)
+            response = client.post('/loans/batch', json={'items': [{'customer_id': 1, 'book_id': 1, 'loan_time_type': 'ONE_DAY'},
+                                                                   {'customer_id': 1, 'book_id': 4, 'loan_time_type': 'ONE_DAY'}]}, headers=headers)
+            self.assertEqual([result['status'] for result in response.json['results']], [201, 400])
+        finally:
+            self.app.config['MAX_ACTIVE_LOANS_PER_CUSTOMER'] = 0
+        db.session.expire_all()
+        self.assertFalse(db.session.get(Books, 4).is_loaned)  # Released again
+
+        self.assertEqual(client.delete('/customer/jane@example.com').status_code, 400)
+
+    def test_reports(self):
+        """A queued report runs on the process pool and its CSV is downloaded; a cancelled job stops before reading rows."""
+        import reports
+        from app import ReportJob, close_reports, database_url, report_path, report_pool
+        client = self.app.test_client()
+        headers = {'Authorization': f'Bearer {self.token}'}
+        self.add_books(3)
+        db.session.add_all([Customers(full_name='Jane Smith', email='jane@example.com', city=City.HAIFA, age=30),
+                            Customers(full_name='John Doe', email='john@example.com', city=City.HAIFA, age=40)])
+        db.session.add_all([
+            Loans(customer_id=1, book_id=1, loan_time_type=LoanType.ONE_DAY, return_date=datetime.utcnow() - timedelta(days=2)),
+            Loans(customer_id=2, book_id=2, loan_time_type=LoanType.ONE_DAY, return_date=datetime.utcnow() - timedelta(days=4)),
+            Loans(customer_id=2, book_id=3, loan_time_type=LoanType.ONE_DAY, return_date=datetime.utcnow() + timedelta(days=1))
+        ])
+        db.session.commit()
+
+        self.assertEqual(client.post('/reports', json={'kind': 'weekly'}, headers=headers).status_code, 400)
+        response = client.post('/reports', json={'kind': 'overdue'}, headers=headers)
+        self.assertEqual(response.status_code, 202)
+        deadline = time.monotonic() + 60
+        while client.get(response.headers['Location'], headers=headers).json['status'] in ('queued', 'running'):
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.05)
+        job = client.get(response.headers['Location'], headers=headers).json
+        self.assertEqual((job['status'], job['rows_done'], job['progress']), ('done', 2, 1.0))
+        csv_text = client.get(job['download'], headers=headers).get_data(as_text=True)
+        self.assertEqual(csv_text.splitlines(), ['city,overdue_loans,average_days_late', 'HAIFA,2,3.0'])
+        self.assertEqual(client.delete(f"/reports/{job['id']}", headers=headers).status_code, 200)
+        self.assertEqual(client.get(job['download'], headers=headers).status_code, 404)
+
+        # In this process, to see the cancellation without racing a pool process
+        job = ReportJob(kind='inventory', cancel_requested=True)
+        db.session.add(job)
+        db.session.commit()
+        urls = [database_url(shard) for shard in ('default', *self.app.config['SHARDS'])]
+        self.assertEqual(reports.run_report(job.id, 'inventory', database_url(), urls, report_path(job.id), 1, job.created_at), 'cancelled')
+        self.assertFalse(os.path.exists(report_path(job.id)))
+
+        # A running job whose process stopped writing progress is failed when it is next read
+        stale = datetime.utcnow() - timedelta(seconds=self.app.config['REPORT_STALE_AFTER'] + 60)
+        job = ReportJob(kind='inventory', status='running', started_at=stale, updated_at=stale)
+        db.session.add(job)
+        db.session.commit()
+        stuck = client.get(f'/reports/{job.id}', headers=headers).json
+        self.assertEqual(stuck['status'], 'failed')
+        self.assertIsNotNone(stuck['finished_at'])
+
+        # Closing the pool cancels the jobs still waiting for a process instead of leaving them queued
+        jobs = [ReportJob(kind='inventory') for _ in range(8)]
+        db.session.add_all(jobs)
+        db.session.commit()
+        for job in jobs:
+            report_pool.submit(job.id, 'inventory', database_url(), urls, report_path(job.id), 1000, job.created_at)
+        dropped = set(close_reports())
+        statuses = {}
+        deadline = time.monotonic() + 60
+        while not statuses or {'queued', 'running'} & set(statuses.values()):
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.05)
+            db.session.expire_all()
+            statuses = {job.id: db.session.get(ReportJob, job.id).status for job in jobs}
+        self.assertTrue(dropped)
+        self.assertEqual({job_id for job_id, status in statuses.items() if status == 'cancelled'}, dropped)
+
+    def test_entity_cache(self):
+        """Customer and book lookups are served from the entity cache, which drops a row as soon as it changes."""
+        client = self.app.test_client()
+        headers = {'Authorization': f'Bearer {self.token}'}
+        self.add_books(3)
+        client.post('/customer', json={'full_name': 'Jane Smith', 'email': 'jane@example.com', 'city': 'HAIFA', 'age': 30}, headers=headers)
+        for book_id in (1, 2):
+            response = client.post('/loan', json={'customer_id': 1, 'book_id': book_id, 'loan_time_type': 'ONE_DAY'}, headers=headers)
+            self.assertEqual(response.status_code, 201)
+        self.assertGreaterEqual(entity_cache.stats()['hits'], 1)  # The second loan found the customer in the cache
+
+        self.assertTrue(client.get('/customer/1/loans').json['items'][0]['book']['is_loaned'])
+        client.post('/return/2', headers=headers)
+        self.assertFalse(client.get('/customer/1/loans').json['items'][0]['book']['is_loaned'])
+
+        for _ in range(2):
+            self.assertEqual(client.post('/book/status', json={'name': 'Book 0'}, headers=headers).status_code, 200)
+        self.assertEqual(client.delete('/book/Book 2', headers=headers).status_code, 200)
+        self.assertIsNone(entity_cache.get_by('books', 'name', 'Book 2'))
+        self.assertEqual(client.delete('/book/Book 2', headers=headers).status_code, 404)
+
+    @unittest.skipUnless(app.config['SHARDS'], "SHARDS is not set")
+    def test_branch_sharding(self):
+        """A branch mapped to another shard keeps its rows there, lists gather from every shard, and moving it keeps the ids."""
+        from app import ShardDirectory, move_branch, shard_engine, shard_router
+        from sharding import ID_RANGE
+        db.session.add(ShardDirectory(branch=City.HAIFA, shard='east'))
+        db.session.commit()
+        shard_router.invalidate()
+        client = self.app.test_client()
+        headers = {'Authorization': f'Bearer {self.token}'}
+        self.add_books(1)
+
+        book = client.post('/book', json={'name': 'Haifa Book', 'author': 'Author', 'year_published': 2000, 'loan_time_type': 'ONE_DAY',
+                                          'category': 'MYSTERY', 'branch': 'HAIFA'}, headers=headers).json
+        customer = client.post('/customer', json={'full_name': 'Jane Smith', 'email': 'jane@example.com', 'city': 'HAIFA', 'age': 30},
+                               headers=headers).json
+        self.assertEqual([book['id'], customer['id']], [ID_RANGE + 1, ID_RANGE + 1])  # From the east shard's id range
+        self.assertEqual([row['id'] for row in client.get('/books/available').json['items']], [1, book['id']])
+        loan = client.post('/loan', json={'customer_id': customer['id'], 'book_id': book['id'], 'loan_time_type': 'ONE_DAY'}, headers=headers).json
+        response = client.post('/loan', json={'customer_id': customer['id'], 'book_id': 1, 'loan_time_type': 'ONE_DAY'}, headers=headers)
+        self.assertEqual(response.status_code, 400)  # Book 1 is at a branch on the default shard
+        self.assertEqual([row['id'] for row in client.get('/books/available').json['items']], [1])
+        with shard_engine('east').connect() as connection:
+            self.assertEqual(connection.exec_driver_sql("SELECT COUNT(*) FROM books").scalar(), 1)
+
+        self.assertEqual([row['id'] for row in client.get('/books?status=all').json], [1, book['id']])
+        self.assertEqual([row['id'] for row in client.get('/books?status=all&branch=HAIFA').json], [book['id']])
+        page = client.get('/books?status=all&limit=1').json
+        self.assertEqual([row['id'] for row in client.get(f"/books?status=all&limit=1&after={page['next_cursor']}").json['items']], [book['id']])
+        self.assertEqual([row['id'] for row in client.post('/book/search', json={'name': 'book'}).json], [1, book['id']])
+        self.assertEqual(client.get('/stats').json['loans']['by_city']['HAIFA']['active'], 1)
+        self.assertEqual([row['id'] for row in client.get('/loans?status=late').json], [])
+
+        self.assertEqual(move_branch('HAIFA', 'default', wait=0), {'customers': 1, 'books': 1, 'loans': 1})
+        self.assertEqual(shard_router.shard_for('HAIFA'), 'default')
+        with shard_engine('east').connect() as connection:
+            self.assertEqual(connection.exec_driver_sql("SELECT COUNT(*) FROM books").scalar(), 0)
+        self.assertEqual([row['id'] for row in client.get('/books?status=all').json], [1, book['id']])
+        self.assertEqual([row['id'] for row in client.get(f"/customer/{customer['id']}/loans").json['items']], [loan['id']])
+        self.assertEqual(client.post(f"/return/{loan['id']}", headers=headers).status_code, 200)
+        self.assertEqual(client.get('/stats').json['loans']['by_city']['HAIFA'], {'active': 0, 'total': 1})
+
+    def test_asgi_entry_point(self):
+        """The ASGI application serves the same routes."""
+        from asgi import application
+        self.add_books(1)
+        messages = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+        async def send(message):
+            messages.append(message)
+
+        scope = {'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET', 'scheme': 'http',
+                 'path': '/books', 'raw_path': b'/books', 'query_string': b'', 'root_path': '', 'headers': [],
+                 'client': ('127.0.0.1', 1234), 'server': ('127.0.0.1', 80)}
+        asyncio.run(application(scope, receive, send))
+        self.assertEqual(messages[0]['status'], 200)
+        body = b''.join(message.get('body', b'') for message in messages[1:])
+        self.assertEqual([book['name'] for book in json.loads(body)], ['Book 0'])
+
+    def test_log_retention(self):
+        """Old records are rolled up per hour, archived in chunks and still searchable in the archive."""
+        hour = (datetime.utcnow() - timedelta(days=40)).replace(minute=0, second=0, microsecond=0)
+        db.session.add_all([Log(timestamp=hour + timedelta(minutes=5), level='INFO', message=f'Old {i}') for i in range(3)] + [
+            Log(timestamp=hour + timedelta(minutes=10), level='ERROR', message='Disk full'),
+            Log(timestamp=hour + timedelta(hours=1, minutes=5), level='INFO', message='Later'),
+            Log(timestamp=hour + timedelta(hours=1, minutes=6), level='INFO', message='Later'),
+            Log(timestamp=datetime.utcnow(), level='INFO', message='Recent')
+        ])
+        db.session.commit()
+        chunk_size, app.config['LOG_RETENTION_CHUNK_SIZE'] = app.config['LOG_RETENTION_CHUNK_SIZE'], 2
+        try:
+            self.assertEqual(run_log_retention()[1], 6)
+        finally:
+            app.config['LOG_RETENTION_CHUNK_SIZE'] = chunk_size
+        self.assertEqual(run_log_retention()[1], 0)
+        self.assertEqual(Log.query.filter(Log.timestamp < hour + timedelta(days=1)).count(), 0)
+        self.assertEqual(Log.query.filter_by(message='Recent').count(), 1)
+
+        client = self.app.test_client()
+        headers = {'Authorization': f'Bearer {self.token}'}
+        window = f'since={hour.isoformat()}&until={(hour + timedelta(hours=2)).isoformat()}'
+        rollup = client.get(f'/log/rollup?{window}', headers=headers).json
+        self.assertEqual([(row['level'], row['count']) for row in rollup], [('ERROR', 1), ('INFO', 3), ('INFO', 2)])
+        archived = client.get(f'/log/archive?{window}&level=ERROR&contains=disk', headers=headers).json
+        self.assertEqual([record['message'] for record in archived['records']], ['Disk full'])
+
+    def test_login_rate_limit(self):
+        """Repeated logins for one username are refused with 429 before any password is checked."""
+        client = self.app.test_client()
+        statuses = [client.post('/login', json={'username': 'testuser', 'password': 'wrong'}).status_code for _ in range(5)]
+        self.assertEqual(statuses, [401] * 4 + [429])  # setUp spent the first token
+        verified = password_hasher.verified
+        response = client.post('/login', json={'username': 'testuser', 'password': 'testpass'})
+        self.assertEqual(response.status_code, 429)
+        self.assertGreaterEqual(int(response.headers['Retry-After']), 1)
+        self.assertEqual(password_hasher.verified, verified)
+        self.assertEqual(client.post('/login', json={'username': 'nobody', 'password': 'x'}).status_code, 401)
+        with self.assertRaises(ValueError):
+            TokenBucketLimiter(5, 0)  # A bucket that never refills would answer with an infinite Retry-After
+
+    def test_rehash_on_login(self):
+        """A password stored with other hash parameters is rehashed with the configured ones at login."""
+        from werkzeug.security import generate_password_hash
+        db.session.add(User(username='legacy', password_hash=generate_password_hash('secret', 'pbkdf2:sha256:500')))
+        db.session.commit()
+        response = self.app.test_client().post('/login', json={'username': 'legacy', 'password': 'secret'})
+        self.assertEqual(response.status_code, 200)
+        user = User.query.filter_by(username='legacy').one()
+        db.session.refresh(user)
+        self.assertFalse(password_hasher.needs_rehash(user.password_hash))
+        self.assertTrue(user.check_password('secret'))
+
+class OverdueTrackerTestCase(unittest.TestCase):
+
+    def test_loans_become_late_in_due_order(self):
+        """Open loans move to the late set as their return dates pass, with one event each."""
+        start = datetime(2024, 1, 1)
+        tracker = OverdueTracker(lambda after_id: [(1, start + timedelta(days=2))] if after_id < 1 else [])
+        events = []
+        tracker.subscribe(events.extend)
+        tracker.rebuild(now=start)
+
+        tracker.add(2, start + timedelta(days=1))
+        tracker.add(3, start + timedelta(days=1))
+        tracker.remove(3)
+        self.assertEqual(tracker.late_ids(now=start + timedelta(days=1, hours=1)), [2])
+        self.assertEqual(tracker.late_ids(now=start + timedelta(days=3)), [1, 2])
+        self.assertEqual([loan_id for loan_id, _ in events], [2, 1])
+
+class AvailabilityIndexTestCase(unittest.TestCase):
+
+    def test_catches_up_from_changes_and_rebuilds_after_a_gap(self):
+        """Logged changes move books between groups; a change log compacted past the index forces a rebuild."""
+        books = [(1, 'A', 'x'), (2, 'B', 'x'), (3, 'A', 'y')]
+        log = []
+
+        def load_changes(after):
+            seqs = [seq for seq, _, _ in log]
+            return (min(seqs, default=None), max(seqs, default=None), [change for change in log if change[0] > after])
+
+        index = AvailabilityIndex(['A', 'B'], ['x', 'y'], lambda: (0, books), load_changes, max_staleness=0)
+        index.refresh()
+        self.assertEqual(index.available('A'), ([1, 3], 2))
+
+        log.extend([(1, 1, None), (2, 4, ('A', 'x')), (3, 1, None)])
+        index.refresh()
+        self.assertEqual(index.available('A', 'x'), ([4], 1))
+        self.assertEqual(index.available(after=2, limit=1), ([3], 3))
+
+        log.append((4, 2 ** 40 + 1, ('B', 'x')))  # An id from another shard's range costs one entry, not 2**40
+        index.refresh()
+        self.assertEqual(index.available('B', 'x'), ([2, 2 ** 40 + 1], 2))
+
+        books = [(2, 'B', 'x')]
+        log[:] = [(9, 2, ('B', 'y'))]  # Seqs 4 to 8 were compacted away unseen
+        index.refresh()
+        self.assertEqual((index.available(), index.rebuilds), (([2], 1), 2))
+        self.assertEqual(index.available('B', 'y'), ([2], 1))
+
+class EntityCacheTestCase(unittest.TestCase):
+
+    def test_invalidation_and_eviction(self):
+        """Changed rows are dropped, rows read before a change are refused, and the least recently used entry goes first."""
+        log = []
+
+        def load_changes(shard, after):
+            seqs = [seq for seq, _, _ in log]
+            changes = [] if after is None else [(kind, record_id) for seq, kind, record_id in log if seq > after]
+            return min(seqs, default=None), max(seqs, default=None), changes
+
+        cache = EntityCache(load_changes, ['default'], max_entries=2, max_staleness=0)
+        cache.refresh()
+        version = cache.version('books')
+        for record_id, name in ((1, 'A'), (2, 'B')):
+            cache.put('books', 'default', {'id': record_id, 'name': name}, version, ('name',))
+        self.assertEqual(cache.get_by('books', 'name', 'A'), ('default', {'id': 1, 'name': 'A'}))
+
+        log.append((1, 'books', 1))  # Another worker changed book 1
+        cache.refresh()
+        self.assertIsNone(cache.get('books', 1))
+        self.assertFalse(cache.put('books', 'default', {'id': 1, 'name': 'A'}, version, ('name',)))  # Read before the change
+
+        version = cache.version('books')
+        for record_id, name in ((3, 'C'), (4, 'D')):
+            cache.put('books', 'default', {'id': record_id, 'name': name}, version, ('name',))
+        self.assertIsNone(cache.get_by('books', 'name', 'B'))
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+        log[:] = [(9, 'customers', 5)]  # Seqs 2 to 8 were compacted away unseen
+        cache.refresh()
+        self.assertEqual(cache.stats()['entries'], 0)
+
+class BlocklistCacheTestCase(unittest.TestCase):
+
+    def test_revocation_reaches_other_workers(self):
+        """A revocation published by one cache is seen by another without a database lookup."""
+        channel = os.path.join(tempfile.mkdtemp(), 'channel')
+        lookups = []
+        worker_a = BlocklistCache(lambda jti: lookups.append(jti) or False, channel)
+        worker_b = BlocklistCache(lambda jti: lookups.append(jti) or False, channel)
+        expires_at = time.time() + 3600
+
+        self.assertFalse(worker_b.is_revoked('token', expires_at))
+        self.assertFalse(worker_b.is_revoked('token', expires_at))  # Served from the negative cache
+        self.assertEqual(lookups, ['token'])
+
+        worker_a.revoke('token', expires_at)
+        self.assertTrue(worker_b.is_revoked('token', expires_at))
+        self.assertEqual(lookups, ['token'])
+
+    def test_prune_compacts_channel(self):
+        """Expired revocations are forgotten and removed from the channel."""
+        channel = os.path.join(tempfile.mkdtemp(), 'channel')
+        cache = BlocklistCache(lambda jti: False, channel)
+        cache.revoke('expired', time.time() - 1)
+        cache.revoke('live', time.time() + 3600)
+
+        self.assertEqual(cache.prune(), 1)
+        with open(channel) as channel_file:
+            self.assertEqual([line.split('\t')[0] for line in channel_file], ['live'])
+
+class TransactionRetryTestCase(unittest.TestCase):
+
+    def test_retries_while_locked(self):
+        """A transaction that hits a locked database is re-run, and other errors are not retried."""
+        engine = create_engine('sqlite://')
+        attempts = []
+
+        def write(connection):
+            attempts.append(connection)
+            if len(attempts) < 3:
+                raise OperationalError('UPDATE books', {}, sqlite3.OperationalError('database is locked'))
+            return 'done'
+
+        retry = TransactionRetry(attempts=5, backoff=0.001)
+        self.assertEqual(retry.run(engine, write), 'done')
+        self.assertEqual(retry.stats(), {'transactions': 1, 'retries': 2, 'failures': 0})
+
+        def broken(connection):
+            raise OperationalError('SELECT', {}, sqlite3.OperationalError('no such table: books'))
+
+        with self.assertRaises(OperationalError):
+            retry.run(engine, broken)
+        self.assertEqual(retry.stats()['retries'], 2)
+
+class DatabaseProfileTestCase(unittest.TestCase):
+
+    def test_sqlite_pragmas_applied(self):
+        """Connections to the SQLite database run in WAL mode with the configured busy timeout."""
+        with app.app_context():
+            with db.engine.connect() as connection:
+                pragmas = current_pragmas(connection)
+        self.assertEqual(pragmas['journal_mode'], 'wal')
+        self.assertEqual(pragmas['synchronous'], 1)  # NORMAL
+        self.assertEqual(pragmas['busy_timeout'], app.config['SQLITE_BUSY_TIMEOUT_MS'])
+
+    def test_reads_routed_to_replica(self):
+        """With use_read_replica() on, queries read the replica while writes still reach the primary."""
+        directory = tempfile.mkdtemp()
+        replica_app = Flask(__name__)
+        replica_app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(directory, 'primary.db')
+        replica_app.config['SQLALCHEMY_BINDS'] = {REPLICA_BIND: 'sqlite:///' + os.path.join(directory, 'replica.db')}
+        routed = SQLAlchemy(replica_app, session_options={'class_': RoutingSession})
+        for url, value in (('primary.db', 'primary'), ('replica.db', 'replica')):
+            with create_engine('sqlite:///' + os.path.join(directory, url)).begin() as connection:
+                connection.exec_driver_sql("CREATE TABLE source (name TEXT)")
+                connection.exec_driver_sql(f"INSERT INTO source VALUES ('{value}')")
+
+        with replica_app.test_request_context():
+            read = lambda: routed.session.execute(text("SELECT name FROM source")).scalar()
+            self.assertEqual(read(), 'primary')
+            routed.session.rollback()
+            use_read_replica()
+            self.assertEqual(read(), 'replica')
+            routed.session.execute(insert(table('source', column('name'))).values(name='written'))
+            routed.session.commit()
+        with create_engine('sqlite:///' + os.path.join(directory, 'primary.db')).connect() as connection:
+            self.assertEqual(connection.exec_driver_sql("SELECT COUNT(*) FROM source").scalar(), 2)
+
+class PasswordHasherTestCase(unittest.TestCase):
+
+    def test_gives_up_when_pool_is_busy(self):
+        """A hash that cannot start within the queue timeout raises PasswordHashBusy instead of waiting."""
+        hasher = PasswordHasher(method='pbkdf2:sha256:1000', workers=1, max_queue=1, queue_timeout=0.05)
+        release = threading.Event()
+        blocker = threading.Thread(target=hasher._run, args=(release.wait, 5))
+        blocker.start()
+        try:
+            time.sleep(0.01)
+            with self.assertRaises(PasswordHashBusy):
+                hasher.hash('secret')
+        finally:
+            release.set()
+            blocker.join()
+        self.assertEqual(hasher.stats()['timed_out'], 1)
+        self.assertEqual(hasher.verify(hasher.hash('secret'), 'secret'), (True, False))
+
+class LogBufferTestCase(unittest.TestCase):
+
+    def test_flush_writes_batches(self):
+        """Queued records are handed to the flush function in batches."""
+        batches = []
+        buffer = LogBuffer(batches.append, max_size=10, batch_size=3, flush_interval=60)
+        for i in range(7):
+            self.assertTrue(buffer.put({'level': 'INFO', 'message': str(i)}))
+        buffer.close()
+
+        self.assertEqual(sum(len(batch) for batch in batches), 7)
+        self.assertTrue(all(len(batch) <= 3 for batch in batches))
+        self.assertEqual(buffer.stats()['flushed'], 7)
+        self.assertEqual(buffer.stats()['queue_depth'], 0)
+
+    def test_drop_policy_when_full(self):
+        """With the drop policy a full queue rejects records and counts them."""
+        buffer = LogBuffer(lambda batch: None, max_size=2, policy='drop')
+        buffer._stop.set()  # Keep the flusher thread from draining the queue
+        results = [buffer.put({'level': 'INFO', 'message': 'x'}) for _ in range(3)]
+        self.assertEqual(results, [True, True, False])
+        self.assertEqual(buffer.stats()['dropped'], 1)
+
+    def test_failed_batch_retried_and_put_after_close(self):
+        """A failing write is retried before its records count as lost; records put after close are written."""
+        batches, failures = [], [1]
+
+        def flush(batch):
+            if failures[0]:
+                failures[0] -= 1
+                raise RuntimeError('database locked')
+            batches.append(batch)
+
+        buffer = LogBuffer(flush, max_size=10, batch_size=10, flush_interval=60, flush_attempts=2, retry_backoff=0)
+        buffer.put({'level': 'INFO', 'message': 'retried'})
+        buffer.close()
+        self.assertEqual(batches, [[{'level': 'INFO', 'message': 'retried'}]])
+
+        self.assertTrue(buffer.put({'level': 'INFO', 'message': 'late'}))
+        self.assertEqual(batches[-1], [{'level': 'INFO', 'message': 'late'}])
+
+        failures[0] = 2
+        self.assertFalse(buffer.put({'level': 'INFO', 'message': 'lost'}))
+        stats = buffer.stats()
+        self.assertEqual((stats['flushed'], stats['flush_errors'], stats['lost'], stats['queue_depth']), (2, 3, 1, 0))
+
+    def test_log_message_reaches_log_table(self):
+        """log_message records are inserted into the Log table once flushed."""
+        with app.app_context():
+            db.create_all()
+            try:
+                from app import log_message
+                log_message('INFO', 'buffered message')
+                log_buffer.flush()
+                self.assertEqual(Log.query.filter_by(message='buffered message').count(), 1)
+            finally:
+                db.session.remove()
+                db.drop_all()
+
 if __name__ == '__main__':
     unittest.main()
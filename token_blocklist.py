@@ -0,0 +1,166 @@
+from collections import OrderedDict
+import os
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows: the channel is still usable, appends are just not locked
+    fcntl = None
+
+
+class BlocklistCache:
+    """In-memory view of revoked JWT ids, kept in sync across workers through an append-only channel file.
+
+    Revoked ids are held until their token expires. Ids that were looked up and found not revoked
+    go into a bounded negative cache whose entries expire at the token expiry or after
+    `negative_ttl` seconds, whichever comes first.
+    """
+
+    def __init__(self, lookup_func, channel_path, negative_ttl=60, max_negative=100000):
+        self.lookup_func = lookup_func  # Called with a jti, returns True if it is revoked in the database
+        self.channel_path = channel_path
+        self.negative_ttl = negative_ttl
+        self.max_negative = max_negative
+
+        self._revoked = {}  # jti -> expiry timestamp
+        self._negative = OrderedDict()  # jti -> timestamp until which "not revoked" may be trusted
+        self._lock = threading.Lock()
+        self._channel_offset = 0
+        self._channel_inode = None
+
+        self.loaded = False
+        self.hits = 0
+        self.misses = 0
+
+    def is_revoked(self, jti, expires_at):
+        """Return True if the token id has been revoked."""
+        now = time.time()
+        self.sync()
+
+        with self._lock:
+            if jti in self._revoked:
+                self.hits += 1
+                return True
+            trusted_until = self._negative.get(jti)
+            if trusted_until is not None and trusted_until > now:
+                self._negative.move_to_end(jti)
+                self.hits += 1
+                return False
+
+        self.misses += 1
+        revoked = self.lookup_func(jti)
+
+        with self._lock:
+            if revoked:
+                self._revoked[jti] = expires_at
+                self._negative.pop(jti, None)
+            else:
+                self._negative[jti] = min(expires_at, now + self.negative_ttl)
+                self._negative.move_to_end(jti)
+                while len(self._negative) > self.max_negative:
+                    self._negative.popitem(last=False)
+        return revoked
+
+    def revoke(self, jti, expires_at):
+        """Record a revocation locally and publish it to the other workers."""
+        with self._lock:
+            self._revoked[jti] = expires_at
+            self._negative.pop(jti, None)
+
+        with self._locked_channel() as channel:
+            channel.write(f"{jti}\t{int(expires_at)}\n")
+
+    def load(self, entries):
+        """Seed the revoked set from (jti, expires_at) pairs, e.g. the database table at startup."""
+        with self._lock:
+            for jti, expires_at in entries:
+                self._revoked[jti] = expires_at
+                self._negative.pop(jti, None)
+            self.loaded = True
+
+    def sync(self):
+        """Apply revocations other workers appended to the channel since the last sync."""
+        try:
+            stat = os.stat(self.channel_path)
+        except FileNotFoundError:
+            return
+
+        with self._lock:
+            if stat.st_ino != self._channel_inode or stat.st_size < self._channel_offset:
+                # The channel was compacted: read it again from the start
+                self._channel_inode = stat.st_ino
+                self._channel_offset = 0
+            if stat.st_size == self._channel_offset:
+                return
+
+            with open(self.channel_path, 'rb') as channel:
+                channel.seek(self._channel_offset)
+                for raw_line in channel:
+                    if not raw_line.endswith(b'\n'):
+                        break  # Partially written line, pick it up next time
+                    self._channel_offset += len(raw_line)
+                    jti, _, expires_at = raw_line.decode('utf-8').rstrip('\n').partition('\t')
+                    self._revoked[jti] = float(expires_at or 0)
+                    self._negative.pop(jti, None)
+
+    def prune(self, now=None):
+        """Forget expired ids and rewrite the channel without them. Returns the number removed."""
+        now = time.time() if now is None else now
+
+        with self._lock:
+            expired = [jti for jti, expires_at in self._revoked.items() if expires_at <= now]
+            for jti in expired:
+                del self._revoked[jti]
+            for jti in [jti for jti, trusted_until in self._negative.items() if trusted_until <= now]:
+                del self._negative[jti]
+
+        self._compact_channel(now)
+        return len(expired)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'revoked': len(self._revoked),
+                'negative': len(self._negative),
+                'hits': self.hits,
+                'misses': self.misses
+            }
+
+    def _compact_channel(self, now):
+        if not os.path.exists(self.channel_path):
+            return
+
+        with self._locked_channel():
+            with open(self.channel_path, 'r', encoding='utf-8') as channel:
+                lines = [line for line in channel if line.endswith('\n') and float(line.rstrip('\n').partition('\t')[2] or 0) > now]
+            temp_path = self.channel_path + '.tmp'
+            with open(temp_path, 'w', encoding='utf-8') as compacted:
+                compacted.writelines(lines)
+            os.replace(temp_path, self.channel_path)
+
+    def _locked_channel(self):
+        return _ChannelLock(self.channel_path)
+
+
+class _ChannelLock:
+    """Exclusive lock shared by channel appends and compaction, held on a sidecar lock file."""
+
+    def __init__(self, channel_path):
+        self.channel_path = channel_path
+        self._lock_file = None
+        self._channel = None
+
+    def __enter__(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.channel_path)), exist_ok=True)
+        self._lock_file = open(self.channel_path + '.lock', 'a')
+        if fcntl is not None:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+        self._channel = open(self.channel_path, 'a', encoding='utf-8')
+        return self._channel
+
+    def __exit__(self, *exc_info):
+        self._channel.close()
+        if fcntl is not None:
+            fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+        self._lock_file.close()
@@ -0,0 +1,67 @@
+import random
+import threading
+import time
+
+from sqlalchemy.exc import OperationalError
+
+
+LOCK_MESSAGES = ('database is locked', 'database table is locked', 'database is busy')
+
+
+def is_lock_error(error):
+    """True for the SQLite errors raised when another connection holds the write lock."""
+    return isinstance(error, OperationalError) and any(message in str(error.orig).lower() for message in LOCK_MESSAGES)
+
+
+class Rollback(Exception):
+    """Raise inside a transaction function to roll back and hand `result` to the caller."""
+
+    def __init__(self, result=None):
+        super().__init__(result)
+        self.result = result
+
+
+class TransactionRetry:
+    """Runs short write transactions, retrying with jittered exponential backoff while the database is locked.
+
+    `func(connection)` is called inside engine.begin(); it is re-run from scratch on every attempt,
+    so it must not have side effects outside the transaction.
+    """
+
+    def __init__(self, attempts=5, backoff=0.01, max_backoff=0.5):
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._lock = threading.Lock()
+
+        self.transactions = 0
+        self.retries = 0
+        self.failures = 0  # Still locked after the last attempt
+
+    def run(self, engine, func):
+        for attempt in range(1, self.attempts + 1):
+            try:
+                with engine.begin() as connection:
+                    result = func(connection)
+            except Rollback as rollback:
+                result = rollback.result
+            except OperationalError as error:
+                if not is_lock_error(error):
+                    raise
+                if attempt == self.attempts:
+                    with self._lock:
+                        self.failures += 1
+                    raise
+                with self._lock:
+                    self.retries += 1
+                delay = min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+                time.sleep(delay * random.uniform(0.5, 1.5))  # Jitter keeps competing workers from retrying in step
+                continue
+
+            with self._lock:
+                self.transactions += 1
+            return result
+
+    def stats(self):
+        with self._lock:
+            return {'transactions': self.transactions, 'retries': self.retries, 'failures': self.failures}